@@ -6,9 +6,25 @@ import openai
 import google.generativeai as genai
 from importlib import import_module
 
+from db_schema import connect_db
+from llm_response_cache import cached_llm_call
+
+ENTITY_TAG_SQL = "SELECT tagValue FROM entity_tags WHERE entity_id = ? AND tagCategory = ?"
+
+# The thread's newest message: a template that reads the thread sees new
+# content exactly when this changes.
+THREAD_LAST_MESSAGE_SQL = "SELECT MAX(itemID) FROM itemTags WHERE tagCategory = 'chat_thread' AND tagResponse = ?"
+
+def _tag_number(tags, name, cast):
+    # Tag values are free text; a missing or malformed number is None.
+    try:
+        return cast(tags[name])
+    except (KeyError, TypeError, ValueError):
+        return None
+
 
 def call_model_api(model_name, prompt, db_path, user_name, chat_thread_id):
-    conn = sqlite3.connect(db_path)
+    conn = connect_db(db_path)
     cursor = conn.cursor()
 
     # Get entity_id for model
@@ -28,7 +44,7 @@ def call_model_api(model_name, prompt, db_path, user_name, chat_thread_id):
 
     # Retrieve API key path for this model-user pair
     api_path_key = f"api_path_{model_name}"
-    cursor.execute("SELECT tagValue FROM entity_tags WHERE entity_id = ? AND tagCategory = ?", (user_id, api_path_key))
+    cursor.execute(ENTITY_TAG_SQL, (user_id, api_path_key))
     api_key_path_row = cursor.fetchone()
     api_key_path = api_key_path_row[0] if api_key_path_row else None
 
@@ -48,11 +64,15 @@ def call_model_api(model_name, prompt, db_path, user_name, chat_thread_id):
     elif "provider" in tags and tags["provider"] == "google":
         genai.configure(api_key=api_key)
 
+    cursor.execute(THREAD_LAST_MESSAGE_SQL, (chat_thread_id,))
+    last_message_id = cursor.fetchone()[0]
+
     # Build execution context
+    context_window = _tag_number(tags, "context_window", int)
     local_vars = {
         "prompt": prompt,
         "chat_thread_id": chat_thread_id,
-        "context_window": int(tags.get("context_window", 4096)),
+        "context_window": 4096 if context_window is None else context_window,
     }
 
     try:
@@ -60,7 +80,14 @@ def call_model_api(model_name, prompt, db_path, user_name, chat_thread_id):
             raise RuntimeError("Missing 'api_call_template' tag for model.")
         print("===== Executing API call =====")
         print(tags["api_call_template"])
-        result = eval(tags["api_call_template"], globals(), local_vars)
-        return result
+        # The template may also read the thread, so its last message is part
+        # of the key.
+        return cached_llm_call(
+            tags.get("provider", "custom"), model_name, prompt,
+            lambda: eval(tags["api_call_template"], globals(), local_vars),
+            temperature=_tag_number(tags, "temperature", float), max_tokens=_tag_number(tags, "max_tokens", int),
+            system_prompt=tags.get("system_prompt"),
+            extra=[tags["api_call_template"], last_message_id]
+        )
     except Exception as e:
         raise RuntimeError(f"Failed to execute API call: {str(e)}")
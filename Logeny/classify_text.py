@@ -1,77 +1,524 @@
-from transformers import AutoTokenizer, AutoModelForSequenceClassification, pipeline
+from transformers import AutoTokenizer, pipeline
+import hashlib
 import os
+import time
+import numpy as np
 import torch
 
+from db_schema import connect_db
+from inference_worker import call_inference_worker, inference_worker_url
+from model_registry import DEFAULT_MODEL_DTYPE, default_device, load_pretrained, model_cache_dir, registry
+from vector_db_search import embed_query, re_chunk_file
+from vector_store import DEFAULT_EMBEDDING_MODEL, get_snippet_vectors
+
 # Suppress symlink warnings
 os.environ['HF_HUB_DISABLE_SYMLINKS_WARNING'] = '1'
 
 # ----------------------------- Utility Functions -----------------------------
 
+# Tokens kept free in each chunk for the hypothesis ("This example is
+# {label}.") and the special tokens the NLI pair adds.
+HYPOTHESIS_TOKEN_RESERVE = 32
+
+
+def split_text(text, max_chunk_size=512, tokenizer=None):
+    """
+    Splits a long text into smaller chunks. With a tokenizer, chunks are cut
+    at max_chunk_size tokens (minus HYPOTHESIS_TOKEN_RESERVE) instead of
+    words, so none of a chunk is lost to truncation.
+    """
+    if tokenizer is None:
+        words = text.split()
+        chunks = [' '.join(words[i:i + max_chunk_size]) for i in range(0, len(words), max_chunk_size)]
+        return chunks
 
-def split_text(text, max_chunk_size=512):
-    """Splits a long text into smaller chunks."""
-    words = text.split()
-    chunks = [' '.join(words[i:i + max_chunk_size]) for i in range(0, len(words), max_chunk_size)]
+    budget = max(max_chunk_size - HYPOTHESIS_TOKEN_RESERVE, 1)
+    try:
+        enc = tokenizer(text, add_special_tokens=False, return_offsets_mapping=True)
+        offsets = enc["offset_mapping"]
+    except (NotImplementedError, TypeError, KeyError):
+        # Slow tokenizers have no offsets; decode token windows instead.
+        ids = tokenizer(text, add_special_tokens=False)["input_ids"]
+        return [tokenizer.decode(ids[i:i + budget]).strip() for i in range(0, len(ids), budget)]
+    chunks = []
+    for i in range(0, len(offsets), budget):
+        window = offsets[i:i + budget]
+        chunk = text[window[0][0]:window[-1][1]].strip()
+        if chunk:
+            chunks.append(chunk)
     return chunks
 
 
 # ----------------------------- Model Loading -----------------------------
 
-# Define a local directory to cache the model
-MODEL_NAME = "facebook/bart-large-mnli" # "distilbert-base-uncased"  #  A second widely used default for zero-shot classification
-CACHE_DIR = os.path.join(os.path.dirname(__file__), "models", MODEL_NAME.replace("/", "_"))
-os.makedirs(CACHE_DIR, exist_ok=True)
+# Zero-shot NLI model; LOGENY_CLASSIFIER_MODEL or set_classifier_model()
+# overrides it. The distilled MNLI variants trade a little agreement with
+# bart-large-mnli for several times the throughput on CPU; see
+# benchmark_classifier().
+MODEL_NAME = os.environ.get("LOGENY_CLASSIFIER_MODEL", "facebook/bart-large-mnli")
+DISTILLED_MNLI_MODELS = (
+    "valhalla/distilbart-mnli-12-1",
+    "valhalla/distilbart-mnli-12-3",
+    "valhalla/distilbart-mnli-12-6",
+    "typeform/distilbert-base-uncased-mnli",
+    "cross-encoder/nli-deberta-v3-xsmall",
+)
+
+# Dynamic int8 quantization of the model's Linear layers (CPU only).
+QUANTIZE_INT8 = os.environ.get("LOGENY_CLASSIFIER_INT8", "") == "1"
+
+CLASSIFY_BATCH_SIZE = 16
+
+# The pipeline (and its model) is loaded on first use through the shared
+# model registry, not at import, so sourcing this file from the app stays
+# cheap and the classifier counts against the same RAM budget as the chat
+# models. Tokenizers are small and kept here for chunking.
+_tokenizers = {}
+
+
+def set_classifier_model(model_name=None, quantize=None):
+    """
+    Switches the zero-shot model and/or int8 quantization; the new model is
+    loaded on next use.
+    """
+    global MODEL_NAME, QUANTIZE_INT8
+    if model_name is not None:
+        MODEL_NAME = model_name
+    if quantize is not None:
+        QUANTIZE_INT8 = bool(quantize)
+
 
-# Load tokenizer and model ONCE (outside the function)
-tokenizer = AutoTokenizer.from_pretrained(MODEL_NAME, cache_dir=CACHE_DIR)
+# The functions below take model_name / quantize to use a given classifier
+# for one call (the inference worker serves several at once); None means
+# the current MODEL_NAME / QUANTIZE_INT8.
 
-# Initialize the model globally
-model = None  # Initialize as None
+def _classifier_dtype(quantize=None):
+    quantize = QUANTIZE_INT8 if quantize is None else quantize
+    return "int8" if quantize and default_device() == "cpu" else DEFAULT_MODEL_DTYPE
 
 
-def load_model():
-    global model
-    if model is None:
-        model = AutoModelForSequenceClassification.from_pretrained(
-            MODEL_NAME,
-            cache_dir=CACHE_DIR
+def get_classifier_model(model_name=None, quantize=None):
+    """Model name as recorded with scores and tags ("+int8" etc. unless float32)."""
+    dtype = _classifier_dtype(quantize)
+    return (model_name or MODEL_NAME) + ("" if dtype == "float32" else "+" + dtype)
+
+
+def load_tokenizer(model_name=None):
+    model_name = model_name or MODEL_NAME
+    if model_name not in _tokenizers:
+        _tokenizers[model_name] = AutoTokenizer.from_pretrained(model_name, cache_dir=model_cache_dir(model_name))
+    return _tokenizers[model_name]
+
+
+def max_input_tokens(model_name=None):
+    """The model's real sequence limit (some tokenizers report a huge sentinel)."""
+    limit = load_tokenizer(model_name).model_max_length
+    return limit if limit and limit <= 4096 else 512
+
+
+def _classifier_key(model_name=None, quantize=None):
+    # Same key huggingface_model_runner.get_pipeline() uses for this model.
+    return (model_name or MODEL_NAME, "pipeline:zero-shot-classification", _classifier_dtype(quantize),
+            default_device())
+
+
+def _classifier_loader(key):
+    model_name, _, dtype, device = key
+
+    def load():
+        tokenizer, model = load_pretrained(model_name, "sequence-classification", dtype, device)
+        return pipeline(
+            "zero-shot-classification",
+            model=model,
+            tokenizer=tokenizer,
+            device=0 if device == "cuda" else -1,  # Use GPU if available, else CPU
+            batch_size=CLASSIFY_BATCH_SIZE
         )
-        model.eval()  # Set to evaluation mode
-        # Move the model to the GPU if available
-        if torch.cuda.is_available():
-            model = model.to("cuda")
+    return load
 
 
-load_model()  # Load the model when the script is loaded
+def get_classifier(model_name=None, quantize=None):
+    """Returns the zero-shot pipeline, loading the model on first call."""
+    key = _classifier_key(model_name, quantize)
+    return registry.get(key, _classifier_loader(key))
 
-# Initialize pipeline globally
-global_pipeline = pipeline(
-    "zero-shot-classification",
-    model=model,
-    tokenizer=tokenizer,
-    device=0 if torch.cuda.is_available() else -1,  # Use GPU if available, else CPU
-    batch_size=16  # Add a batch size
-)
+
+def using_classifier(model_name=None, quantize=None):
+    """Context manager yielding the pipeline, pinned in the registry while in use."""
+    key = _classifier_key(model_name, quantize)
+    return registry.using(key, _classifier_loader(key))
+
+
+def split_for_model(text, model_name=None):
+    """split_text at the model's token limit."""
+    return split_text(text, max_input_tokens(model_name), load_tokenizer(model_name))
+
+
+# ----------------------------- Persistent NLI Scores -----------------------------
+
+# The zero-shot pipeline's default hypothesis; `{}` is replaced by the label.
+DEFAULT_HYPOTHESIS_TEMPLATE = "This example is {}."
+
+# Rows per IN (...) lookup against classificationScores.
+SCORE_LOOKUP_BATCH = 500
+
+
+def score_lookup_sql(n):
+    """Cached logits of one template and model for n chunk hashes."""
+    return f"""
+        SELECT chunkHash, label, entailLogit, contradictionLogit
+        FROM classificationScores
+        WHERE template = ? AND model = ? AND chunkHash IN ({",".join("?" * n)})
+    """
+
+
+def _chunk_hash(chunk):
+    return hashlib.sha1(chunk.encode("utf-8")).hexdigest()
+
+
+def _nli_label_ids(model):
+    # Same lookup the zero-shot pipeline does on the model's label names.
+    entail_id, contra_id = -1, 0
+    for label, idx in model.config.label2id.items():
+        if label.lower().startswith("entail"):
+            entail_id = idx
+        elif label.lower().startswith("contra"):
+            contra_id = idx
+    return entail_id, contra_id
+
+
+def _nli_logits(pairs, batch_size, model_name=None, quantize=None):
+    """(entailment, contradiction) logits for (premise, hypothesis) pairs."""
+    out = []
+    with using_classifier(model_name, quantize) as classifier:
+        tokenizer, model = classifier.tokenizer, classifier.model
+        entail_id, contra_id = _nli_label_ids(model)
+        for start in range(0, len(pairs), batch_size):
+            batch = pairs[start:start + batch_size]
+            enc = tokenizer([p for p, _ in batch], [h for _, h in batch], truncation="only_first",
+                            max_length=max_input_tokens(model_name), padding=True,
+                            return_tensors="pt").to(model.device)
+            with torch.no_grad():
+                logits = model(**enc).logits
+            out.extend(logits[:, [entail_id, contra_id]].float().cpu().tolist())
+    return out
+
+
+def score_chunks(db_path, chunks, terms, hypothesis_template=DEFAULT_HYPOTHESIS_TEMPLATE,
+                 batch_size=CLASSIFY_BATCH_SIZE, model_name=None, quantize=None):
+    """
+    Returns an array (len(chunks), len(terms), 2) of (entailment,
+    contradiction) logits. Logits are stored in classificationScores per
+    (chunk content hash, label, template, model), so only chunk x label pairs
+    not seen before go through the model; a new label or an edited chunk
+    costs just its own pairs.
+    """
+    hashes = [_chunk_hash(chunk) for chunk in chunks]
+    model_key = get_classifier_model(model_name, quantize)
+    unique = list(dict.fromkeys(hashes))
+    known = {}
+
+    conn = connect_db(db_path)
+    try:
+        c = conn.cursor()
+        for start in range(0, len(unique), SCORE_LOOKUP_BATCH):
+            batch = unique[start:start + SCORE_LOOKUP_BATCH]
+            c.execute(score_lookup_sql(len(batch)), [hypothesis_template, model_key] + batch)
+            for chunk_hash, label, entail, contra in c.fetchall():
+                known[(chunk_hash, label)] = (entail, contra)
+
+        text_by_hash = dict(zip(hashes, chunks))
+        missing = [(h, t) for h in unique for t in terms if (h, t) not in known]
+        if missing:
+            logits = _nli_logits([(text_by_hash[h], hypothesis_template.format(t)) for h, t in missing],
+                                 batch_size, model_name, quantize)
+            for key, pair in zip(missing, logits):
+                known[key] = tuple(pair)
+            c.executemany("""
+                INSERT OR REPLACE INTO classificationScores
+                  (chunkHash, label, template, model, entailLogit, contradictionLogit)
+                VALUES (?, ?, ?, ?, ?, ?)
+            """, [(h, t, hypothesis_template, model_key) + known[(h, t)] for h, t in missing])
+            conn.commit()
+    finally:
+        conn.close()
+
+    print(f"NLI scores: {len(unique) * len(terms) - len(missing)} cached, {len(missing)} computed.")
+    return np.array([[known[(h, t)] for t in terms] for h in hashes], dtype=np.float32).reshape(
+        len(chunks), len(terms), 2)
+
+
+def _scores_from_logits(logits, multi_label=False):
+    # Mirrors the zero-shot pipeline: softmax over labels of the entailment
+    # logits, or per label entailment vs contradiction when multi_label.
+    if multi_label:
+        pair = logits[..., ::-1]
+        pair = np.exp(pair - pair.max(axis=-1, keepdims=True))
+        return pair[..., 1] / pair.sum(axis=-1)
+    entail = logits[..., 0]
+    entail = np.exp(entail - entail.max(axis=-1, keepdims=True))
+    return entail / entail.sum(axis=-1, keepdims=True)
+
+
+def classify_text_scores(text_list, terms, db_path, hypothesis_template=DEFAULT_HYPOTHESIS_TEMPLATE,
+                         multi_label=False, batch_size=CLASSIFY_BATCH_SIZE, model_name=None, quantize=None):
+    """
+    Full score vector per text: [{label: score, ...}, ...], taken from the
+    text's most confident chunk (the same chunk classify_text_with_map_reduce
+    picks its label from). NLI logits come from score_chunks' cache.
+    """
+    if isinstance(text_list, str):
+        text_list = [text_list]
+    if isinstance(terms, str):
+        terms = [terms]
+    if inference_worker_url():
+        return call_inference_worker("classify_scores", texts=list(text_list), terms=list(terms), db_path=db_path,
+                                     hypothesis_template=hypothesis_template, multi_label=multi_label,
+                                     model=model_name or MODEL_NAME,
+                                     quantize=QUANTIZE_INT8 if quantize is None else quantize)
+
+    chunks = []
+    owners = []
+    for n, text in enumerate(text_list):
+        for chunk in split_for_model(text, model_name):
+            chunks.append(chunk)
+            owners.append(n)
+    if not chunks:
+        return [{} for _ in text_list]
+
+    scores = _scores_from_logits(score_chunks(db_path, chunks, terms, hypothesis_template, batch_size,
+                                              model_name, quantize), multi_label)
+    owners = np.asarray(owners)
+    best = scores.max(axis=1)
+    vectors = []
+    for n in range(len(text_list)):
+        rows = np.flatnonzero(owners == n)
+        if not len(rows):
+            vectors.append({})
+            continue
+        row = rows[np.argmax(best[rows])]
+        vectors.append({t: float(scores[row, j]) for j, t in enumerate(terms)})
+    return vectors
 
 
 # ----------------------------- Classification Function -----------------------------
 
-def classify_text_with_map_reduce(text_list, prompt, terms):
-    """Classify long texts using Map-Reduce."""
+def _reduce_chunk_results(chunk_results):
+    # A text gets the top label of its most confident chunk.
+    return max(chunk_results, key=lambda x: x['scores'][0])['labels'][0]
 
-    classifications = []
 
-    for text in text_list:
+def classify_text_with_map_reduce(text_list, prompt, terms, batch_size=CLASSIFY_BATCH_SIZE, db_path=None,
+                                  hypothesis_template=DEFAULT_HYPOTHESIS_TEMPLATE, model_name=None, quantize=None):
+    """
+    Classify long texts using Map-Reduce.
+
+    The chunks of all texts go through the pipeline as one stream, so
+    batch_size batches across documents, not just within one; results are
+    then regrouped per text. If the combined run fails, each text is retried
+    alone so one bad input only fails itself.
+
+    With db_path, NLI scores are read from and saved to the database (see
+    score_chunks), so re-runs over the same texts only score new labels or
+    changed chunks.
+
+    With LOGENY_INFERENCE_URL set, the shared inference worker classifies
+    instead (see inference_worker.py).
+    """
+    if isinstance(text_list, str):
+        text_list = [text_list]
+
+    if db_path is None and inference_worker_url():
+        return call_inference_worker("classify", texts=list(text_list), terms=list(terms),
+                                     hypothesis_template=hypothesis_template, model=model_name or MODEL_NAME,
+                                     quantize=QUANTIZE_INT8 if quantize is None else quantize)
+
+    if db_path is not None:
         try:
-            chunks = split_text(text, max_chunk_size=512)
-            # Use the global pipeline
-            chunk_results = global_pipeline(chunks, candidate_labels=terms,  truncation=True,  max_length=512)
+            vectors = classify_text_scores(text_list, terms, db_path, hypothesis_template,
+                                           batch_size=batch_size, model_name=model_name, quantize=quantize)
+        except Exception as e:
+            return [f"Error: {str(e)}" for _ in text_list]
+        return [max(v, key=v.get) if v else "Error: empty text" for v in vectors]
+
+    with using_classifier(model_name, quantize) as classifier:
+        return _classify_with_pipeline(classifier, text_list, terms, batch_size, model_name)
 
-            # Process the results.  chunk_results is already a list of dicts.
-            final_classification = max(chunk_results, key=lambda x: x['scores'][0])['labels'][0]
-            classifications.append(final_classification)
+
+def _classify_with_pipeline(classifier, text_list, terms, batch_size, model_name=None):
+    chunks = []
+    owners = []
+    for n, text in enumerate(text_list):
+        for chunk in split_for_model(text, model_name):
+            chunks.append(chunk)
+            owners.append(n)
+
+    grouped = [[] for _ in text_list]
+    try:
+        if chunks:
+            results = classifier(chunks, candidate_labels=terms, truncation=True,
+                                 max_length=max_input_tokens(model_name), batch_size=batch_size)
+            if isinstance(results, dict):
+                results = [results]
+            for owner, result in zip(owners, results):
+                grouped[owner].append(result)
+    except Exception:
+        grouped = None
+
+    classifications = []
+    for n, text in enumerate(text_list):
+        try:
+            if grouped is not None:
+                chunk_results = grouped[n]
+            else:
+                chunk_results = classifier(split_for_model(text, model_name), candidate_labels=terms, truncation=True,
+                                           max_length=max_input_tokens(model_name), batch_size=batch_size)
+                if isinstance(chunk_results, dict):
+                    chunk_results = [chunk_results]
+            classifications.append(_reduce_chunk_results(chunk_results))
 
         except Exception as e:
             classifications.append(f"Error: {str(e)}")
 
     return classifications
+
+
+# ----------------------------- Embedding Cascade -----------------------------
+
+# A snippet whose best label beats the runner-up by less cosine similarity
+# than this is escalated to the NLI model.
+CASCADE_MARGIN = 0.05
+
+# Running totals across calls, see get_cascade_stats().
+_cascade_stats = {"snippets": 0, "embedding_only": 0, "escalated": 0, "no_vector": 0}
+
+
+def get_cascade_stats():
+    stats = dict(_cascade_stats)
+    stats["escalation_rate"] = stats["escalated"] / stats["snippets"] if stats["snippets"] else 0.0
+    return stats
+
+
+def _snippet_texts(db_path, snippet_ids):
+    conn = connect_db(db_path)
+    try:
+        c = conn.cursor()
+        texts = []
+        for snippet_id in snippet_ids:
+            c.execute("""
+                SELECT items.key, documentEmbeddings.chunkIndex, documentEmbeddings.chunkSize
+                FROM documentEmbeddings
+                JOIN items ON items.itemID = documentEmbeddings.itemID
+                WHERE documentEmbeddings.snippetID = ?
+            """, (snippet_id,))
+            row = c.fetchone()
+            texts.append((re_chunk_file(row[0], row[2], row[1]) or "") if row else "")
+    finally:
+        conn.close()
+    return texts
+
+
+def classify_snippets_cascade(db_path, snippet_ids, terms, margin=CASCADE_MARGIN, texts=None,
+                              embedding_model=DEFAULT_EMBEDDING_MODEL,
+                              hypothesis_template=DEFAULT_HYPOTHESIS_TEMPLATE, batch_size=CLASSIFY_BATCH_SIZE):
+    """
+    Two-stage zero-shot classification of embedded snippets. The labels are
+    embedded once and scored against the snippets' stored vectors with one
+    matrix product; only snippets whose top-label margin is below `margin`
+    (or that have no stored vector) go to the NLI model, through
+    classify_text_scores and its score cache. `texts` (one per snippet) is
+    what the NLI model sees; by default the snippet text is rebuilt from its
+    file.
+
+    Returns {"labels": [...], "escalated": [bool, ...], "stats": {...}}.
+    """
+    if isinstance(snippet_ids, (int, np.integer)):
+        snippet_ids = [snippet_ids]
+    if isinstance(terms, str):
+        terms = [terms]
+    if isinstance(texts, str):
+        texts = [texts]
+    snippet_ids = [int(s) for s in snippet_ids]
+
+    vectors, found = get_snippet_vectors(db_path, snippet_ids, embedding_model)
+    label_vecs = np.array([embed_query(t, embedding_model) for t in terms], dtype=np.float32)
+    sims = np.zeros((len(snippet_ids), len(terms)), dtype=np.float32)
+    if vectors.shape[1]:
+        vectors = vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+        label_vecs = label_vecs / np.maximum(np.linalg.norm(label_vecs, axis=1, keepdims=True), 1e-12)
+        sims = vectors @ label_vecs.T
+
+    if len(terms) > 1:
+        top2 = np.sort(sims, axis=1)[:, -2:]
+        gaps = top2[:, 1] - top2[:, 0]
+    else:
+        gaps = np.full(len(snippet_ids), np.inf)
+    escalate = ~found | (gaps < margin)
+    labels = [terms[j] for j in sims.argmax(axis=1)] if len(terms) else []
+
+    idx = np.flatnonzero(escalate)
+    if len(idx):
+        if texts is None:
+            nli_texts = _snippet_texts(db_path, [snippet_ids[i] for i in idx])
+        else:
+            nli_texts = [texts[i] for i in idx]
+        vectors_nli = classify_text_scores(nli_texts, terms, db_path, hypothesis_template, batch_size=batch_size)
+        for i, v in zip(idx, vectors_nli):
+            labels[i] = max(v, key=v.get) if v else "Error: empty text"
+
+    stats = {
+        "snippets": len(snippet_ids),
+        "embedding_only": int(len(snippet_ids) - len(idx)),
+        "escalated": int(len(idx)),
+        "no_vector": int((~found).sum()),
+    }
+    for key, value in stats.items():
+        _cascade_stats[key] += value
+    print(f"Cascade: {stats['embedding_only']} by embedding, {stats['escalated']} escalated to NLI "
+          f"({stats['no_vector']} without stored vectors).")
+    return {"labels": labels, "escalated": escalate.tolist(), "stats": stats}
+
+
+# ----------------------------- Benchmark -----------------------------
+
+def benchmark_classifier(text_list, terms, model_names=DISTILLED_MNLI_MODELS[:2], quantize=(False, True),
+                         batch_size=CLASSIFY_BATCH_SIZE):
+    """
+    Classifies text_list with the current model (unquantized, the reference)
+    and with each of model_names x quantize, and reports docs/sec and the
+    share of labels that agree with the reference. Model load time is
+    reported separately. The current model setting is left unchanged.
+    """
+    if isinstance(text_list, str):
+        text_list = [text_list]
+    if isinstance(model_names, str):
+        model_names = [model_names]
+    configs = [(MODEL_NAME, False)]
+    for name in model_names:
+        for q in quantize:
+            if (name, bool(q)) not in configs:
+                configs.append((name, bool(q)))
+
+    report = []
+    reference = None
+    for name, q in configs:
+        start = time.perf_counter()
+        get_classifier(name, q)
+        load_s = time.perf_counter() - start
+        start = time.perf_counter()
+        labels = classify_text_with_map_reduce(text_list, "", terms, batch_size=batch_size,
+                                               model_name=name, quantize=q)
+        elapsed = time.perf_counter() - start
+        if reference is None:
+            reference = labels
+        agreement = sum(a == b for a, b in zip(labels, reference)) / len(labels) if labels else 0.0
+        row = {
+            "model": get_classifier_model(name, q),
+            "load_s": round(load_s, 2),
+            "docs_per_s": round(len(text_list) / elapsed, 2) if elapsed > 0 else None,
+            "agreement": round(agreement, 4),
+        }
+        print(f"{row['model']}: {row['docs_per_s']} docs/s, {row['agreement']:.1%} agreement "
+              f"(load {row['load_s']}s)")
+        report.append(row)
+    return report
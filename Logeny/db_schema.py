@@ -0,0 +1,281 @@
+import os
+import sqlite3
+
+###############################################################################
+# Versioned schema migrations
+###############################################################################
+
+# Our migrations are tracked in Zotero's own `version` table under this name,
+# next to the stock Zotero schema entries copied in from skeleton.sqlite.
+SCHEMA_NAME = "logeny"
+
+# (version, [statements]) in ascending order. Append new versions at the end;
+# never edit a version once it has shipped, databases in the field already
+# have it recorded.
+SCHEMA_MIGRATIONS = [
+    (1, [
+        # vector_db_search: documentEmbeddings WHERE itemID IN (...)
+        "CREATE INDEX IF NOT EXISTS documentEmbeddings_itemID ON documentEmbeddings(itemID)",
+        # vector_db_search: existence check before inserting a hit
+        "CREATE INDEX IF NOT EXISTS search_results_snippet_query ON search_results(snippetID, query, collection_name)",
+        # chat memory + project notes
+        "CREATE INDEX IF NOT EXISTS itemTags_itemID_category ON itemTags(itemID, tagCategory)",
+        "CREATE INDEX IF NOT EXISTS itemTags_category_response ON itemTags(tagCategory, tagResponse)",
+        # model/user settings lookups
+        "CREATE INDEX IF NOT EXISTS entity_tags_entity_category ON entity_tags(entity_id, tagCategory)",
+        # collection name -> collectionID
+        "CREATE INDEX IF NOT EXISTS collections_collectionName ON collections(collectionName)",
+    ]),
+    (2, [
+        # Ancestor/descendant closure over collections.parentCollectionID, so
+        # a subtree's items resolve in one indexed join. Every collection is
+        # its own ancestor at depth 0.
+        """
+        CREATE TABLE IF NOT EXISTS collectionClosure (
+            ancestorID INT NOT NULL,
+            descendantID INT NOT NULL,
+            depth INT NOT NULL,
+            PRIMARY KEY (ancestorID, descendantID)
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS collectionClosure_descendantID ON collectionClosure(descendantID)",
+        """
+        WITH RECURSIVE tree(ancestorID, descendantID, depth) AS (
+            SELECT collectionID, collectionID, 0 FROM collections
+            UNION ALL
+            SELECT tree.ancestorID, collections.collectionID, tree.depth + 1
+            FROM tree
+            JOIN collections ON collections.parentCollectionID = tree.descendantID
+            WHERE tree.depth < 64
+        )
+        INSERT OR IGNORE INTO collectionClosure (ancestorID, descendantID, depth)
+        SELECT ancestorID, descendantID, depth FROM tree
+        """,
+    ]),
+    (3, [
+        # Persistent semantic search cache: cacheKey hashes the query
+        # embedding with the search parameters; rows from an older library
+        # generation are stale.
+        """
+        CREATE TABLE IF NOT EXISTS searchCache (
+            cacheKey TEXT PRIMARY KEY,
+            generation INT NOT NULL,
+            hits TEXT NOT NULL,
+            timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS searchCache_generation ON searchCache(generation)",
+    ]),
+    (4, [
+        # get_search_results pages newest-first by (timestamp, resultID), per
+        # collection or across all; prune_search_results deletes by age.
+        "CREATE INDEX IF NOT EXISTS search_results_collection_time ON search_results(collection_name, timestamp, resultID)",
+        "CREATE INDEX IF NOT EXISTS search_results_time ON search_results(timestamp, resultID)",
+    ]),
+    (5, [
+        # Zero-shot NLI logits per (chunk content hash, label, hypothesis
+        # template, model), so re-classifying only scores new pairs.
+        """
+        CREATE TABLE IF NOT EXISTS classificationScores (
+            chunkHash TEXT NOT NULL,
+            label TEXT NOT NULL,
+            template TEXT NOT NULL,
+            model TEXT NOT NULL,
+            entailLogit REAL NOT NULL,
+            contradictionLogit REAL NOT NULL,
+            timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (chunkHash, label, template, model)
+        )
+        """,
+    ]),
+    (6, [
+        # Last seen mtime, size and SHA-1 of each item's file, so sync and
+        # embedding notice edited files and re-embed them.
+        """
+        CREATE TABLE IF NOT EXISTS itemFiles (
+            itemID INTEGER PRIMARY KEY,
+            mtime REAL NOT NULL,
+            size INT NOT NULL,
+            sha1 TEXT NOT NULL
+        )
+        """,
+    ]),
+]
+
+LATEST_SCHEMA_VERSION = SCHEMA_MIGRATIONS[-1][0]
+
+# Databases already migrated by this process, so connect_db() only pays for
+# the version check once per file.
+_migrated_dbs = set()
+
+
+def get_schema_version(conn):
+    """
+    Returns the Logeny schema version recorded in the `version` table (0 if none).
+    """
+    c = conn.cursor()
+    c.execute("CREATE TABLE IF NOT EXISTS version (schema TEXT PRIMARY KEY, version INT NOT NULL)")
+    c.execute("SELECT version FROM version WHERE schema=?", (SCHEMA_NAME,))
+    row = c.fetchone()
+    return row[0] if row else 0
+
+
+def apply_schema_migrations(conn):
+    """
+    Applies every migration newer than the recorded schema version, one
+    transaction per version, and records the new version. Returns the version
+    the database is at afterwards.
+    """
+    current = get_schema_version(conn)
+    for version, statements in SCHEMA_MIGRATIONS:
+        if version <= current:
+            continue
+        c = conn.cursor()
+        try:
+            c.execute("BEGIN")
+            for stmt in statements:
+                c.execute(stmt)
+            c.execute("INSERT OR REPLACE INTO version (schema, version) VALUES (?, ?)",
+                      (SCHEMA_NAME, version))
+            conn.commit()
+        except Exception as e:
+            conn.rollback()
+            raise RuntimeError(f"Schema migration {version} failed: {e}")
+        print(f"Applied Logeny schema migration {version}.")
+        current = version
+    return current
+
+
+def connect_db(db_path):
+    """
+    sqlite3.connect() that makes sure the database is migrated to the latest
+    schema the first time this process opens it.
+    """
+    conn = sqlite3.connect(str(db_path))
+    key = os.path.abspath(str(db_path))
+    if key not in _migrated_dbs:
+        apply_schema_migrations(conn)
+        _migrated_dbs.add(key)
+    return conn
+
+
+###############################################################################
+# Logeny settings
+###############################################################################
+
+# Our own keys in Zotero's settings table live under this setting name.
+SETTINGS_NAME = "logeny"
+
+
+def get_logeny_setting(conn, key, default=None):
+    c = conn.cursor()
+    c.execute("SELECT value FROM settings WHERE setting=? AND key=?", (SETTINGS_NAME, key))
+    row = c.fetchone()
+    return row[0] if row else default
+
+
+def set_logeny_setting(conn, key, value):
+    """
+    Stores a setting; the caller commits.
+    """
+    c = conn.cursor()
+    c.execute("INSERT OR REPLACE INTO settings (setting, key, value) VALUES (?, ?, ?)",
+              (SETTINGS_NAME, key, value))
+
+###############################################################################
+# Library generation counter
+###############################################################################
+
+# Bumped by anything that changes what a search can return (sync, embedding,
+# garbage collection); caches keyed on an older generation are stale.
+# Kept in Zotero's settings table.
+GENERATION_SETTING = (SETTINGS_NAME, "library_generation")
+
+
+def get_library_generation(conn):
+    """
+    Returns the current library generation (0 if never bumped).
+    """
+    c = conn.cursor()
+    c.execute("SELECT value FROM settings WHERE setting=? AND key=?", GENERATION_SETTING)
+    row = c.fetchone()
+    return int(row[0]) if row else 0
+
+
+def bump_library_generation(conn):
+    """
+    Increments the library generation and returns the new value. Runs inside
+    the caller's transaction; the caller commits.
+    """
+    c = conn.cursor()
+    c.execute("""
+        INSERT INTO settings (setting, key, value) VALUES (?, ?, 1)
+        ON CONFLICT(setting, key) DO UPDATE SET value = value + 1
+    """, GENERATION_SETTING)
+    return get_library_generation(conn)
+
+
+###############################################################################
+# Query plan checks for the hot lookup paths
+###############################################################################
+
+def hot_queries():
+    """
+    name -> (query, sample params, index the planner is expected to use),
+    taken from the modules that run each query so the check follows them.
+    """
+    # Imported here: these modules import db_schema themselves.
+    from call_model_api import ENTITY_TAG_SQL, THREAD_LAST_MESSAGE_SQL
+    from classify_text import score_lookup_sql
+    from llm_memory_handler import NOTE_CONTENT_SQL
+    from vector_db_search import SCOPE_TAG_SQL, SEARCH_CACHE_SQL, STORE_SEARCH_RESULT_SQL
+    from zotero_integration import (COLLECTION_BY_NAME_SQL, ITEM_SNIPPETS_SQL, PRUNE_SEARCH_RESULTS_SQL,
+                                    collection_items_sql, search_results_query)
+
+    page_before = ("2100-01-01 00:00:00", 0)
+    return {
+        "item_snippets": (ITEM_SNIPPETS_SQL, (1,), "documentEmbeddings_itemID"),
+        "store_search_result": (
+            STORE_SEARCH_RESULT_SQL,
+            (0, 1, "q", "q", "context", "c", 1, "q", "c"),
+            "search_results_snippet_query",
+        ),
+        "note_content": (NOTE_CONTENT_SQL, (1,), "itemTags_itemID_category"),
+        "scope_tag_filter": (SCOPE_TAG_SQL, ("project", "p"), "itemTags_category_response"),
+        "thread_last_message": (THREAD_LAST_MESSAGE_SQL, ("t",), "itemTags_category_response"),
+        "entity_tag": (ENTITY_TAG_SQL, (1, "provider"), "entity_tags_entity_category"),
+        "collection_by_name": (COLLECTION_BY_NAME_SQL, ("c",), "collections_collectionName"),
+        "collection_subtree_items": (collection_items_sql(recursive=True), (1,),
+                                     "sqlite_autoindex_collectionClosure_1"),
+        "search_cache_by_key": (SEARCH_CACHE_SQL, ("k",), "sqlite_autoindex_searchCache_1"),
+        "search_results_page": (*search_results_query("c", 50, *page_before), "search_results_collection_time"),
+        "search_results_page_all": (*search_results_query(None, 50, *page_before), "search_results_time"),
+        "search_results_prune_age": (PRUNE_SEARCH_RESULTS_SQL, ("-30 days",), "search_results_time"),
+        "classification_scores_by_chunk": (score_lookup_sql(2), ("t", "m", "a", "b"),
+                                           "sqlite_autoindex_classificationScores_1"),
+    }
+
+
+def explain_hot_queries(db_path):
+    """
+    Runs EXPLAIN QUERY PLAN for each entry of hot_queries() and reports whether
+    the planner picked the expected index. Meant as a regression check after
+    schema or query changes:
+
+        failing = [n for n, r in explain_hot_queries(db).items() if not r["uses_index"]]
+    """
+    conn = connect_db(db_path)
+    report = {}
+    try:
+        c = conn.cursor()
+        for name, (query, params, index_name) in hot_queries().items():
+            c.execute("EXPLAIN QUERY PLAN " + query, params)
+            plan = [row[-1] for row in c.fetchall()]
+            report[name] = {
+                "plan": plan,
+                "expected_index": index_name,
+                "uses_index": any(index_name in detail for detail in plan),
+            }
+    finally:
+        conn.close()
+    return report
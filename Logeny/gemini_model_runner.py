@@ -1,19 +1,36 @@
 import google.generativeai as genai
 import os
 
+from llm_response_cache import cached_llm_call
+
 _gemini_models = {}
 
 def configure_gemini(api_key):
     genai.configure(api_key=api_key)
 
-def run_gemini_chat(model_name, prompt):
-    if model_name not in _gemini_models:
-        _gemini_models[model_name] = genai.GenerativeModel(model_name)
-    model = _gemini_models[model_name]
-    chat = model.start_chat()
-    response = chat.send_message("Please format your response in Markdown. " + prompt)
-    try:
-        output = response.candidates[0]['content'].parts[0].text.strip()
-    except Exception:
-        output = response.text.strip()
-    return output
+def run_gemini_chat(model_name, prompt, temperature=None, max_output_tokens=None, system_prompt=None):
+    # The system instruction is fixed per GenerativeModel, so models are
+    # cached per (name, system prompt).
+    model_key = (model_name, system_prompt)
+    if model_key not in _gemini_models:
+        _gemini_models[model_key] = (genai.GenerativeModel(model_name, system_instruction=system_prompt)
+                                     if system_prompt else genai.GenerativeModel(model_name))
+    model = _gemini_models[model_key]
+
+    generation_config = {}
+    if temperature is not None:
+        generation_config["temperature"] = temperature
+    if max_output_tokens is not None:
+        generation_config["max_output_tokens"] = int(max_output_tokens)
+
+    def call():
+        chat = model.start_chat()
+        kwargs = {"generation_config": generation_config} if generation_config else {}
+        response = chat.send_message("Please format your response in Markdown. " + prompt, **kwargs)
+        try:
+            return response.candidates[0]['content'].parts[0].text.strip()
+        except Exception:
+            return response.text.strip()
+
+    return cached_llm_call("google", model_name, prompt, call, temperature=temperature,
+                           max_tokens=max_output_tokens, system_prompt=system_prompt)
@@ -1,71 +1,429 @@
+from collections import OrderedDict
 import os
+import queue
+import threading
+import time
+import uuid
+import numpy as np
 import torch
 from transformers import (
-    AutoTokenizer,
-    AutoModelForCausalLM,
-    AutoModelForSequenceClassification,
-    TextStreamer,
+    StoppingCriteria,
+    StoppingCriteriaList,
+    TextIteratorStreamer,
     pipeline
 )
 
-# Caches
-_loaded_models = {}
-_loaded_pipelines = {}
+from inference_worker import call_inference_worker, inference_worker_url
+from model_registry import DEFAULT_MODEL_DTYPE, default_device, load_pretrained, model_cache_dir, registry
 
 # ---------------------------------------------------
 # Unified model caching utilities
 # ---------------------------------------------------
+# Models live in the shared registry (model_registry.py), keyed by
+# (name, type, dtype, device) and evicted least-recently-used past the RAM
+# budget. Generations pin their model with registry.using() so it cannot be
+# evicted mid-run.
 def get_model_cache_dir(model_name):
-    base_dir = os.path.join(os.path.dirname(__file__), "models")
-    model_cache_dir = os.path.join(base_dir, model_name.replace("/", "_"))
-    os.makedirs(model_cache_dir, exist_ok=True)
-    return model_cache_dir
-
-def get_tokenizer_and_model(model_name, model_type="causal-lm"):
-    if model_name in _loaded_models:
-        return _loaded_models[model_name]
-
-    cache_dir = get_model_cache_dir(model_name)
-    print(f"[INFO] Loading tokenizer and model into {cache_dir}")
-    tokenizer = AutoTokenizer.from_pretrained(model_name, cache_dir=cache_dir)
-
-    if model_type == "causal-lm":
-        model = AutoModelForCausalLM.from_pretrained(model_name, cache_dir=cache_dir)
-    elif model_type == "sequence-classification":
-        model = AutoModelForSequenceClassification.from_pretrained(model_name, cache_dir=cache_dir)
+    return model_cache_dir(model_name)
+
+def _model_key(model_name, model_type="causal-lm", dtype=None):
+    return (model_name, model_type, dtype or DEFAULT_MODEL_DTYPE, default_device())
+
+def _model_loader(key):
+    model_name, model_type, dtype, device = key
+    return lambda: load_pretrained(model_name, model_type, dtype, device)
+
+def get_tokenizer_and_model(model_name, model_type="causal-lm", dtype=None):
+    key = _model_key(model_name, model_type, dtype)
+    return registry.get(key, _model_loader(key))
+
+def using_model(model_name, model_type="causal-lm", dtype=None):
+    """Context manager yielding (tokenizer, model), pinned while in use."""
+    key = _model_key(model_name, model_type, dtype)
+    return registry.using(key, _model_loader(key))
+
+def get_pipeline(model_name, task="zero-shot-classification", dtype=None):
+    key = _model_key(model_name, "pipeline:" + task, dtype)
+
+    def load():
+        model_type = "causal-lm" if task == "text-generation" else "sequence-classification"
+        tokenizer, model = load_pretrained(model_name, model_type, key[2], key[3])
+        print(f"[INFO] Building {task} pipeline for {model_name}")
+        return pipeline(task=task, model=model, tokenizer=tokenizer,
+                        device=0 if key[3] == "cuda" else -1)
+
+    return registry.get(key, load)
+
+def set_model_ram_budget(budget_mb):
+    registry.set_budget(budget_mb)
+
+def get_model_registry_stats():
+    return registry.stats()
+
+# ---------------------------------------------------
+# Prompt-prefix KV cache (chat threads)
+# ---------------------------------------------------
+# Each chat turn's prompt repeats the previous turn's (system text, memory
+# context, earlier messages) and adds a little. We keep the past_key_values
+# of the last generation per (thread, model) and, on the next turn, crop them
+# to the longest token prefix the new prompt shares, so only the new suffix
+# is prefilled. Needs a transformers version whose caches are Cache objects
+# (crop / get_seq_length); otherwise generation just runs uncached.
+# The cached tensors are capped at PREFIX_CACHE_MAX_MB and charged to the
+# model registry's RAM budget.
+PREFIX_CACHE_MAX_ENTRIES = 4
+PREFIX_CACHE_MAX_TOKENS = 8192
+PREFIX_CACHE_MAX_MB = int(os.environ.get("LOGENY_PREFIX_CACHE_MB", "1024"))
+_prefix_caches = OrderedDict()
+_prefix_lock = threading.Lock()
+prefix_cache_stats = {"hits": 0, "misses": 0, "reused_tokens": 0, "prefilled_tokens": 0}
+
+def _shared_prefix_len(a, b):
+    n = min(len(a), len(b))
+    diff = np.flatnonzero(np.asarray(a[:n]) != np.asarray(b[:n]))
+    return int(diff[0]) if len(diff) else n
+
+def _past_bytes(past):
+    # Key and value tensors of a Cache object (older versions keep them in
+    # key_cache / value_cache lists, newer ones per layer).
+    if hasattr(past, "key_cache"):
+        tensors = list(past.key_cache) + list(past.value_cache)
     else:
-        raise ValueError(f"Unsupported model type: {model_type}")
+        tensors = [t for layer in getattr(past, "layers", []) for t in (getattr(layer, "keys", None),
+                                                                        getattr(layer, "values", None))]
+    return sum(t.numel() * t.element_size() for t in tensors if hasattr(t, "numel"))
+
+def _charge_prefix_caches():
+    # Called with _prefix_lock held. Each module instance (app.R loads this
+    # file twice) reports under its own name.
+    registry.set_external_bytes(("prefix_cache", id(_prefix_caches)),
+                                sum(e["bytes"] for e in _prefix_caches.values()))
+
+def _take_prefix_cache(cache_key, ids):
+    # Entries are taken out while in use, so two turns on one thread never
+    # share (and mutate) the same cache.
+    with _prefix_lock:
+        entry = _prefix_caches.pop(cache_key, None)
+        if entry is not None:
+            _charge_prefix_caches()
+    if entry is None:
+        return None, 0
+    # At least one prompt token must be left to run through the model.
+    shared = min(_shared_prefix_len(entry["ids"], ids), len(ids) - 1)
+    if shared <= 0:
+        return None, 0
+    entry["past"].crop(shared)
+    return entry["past"], shared
+
+def _store_prefix_cache(cache_key, ids, past):
+    if past is None or not hasattr(past, "crop") or not hasattr(past, "get_seq_length"):
+        return
+    cached = past.get_seq_length()
+    nbytes = _past_bytes(past)
+    max_bytes = PREFIX_CACHE_MAX_MB * 1024 * 1024
+    if cached > PREFIX_CACHE_MAX_TOKENS or nbytes > max_bytes:
+        return
+    with _prefix_lock:
+        _prefix_caches[cache_key] = {"ids": ids[:cached], "past": past, "bytes": nbytes}
+        _prefix_caches.move_to_end(cache_key)
+        while len(_prefix_caches) > PREFIX_CACHE_MAX_ENTRIES or \
+                sum(e["bytes"] for e in _prefix_caches.values()) > max_bytes:
+            _prefix_caches.popitem(last=False)
+        _charge_prefix_caches()
+
+def clear_prefix_cache(thread_id=None):
+    """Drops the cached prefixes of one chat thread, or all of them."""
+    with _prefix_lock:
+        for cache_key in list(_prefix_caches):
+            if thread_id is None or cache_key[0] == thread_id:
+                del _prefix_caches[cache_key]
+        _charge_prefix_caches()
+
+def generate_with_prefix_cache(model, input_ids, cache_key=None, draft_model=None, **generate_kwargs):
+    """
+    model.generate() for a single prompt, reusing the KV cache of the
+    longest shared token prefix stored under cache_key (and storing this
+    generation's cache for the next call). With draft_model, decoding is
+    assisted by it (see below). Returns the output sequences.
+    """
+    ids = input_ids[0].tolist()
+    past, shared = _take_prefix_cache(cache_key, ids) if cache_key is not None else (None, 0)
+    if past is not None:
+        generate_kwargs["past_key_values"] = past
+    with _prefix_lock:
+        prefix_cache_stats["hits" if past is not None else "misses"] += 1
+        prefix_cache_stats["reused_tokens"] += shared
+        prefix_cache_stats["prefilled_tokens"] += len(ids) - shared
+    attention_mask = torch.ones_like(input_ids)
+    with torch.no_grad(), _AssistedRun(model, draft_model, len(ids)) as run:
+        if draft_model is not None:
+            generate_kwargs["assistant_model"] = draft_model
+        output = model.generate(input_ids, attention_mask=attention_mask, use_cache=True,
+                                return_dict_in_generate=True, **generate_kwargs)
+        run.sequences = output.sequences
+    if cache_key is not None:
+        _store_prefix_cache(cache_key, output.sequences[0].tolist(), getattr(output, "past_key_values", None))
+    return output.sequences
+
+# ---------------------------------------------------
+# Assisted (speculative) decoding
+# ---------------------------------------------------
+# A small draft model from the same tokenizer family proposes a few tokens,
+# which the target model verifies in one forward pass; accepted tokens cost
+# no extra target pass, and the output distribution is the target's. Set per
+# model entity with an entity_tags row (tagCategory 'draft_model').
+#
+# Acceptance is estimated by counting forward passes: every target pass
+# yields one token of its own, so accepted = new tokens - target passes, out
+# of one proposal per draft pass. The models are shared between threads,
+# so a run's hooks only count passes made on its own thread.
+assisted_stats = {"generations": 0, "new_tokens": 0, "target_passes": 0, "draft_passes": 0, "seconds": 0.0}
+
+# The _AssistedRun generating on this thread, if any.
+_assisted_local = threading.local()
+
+class _AssistedRun:
+    def __init__(self, model, draft_model, prompt_len):
+        self.models = [model, draft_model] if draft_model is not None else []
+        self.prompt_len = prompt_len
+        self.passes = [0, 0]
+        self.sequences = None
+
+    def _count_pass(self, n):
+        if getattr(_assisted_local, "run", None) is self:
+            self.passes[n] += 1
+
+    def __enter__(self):
+        self.outer = getattr(_assisted_local, "run", None)
+        _assisted_local.run = self
+        self.handles = [
+            m.register_forward_hook(lambda *args, n=n: self._count_pass(n))
+            for n, m in enumerate(self.models)
+        ]
+        self.started = time.perf_counter()
+        return self
 
-    model.eval()
-    _loaded_models[model_name] = (tokenizer, model)
-    return tokenizer, model
+    def __exit__(self, *exc):
+        for handle in self.handles:
+            handle.remove()
+        _assisted_local.run = self.outer
+        if not self.models or self.sequences is None:
+            return False
+        elapsed = time.perf_counter() - self.started
+        new_tokens = int(self.sequences.shape[1]) - self.prompt_len
+        with _prefix_lock:
+            assisted_stats["generations"] += 1
+            assisted_stats["new_tokens"] += new_tokens
+            assisted_stats["target_passes"] += self.passes[0]
+            assisted_stats["draft_passes"] += self.passes[1]
+            assisted_stats["seconds"] += elapsed
+        accepted = max(new_tokens - self.passes[0], 0)
+        rate = accepted / self.passes[1] if self.passes[1] else 0.0
+        print(f"[INFO] Assisted decoding: {new_tokens / elapsed if elapsed else 0:.1f} tokens/s, "
+              f"{rate:.0%} of draft tokens accepted")
+        return False
 
-def get_pipeline(model_name, task="zero-shot-classification"):
-    if model_name in _loaded_pipelines:
-        return _loaded_pipelines[model_name]
+def get_assisted_stats():
+    stats = dict(assisted_stats)
+    accepted = max(stats["new_tokens"] - stats["target_passes"], 0)
+    stats["acceptance_rate"] = accepted / stats["draft_passes"] if stats["draft_passes"] else 0.0
+    stats["tokens_per_s"] = stats["new_tokens"] / stats["seconds"] if stats["seconds"] else 0.0
+    return stats
 
-    cache_dir = get_model_cache_dir(model_name)
-    print(f"[INFO] Loading pipeline for {model_name} with task {task} from {cache_dir}")
-    pipe = pipeline(task=task, model=model_name, tokenizer=model_name, cache_dir=cache_dir)
-    _loaded_pipelines[model_name] = pipe
-    return pipe
+def _acquire_draft(draft_model, dtype, tokenizer):
+    """
+    Pins the draft model in the registry and returns (key, model), or
+    (None, None) when there is no draft or its vocabulary differs from the
+    target's.
+    """
+    if not draft_model:
+        return None, None
+    key = _model_key(draft_model, dtype=dtype)
+    draft_tokenizer, model = registry.acquire(key, _model_loader(key))
+    if len(draft_tokenizer) != len(tokenizer):
+        registry.release(key)
+        print(f"[INFO] Draft model {draft_model} does not share the target's tokenizer; decoding unassisted")
+        return None, None
+    return key, model
 
 # ---------------------------------------------------
 # Streaming Generation (True Streaming)
 # ---------------------------------------------------
-def stream_response(prompt, model_name, max_new_tokens=256):
-    tokenizer, model = get_tokenizer_and_model(model_name, model_type="causal-lm")
-    input_ids = tokenizer.encode(prompt, return_tensors="pt").to(model.device)
+# Generation runs in a background thread feeding a TextIteratorStreamer; a
+# second thread drains it into a queue so callers (app.R via reticulate) can
+# poll for text deltas without blocking. Streams are kept by id until their
+# last delta has been polled, or until nobody has polled them for
+# STREAM_IDLE_TIMEOUT_S (a closed browser tab): then generation stops and
+# the stream is dropped.
+STREAM_IDLE_TIMEOUT_S = float(os.environ.get("LOGENY_STREAM_IDLE_S", "120"))
+_streams = {}
+_streams_lock = threading.Lock()
 
-    streamer = TextStreamer(tokenizer, skip_prompt=True, skip_special_tokens=True)
+class _CancelCriteria(StoppingCriteria):
+    def __init__(self, state):
+        self.state = state
 
-    with torch.no_grad():
-        model.generate(
-            input_ids=input_ids,
-            max_new_tokens=max_new_tokens,
-            streamer=streamer,
-            do_sample=True
-        )
+    def __call__(self, input_ids, scores, **kwargs):
+        if time.monotonic() - self.state["polled"] > STREAM_IDLE_TIMEOUT_S:
+            self.state["cancel"].set()
+        return self.state["cancel"].is_set()
+
+def _expire_idle_streams():
+    now = time.monotonic()
+    with _streams_lock:
+        idle = [sid for sid, state in _streams.items() if now - state["polled"] > STREAM_IDLE_TIMEOUT_S]
+        for stream_id in idle:
+            _streams.pop(stream_id)["cancel"].set()
+    if idle:
+        print(f"[INFO] Dropped {len(idle)} stream(s) not polled for {STREAM_IDLE_TIMEOUT_S:.0f}s")
+
+def prompt_token_count(prompt, model_name):
+    if inference_worker_url():
+        return call_inference_worker("tokens", prompt=prompt, model=model_name)
+    tokenizer, _ = get_tokenizer_and_model(model_name, model_type="causal-lm")
+    return len(tokenizer.encode(prompt))
+
+def start_stream(prompt, model_name, max_new_tokens=256, do_sample=True, dtype=None, thread_id=None,
+                 draft_model=None):
+    """
+    Starts generating in the background and returns a stream id for
+    poll_stream() / cancel_stream(). With thread_id, the KV cache of the
+    thread's previous turn is reused for the shared prompt prefix; with
+    draft_model, decoding is assisted by that smaller model.
+    """
+    if inference_worker_url():
+        return call_inference_worker("stream_start", prompt=prompt, model=model_name, max_new_tokens=max_new_tokens,
+                                     do_sample=do_sample, dtype=dtype, thread_id=thread_id, draft_model=draft_model)
+    _expire_idle_streams()
+    key = _model_key(model_name, dtype=dtype)
+    tokenizer, model = registry.acquire(key, _model_loader(key))
+    draft_key, draft = _acquire_draft(draft_model, dtype, tokenizer)
+    input_ids = tokenizer(prompt, return_tensors="pt")["input_ids"].to(model.device)
+    cache_key = (thread_id, key) if thread_id is not None else None
+    streamer = TextIteratorStreamer(tokenizer, skip_prompt=True, skip_special_tokens=True)
+    state = {
+        "queue": queue.Queue(),
+        "cancel": threading.Event(),
+        "started": time.perf_counter(),
+        "polled": time.monotonic(),
+        "ttft_s": None,
+        "chunks": 0,
+        "error": None,
+        "done": False,
+    }
+
+    def generate():
+        try:
+            generate_with_prefix_cache(
+                model,
+                input_ids,
+                cache_key,
+                draft,
+                max_new_tokens=max_new_tokens,
+                streamer=streamer,
+                do_sample=do_sample,
+                stopping_criteria=StoppingCriteriaList([_CancelCriteria(state)])
+            )
+        except Exception as e:
+            state["error"] = str(e)
+            streamer.end()
+        finally:
+            registry.release(key)
+            if draft_key is not None:
+                registry.release(draft_key)
+
+    def drain():
+        for delta in streamer:
+            if not delta:
+                continue
+            if state["ttft_s"] is None:
+                state["ttft_s"] = time.perf_counter() - state["started"]
+            state["chunks"] += 1
+            state["queue"].put(delta)
+        state["queue"].put(None)
+
+    stream_id = uuid.uuid4().hex
+    with _streams_lock:
+        _streams[stream_id] = state
+    threading.Thread(target=generate, daemon=True).start()
+    threading.Thread(target=drain, daemon=True).start()
+    return stream_id
+
+def poll_stream(stream_id, wait_s=0.05):
+    """
+    Text generated since the last poll. Waits up to wait_s for the first
+    delta (letting the generation thread run meanwhile), then takes whatever
+    else is queued. Returns {text, done, cancelled, error, ttft_s, elapsed_s};
+    once done is True the stream is forgotten.
+    """
+    if inference_worker_url():
+        return call_inference_worker("stream_poll", stream_id=stream_id, wait_s=wait_s)
+    with _streams_lock:
+        state = _streams.get(stream_id)
+    if state is None:
+        raise ValueError(f"Unknown stream: {stream_id}")
+    state["polled"] = time.monotonic()
+
+    parts = []
+    try:
+        item = state["queue"].get(timeout=wait_s)
+        while True:
+            if item is None:
+                state["done"] = True
+                break
+            parts.append(item)
+            item = state["queue"].get_nowait()
+    except queue.Empty:
+        pass
+
+    elapsed = time.perf_counter() - state["started"]
+    if state["done"]:
+        with _streams_lock:
+            _streams.pop(stream_id, None)
+        ttft = f"{state['ttft_s']:.2f}s" if state["ttft_s"] is not None else "n/a"
+        print(f"[INFO] Stream {stream_id[:8]} finished: first token after {ttft}, "
+              f"{state['chunks']} deltas in {elapsed:.2f}s")
+    return {
+        "text": "".join(parts),
+        "done": state["done"],
+        "cancelled": state["cancel"].is_set(),
+        "error": state["error"],
+        "ttft_s": state["ttft_s"],
+        "elapsed_s": elapsed,
+    }
+
+def cancel_stream(stream_id):
+    """
+    Stops the stream after the current token and forgets it; don't poll it
+    afterwards. False if unknown.
+    """
+    if inference_worker_url():
+        return call_inference_worker("stream_cancel", stream_id=stream_id)
+    with _streams_lock:
+        state = _streams.pop(stream_id, None)
+    if state is None:
+        return False
+    state["cancel"].set()
+    return True
+
+def stream_response(prompt, model_name, max_new_tokens=256):
+    """
+    Generator over text deltas as they are generated. Closing it early
+    cancels the generation.
+    """
+    stream_id = start_stream(prompt, model_name, max_new_tokens)
+    done = False
+    try:
+        while not done:
+            polled = poll_stream(stream_id, wait_s=0.1)
+            done = polled["done"]
+            if polled["text"]:
+                yield polled["text"]
+        if polled["error"]:
+            raise RuntimeError(polled["error"])
+    finally:
+        if not done:
+            cancel_stream(stream_id)
 
 # ---------------------------------------------------
 # Map-Reduce Generation
@@ -74,14 +432,70 @@ def split_into_chunks(text, max_tokens, tokenizer):
     tokens = tokenizer.encode(text)
     return [tokens[i:i + max_tokens] for i in range(0, len(tokens), max_tokens)]
 
-def generate_responses_from_chunks(chunks, tokenizer, model, max_tokens=256):
-    responses = []
-    for chunk in chunks:
-        input_ids = torch.tensor([chunk]).to(model.device)
-        with torch.no_grad():
-            output = model.generate(input_ids, max_new_tokens=max_tokens, do_sample=True)
-        decoded = tokenizer.decode(output[0], skip_special_tokens=True)
-        responses.append(decoded)
+# Chunks per generate() call in the map step, and a cap on batch_size x
+# longest chunk so long chunks get smaller batches. A batch that runs out of
+# memory is retried in halves.
+GENERATION_BATCH_SIZE = 8
+GENERATION_BATCH_TOKENS = 16384
+
+def _is_oom(error):
+    if isinstance(error, MemoryError):
+        return True
+    oom_type = getattr(torch.cuda, "OutOfMemoryError", None)
+    if oom_type is not None and isinstance(error, oom_type):
+        return True
+    return isinstance(error, RuntimeError) and "out of memory" in str(error).lower()
+
+def _left_padded_batch(chunks, pad_id, device):
+    # Decoder-only models continue from the last position, so pad on the left.
+    longest = max(len(chunk) for chunk in chunks)
+    input_ids = torch.full((len(chunks), longest), pad_id, dtype=torch.long)
+    attention_mask = torch.zeros((len(chunks), longest), dtype=torch.long)
+    for row, chunk in enumerate(chunks):
+        if chunk:
+            input_ids[row, longest - len(chunk):] = torch.tensor(chunk, dtype=torch.long)
+            attention_mask[row, longest - len(chunk):] = 1
+    return input_ids.to(device), attention_mask.to(device)
+
+def _generate_batch(chunks, tokenizer, model, max_tokens, new_tokens_only=False):
+    pad_id = tokenizer.pad_token_id if tokenizer.pad_token_id is not None else tokenizer.eos_token_id
+    input_ids, attention_mask = _left_padded_batch(chunks, pad_id, model.device)
+    with torch.no_grad():
+        output = model.generate(input_ids, attention_mask=attention_mask, max_new_tokens=max_tokens,
+                                do_sample=True, pad_token_id=pad_id)
+    if new_tokens_only:
+        # Every row shares the padded prompt length, so new tokens start there.
+        output = output[:, input_ids.shape[1]:]
+    return [tokenizer.decode(row, skip_special_tokens=True) for row in output]
+
+def generate_responses_from_chunks(chunks, tokenizer, model, max_tokens=256, batch_size=GENERATION_BATCH_SIZE,
+                                   new_tokens_only=False):
+    """
+    Generates one response per token chunk, several chunks per generate()
+    call. Chunks are grouped by length to keep padding low; results come
+    back in input order. new_tokens_only=True leaves the prompt out of the
+    decoded text.
+    """
+    responses = [None] * len(chunks)
+    order = sorted(range(len(chunks)), key=lambda i: len(chunks[i]))
+    start = 0
+    while start < len(order):
+        longest = len(chunks[order[min(start + batch_size, len(order)) - 1]]) + max_tokens
+        size = max(1, min(batch_size, GENERATION_BATCH_TOKENS // max(longest, 1)))
+        batch = order[start:start + size]
+        try:
+            decoded = _generate_batch([chunks[i] for i in batch], tokenizer, model, max_tokens, new_tokens_only)
+        except Exception as e:
+            if not _is_oom(e) or len(batch) == 1:
+                raise
+            batch_size = max(1, len(batch) // 2)
+            print(f"[INFO] Out of memory generating {len(batch)} chunks; retrying with batch size {batch_size}")
+            if torch.cuda.is_available():
+                torch.cuda.empty_cache()
+            continue
+        for i, text in zip(batch, decoded):
+            responses[i] = text
+        start += len(batch)
     return responses
 
 def clean_response(response, prompt):
@@ -96,19 +510,140 @@ def clean_response(response, prompt):
     ]
     return '\n'.join(cleaned_lines)
 
-def generate_map_reduce_response(prompt, model_name, context_window=2048):
-    tokenizer, model = get_tokenizer_and_model(model_name, model_type="causal-lm")
-    max_input_tokens = context_window - 256
-    chunks = split_into_chunks(prompt, max_input_tokens, tokenizer)
-    partial_responses = generate_responses_from_chunks(chunks, tokenizer, model)
+REDUCE_PROMPT = "Summarize the following:\n"
+REDUCE_SEPARATOR = "\n\n"
+
+def _pack_reduce_groups(part_ids, sep_len, budget):
+    # Greedily packs consecutive partial outputs into groups that fit the
+    # budget. A part that fits with neither neighbour is left in a group of
+    # its own.
+    groups = []
+    current, used = [], 0
+    for n, ids in enumerate(part_ids):
+        cost = len(ids) + (sep_len if current else 0)
+        if current and used + cost > budget:
+            groups.append(current)
+            current, used = [], 0
+            cost = len(ids)
+        current.append(n)
+        used += cost
+    if current:
+        groups.append(current)
+    return groups
 
-    if len(partial_responses) == 1:
-        return clean_response(partial_responses[0], prompt)
+def generate_map_reduce_response(prompt, model_name, context_window=2048, batch_size=GENERATION_BATCH_SIZE,
+                                 max_new_tokens=256, dtype=None, thread_id=None, draft_model=None):
+    """
+    Map: the prompt is cut into chunks of context_window - max_new_tokens
+    tokens and each is generated from (batched). Reduce: partial outputs are
+    packed into as few "Summarize the following" prompts as fit the same
+    budget and generated from again, level by level, until they fit one
+    prompt; that last generation is the answer. A part left without a
+    partner moves up a level unchanged, and a prompt that would still
+    exceed the budget is map-reduced on its own, so no text is cut off. The number of generate()
+    passes grows with the log of the input length. Only newly generated
+    tokens are decoded, so no prompt text is echoed.
 
-    summary_prompt = "Summarize the following:\n" + "\n\n".join(partial_responses)
-    summary_chunks = split_into_chunks(summary_prompt, max_input_tokens, tokenizer)
-    summary_responses = generate_responses_from_chunks(summary_chunks, tokenizer, model)
-    return clean_response("\n\n".join(summary_responses), prompt)
+    A prompt that fits in one chunk is generated directly; with thread_id,
+    that reuses the KV cache of the thread's previous turn (see
+    generate_with_prefix_cache), and with draft_model it is decoded with
+    assistance (batched map steps are not).
+
+    With LOGENY_INFERENCE_URL set, the shared inference worker generates
+    instead (see inference_worker.py).
+    """
+    if inference_worker_url():
+        return call_inference_worker("generate", prompt=prompt, model=model_name, context_window=context_window,
+                                     max_new_tokens=max_new_tokens, dtype=dtype, thread_id=thread_id,
+                                     draft_model=draft_model)
+    cache_key = (thread_id, _model_key(model_name, dtype=dtype)) if thread_id is not None else None
+    with using_model(model_name, dtype=dtype) as (tokenizer, model):
+        draft_key, draft = _acquire_draft(draft_model, dtype, tokenizer)
+        try:
+            return _map_reduce(prompt, tokenizer, model, context_window, batch_size, max_new_tokens,
+                               cache_key, draft)
+        finally:
+            if draft_key is not None:
+                registry.release(draft_key)
+
+def _map_reduce(prompt, tokenizer, model, context_window, batch_size, max_new_tokens, cache_key=None,
+                draft=None):
+    budget = context_window - max_new_tokens
+    prefix_ids = tokenizer.encode(REDUCE_PROMPT)
+    sep_len = len(tokenizer.encode(REDUCE_SEPARATOR, add_special_tokens=False))
+    if budget - len(prefix_ids) < 2 * max_new_tokens + sep_len:
+        raise ValueError(f"context_window {context_window} is too small to reduce outputs of {max_new_tokens} tokens.")
+
+    def generate(chunk_ids):
+        outputs = generate_responses_from_chunks(chunk_ids, tokenizer, model, max_tokens=max_new_tokens,
+                                                 batch_size=batch_size, new_tokens_only=True)
+        stats["generations"] += len(chunk_ids)
+        stats["tokens_in"] += sum(len(ids) for ids in chunk_ids)
+        return [text.strip() for text in outputs]
+
+    stats = {"levels": 0, "generations": 0, "tokens_in": 0}
+    chunks = split_into_chunks(prompt, budget, tokenizer)
+    if len(chunks) == 1 and (cache_key is not None or draft is not None):
+        pad_id = tokenizer.pad_token_id if tokenizer.pad_token_id is not None else tokenizer.eos_token_id
+        sequences = generate_with_prefix_cache(model, torch.tensor([chunks[0]]).to(model.device), cache_key, draft,
+                                               max_new_tokens=max_new_tokens, do_sample=True, pad_token_id=pad_id)
+        return tokenizer.decode(sequences[0][len(chunks[0]):], skip_special_tokens=True).strip()
+    parts = generate(chunks)
+    while len(parts) > 1:
+        stats["levels"] += 1
+        part_ids = [tokenizer.encode(part, add_special_tokens=False) for part in parts]
+        combined = sum(len(ids) for ids in part_ids) + sep_len * (len(parts) - 1) + len(prefix_ids)
+        if combined <= budget:
+            groups = [list(range(len(parts)))]
+        else:
+            groups = _pack_reduce_groups(part_ids, sep_len, budget - len(prefix_ids))
+        print(f"[INFO] Reduce level {stats['levels']}: {len(parts)} parts, {combined} tokens -> {len(groups)} prompts")
+        # Lone parts wait for the next level, unless no two parts fit
+        # together at all; then each is summarized on its own.
+        carry = len(groups) < len(parts)
+        next_parts = [None] * len(groups)
+        reduce_ids, reduced = [], []
+        for g, group in enumerate(groups):
+            if carry and len(group) == 1:
+                next_parts[g] = parts[group[0]]
+                continue
+            text = REDUCE_SEPARATOR.join(parts[n] for n in group)
+            ids = tokenizer.encode(REDUCE_PROMPT + text)
+            if len(ids) > budget:
+                next_parts[g] = _map_reduce(text, tokenizer, model, context_window, batch_size, max_new_tokens)
+                continue
+            reduce_ids.append(ids)
+            reduced.append(g)
+        if reduce_ids:
+            for g, text in zip(reduced, generate(reduce_ids)):
+                next_parts[g] = text
+        parts = next_parts
+    print(f"[INFO] Map-reduce: {len(chunks)} chunks, {stats['levels']} reduce levels, "
+          f"{stats['generations']} generations, {stats['tokens_in']} prompt tokens")
+    return parts[0] if parts else ""
+
+def generate_responses(prompts, model_name, context_window=2048, max_new_tokens=256,
+                       batch_size=GENERATION_BATCH_SIZE, dtype=None):
+    """
+    One generate_map_reduce_response() answer per prompt, with every prompt
+    that fits one chunk generated in the same batches. The inference worker
+    uses it to batch requests from different sessions.
+    """
+    budget = context_window - max_new_tokens
+    with using_model(model_name, dtype=dtype) as (tokenizer, model):
+        prompt_ids = [tokenizer.encode(prompt) for prompt in prompts]
+        short = [n for n, ids in enumerate(prompt_ids) if len(ids) <= budget]
+        responses = [None] * len(prompts)
+        if short:
+            outputs = generate_responses_from_chunks([prompt_ids[n] for n in short], tokenizer, model,
+                                                     max_tokens=max_new_tokens, batch_size=batch_size,
+                                                     new_tokens_only=True)
+            for n, text in zip(short, outputs):
+                responses[n] = text.strip()
+        for n, response in enumerate(responses):
+            if response is None:
+                responses[n] = _map_reduce(prompts[n], tokenizer, model, context_window, batch_size, max_new_tokens)
+    return responses
 
 # ---------------------------------------------------
 # Classification (Zero-Shot)
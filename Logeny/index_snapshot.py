@@ -0,0 +1,298 @@
+import datetime
+import json
+import os
+import shutil
+import struct
+from pathlib import Path
+
+import numpy as np
+
+from db_schema import bump_library_generation, connect_db
+from vector_store import (DEFAULT_EMBEDDING_MODEL, HNSWIndex, VectorStore, _open_stores, _row_norms,
+                          get_snapshot_store_dir, load_snapshot_store, load_vector_store)
+from zotero_integration import _file_sha1
+
+###############################################################################
+# Snapshot file format
+###############################################################################
+
+# One file holding everything a client needs to search a library without
+# embedding it:
+#
+#   preamble  8s magic | u32 format version | u32 reserved | u64 header length
+#   header    UTF-8 JSON: model, dims, item map, array table
+#   arrays    raw little-endian arrays, each starting on a SNAPSHOT_ALIGN
+#             boundary so they can be memory-mapped in place
+#
+# Arrays: vectors float32 (N, dim), norms float32 (N,), graph int32 (N, M),
+# chunks int64 (N, 5) = (item index, chunkIndex, chunkStart, chunkEnd,
+# chunkSize). "item index" points into header["items"], which identifies
+# files by path relative to the synced folder plus size and SHA-1.
+
+SNAPSHOT_MAGIC = b"LGNYSNAP"
+SNAPSHOT_FORMAT_VERSION = 1
+SNAPSHOT_ALIGN = 64
+_PREAMBLE = struct.Struct("<8sIIQ")
+
+
+def _aligned(n):
+    return (n + SNAPSHOT_ALIGN - 1) // SNAPSHOT_ALIGN * SNAPSHOT_ALIGN
+
+
+def write_snapshot(path, header, arrays):
+    """
+    Writes `arrays` (name -> ndarray) after the JSON `header` into one file,
+    atomically.
+    """
+    table = {}
+    offset = 0
+    for name, arr in arrays.items():
+        arr = np.ascontiguousarray(arr)
+        arrays[name] = arr
+        table[name] = {"dtype": arr.dtype.str, "shape": list(arr.shape), "offset": offset}
+        offset = _aligned(offset + arr.nbytes)
+    header = dict(header, arrays=table)
+    header_bytes = json.dumps(header).encode("utf-8")
+    data_start = _aligned(_PREAMBLE.size + len(header_bytes))
+
+    tmp_path = str(path) + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(_PREAMBLE.pack(SNAPSHOT_MAGIC, SNAPSHOT_FORMAT_VERSION, 0, len(header_bytes)))
+        f.write(header_bytes)
+        for name, arr in arrays.items():
+            f.seek(data_start + table[name]["offset"])
+            f.write(arr.tobytes())
+    os.replace(tmp_path, path)
+
+
+def read_snapshot_header(path):
+    """
+    Returns (header, data_start) for a snapshot file; ValueError if it is not
+    one this version can read.
+    """
+    with open(path, "rb") as f:
+        preamble = f.read(_PREAMBLE.size)
+        if len(preamble) < _PREAMBLE.size:
+            raise ValueError(f"{path} is not a Logeny index snapshot.")
+        magic, version, _, header_len = _PREAMBLE.unpack(preamble)
+        if magic != SNAPSHOT_MAGIC:
+            raise ValueError(f"{path} is not a Logeny index snapshot.")
+        if version != SNAPSHOT_FORMAT_VERSION:
+            raise ValueError(f"Unsupported snapshot format {version} in {path}.")
+        header = json.loads(f.read(header_len).decode("utf-8"))
+    return header, _aligned(_PREAMBLE.size + header_len)
+
+
+def open_snapshot_arrays(path):
+    """
+    Returns (header, {name: read-only memmap}) for a snapshot file.
+    """
+    header, data_start = read_snapshot_header(path)
+    arrays = {}
+    for name, spec in header["arrays"].items():
+        shape = tuple(spec["shape"])
+        if 0 in shape:
+            arrays[name] = np.zeros(shape, dtype=spec["dtype"])
+        else:
+            arrays[name] = np.memmap(path, dtype=spec["dtype"], mode="r",
+                                     offset=data_start + spec["offset"], shape=shape)
+    return header, arrays
+
+
+def _items_under_root(c, root):
+    """
+    {relative posix path: itemID} for every item whose file lives under root.
+    """
+    mapping = {}
+    c.execute("SELECT itemID, key FROM items WHERE itemTypeID!=14")
+    for item_id, key in c.fetchall():
+        if not key or not os.path.isabs(key):
+            continue
+        path = Path(key).resolve()
+        if root in path.parents:
+            mapping[path.relative_to(root).as_posix()] = item_id
+    return mapping
+
+###############################################################################
+# Export (admin)
+###############################################################################
+
+def export_index_snapshot(db_path, folder_path, snapshot_path, model_name=DEFAULT_EMBEDDING_MODEL):
+    """
+    Writes every live vector for `model_name` whose file lives under
+    folder_path into one snapshot file, typically next to the documents on
+    the shared drive (name it *.lgsnap; folder sync skips those). Run after
+    generate_document_embeddings.
+    """
+    root = Path(folder_path).resolve()
+    segments = [load_vector_store(db_path, model_name), load_snapshot_store(db_path, model_name)]
+    segments = [s for s in segments if s is not None and s.size and s.index is not None]
+
+    conn = connect_db(db_path)
+    try:
+        c = conn.cursor()
+        rel_by_item = {item_id: rel for rel, item_id in _items_under_root(c, root).items()}
+        c.execute("""
+            SELECT snippetID, chunkStart, chunkEnd, chunkSize
+            FROM documentEmbeddings WHERE embeddingModel = ?
+        """, (model_name,))
+        offsets = {r[0]: r[1:] for r in c.fetchall()}
+    finally:
+        conn.close()
+
+    items = []
+    item_index = {}
+    vectors = []
+    chunks = []
+    reuse_graph = len(segments) == 1
+    for store in segments:
+        keep = np.zeros(store.size, dtype=bool)
+        for r in np.flatnonzero(store.alive):
+            s_id, i_id, chunk_idx = (int(x) for x in store.rows[r])
+            rel = rel_by_item.get(i_id)
+            if rel is None or s_id not in offsets or not os.path.exists(root / rel):
+                continue
+            if rel not in item_index:
+                file_path = root / rel
+                item_index[rel] = len(items)
+                items.append({"path": rel, "size": os.path.getsize(file_path), "sha1": _file_sha1(file_path)})
+            chunk_start, chunk_end, chunk_size = offsets[s_id]
+            chunks.append((item_index[rel], chunk_idx, chunk_start, chunk_end, chunk_size))
+            keep[r] = True
+        vectors.append(np.asarray(store.index.vectors[keep], dtype=np.float32))
+        reuse_graph = reuse_graph and keep.all()
+
+    if not chunks:
+        raise RuntimeError(f"No embeddings for '{model_name}' under {root} to export.")
+    vectors = np.vstack(vectors)
+
+    if reuse_graph:
+        graph = np.asarray(segments[0].index.graph, dtype=np.int32)
+    else:
+        # Rows were dropped or merged, so graph positions moved; rebuild.
+        index = HNSWIndex(vectors.shape[1], M=segments[0].M)
+        index.add_items(vectors, list(range(len(vectors))))
+        graph = index.graph
+
+    header = {
+        "format_version": SNAPSHOT_FORMAT_VERSION,
+        "model_name": model_name,
+        "dim": int(vectors.shape[1]),
+        "M": int(graph.shape[1]),
+        "rows": len(chunks),
+        "created": datetime.datetime.now().isoformat(timespec="seconds"),
+        "items": items,
+    }
+    write_snapshot(snapshot_path, header, {
+        "vectors": vectors,
+        "norms": _row_norms(vectors),
+        "graph": graph,
+        "chunks": np.asarray(chunks, dtype=np.int64),
+    })
+    print(f"Exported {len(chunks)} vectors for {len(items)} files to {snapshot_path}.")
+    return {"rows": len(chunks), "items": len(items)}
+
+###############################################################################
+# Import (clients)
+###############################################################################
+
+def _drop_snapshot_segment(conn, db_path, model_name):
+    # Forget the previously imported snapshot's rows so a re-import doesn't
+    # leave duplicates behind. Its files are replaced by the new segment
+    # once that is committed.
+    store = load_snapshot_store(db_path, model_name)
+    if store is None:
+        return
+    c = conn.cursor()
+    snippet_ids = [(int(s),) for s in store.snippet_ids[store.alive]]
+    c.executemany("DELETE FROM search_results WHERE snippetID = ?", snippet_ids)
+    c.executemany("DELETE FROM documentEmbeddings WHERE snippetID = ?", snippet_ids)
+    _open_stores.pop(store.store_dir, None)
+
+
+def import_index_snapshot(snapshot_path, db_path, folder_path):
+    """
+    Attaches a snapshot written by export_index_snapshot to this database.
+    Run sync_folder_with_db first so the files exist as items.
+
+    Files whose size and SHA-1 still match get documentEmbeddings rows that
+    point into the snapshot, which is memory-mapped read-only from where it
+    lies rather than copied. Changed or new files, and files this database
+    has already embedded with the same model, are left for
+    generate_document_embeddings, which only embeds items that have no
+    embeddings yet.
+    """
+    snapshot_path = os.path.abspath(snapshot_path)
+    header, arrays = open_snapshot_arrays(snapshot_path)
+    model_name = header["model_name"]
+    chunks = np.asarray(arrays["chunks"])
+    root = Path(folder_path).resolve()
+    stats = {"items_matched": 0, "items_changed": 0, "items_missing": 0, "items_local": 0, "rows": 0}
+    # The segment is written next to its final place and moved there once the
+    # rows pointing into it are committed, so a failed commit leaves no
+    # segment without rows.
+    store_dir = get_snapshot_store_dir(db_path, model_name)
+    staging_dir = store_dir + ".importing"
+    shutil.rmtree(staging_dir, ignore_errors=True)
+
+    conn = connect_db(db_path)
+    try:
+        c = conn.cursor()
+        _drop_snapshot_segment(conn, db_path, model_name)
+        local_items = _items_under_root(c, root)
+        c.execute("SELECT DISTINCT itemID FROM documentEmbeddings WHERE embeddingModel = ?", (model_name,))
+        embedded = {r[0] for r in c.fetchall()}
+
+        # Snapshot item index -> local itemID, for files that are unchanged.
+        matched = {}
+        for idx, entry in enumerate(header["items"]):
+            item_id = local_items.get(entry["path"])
+            file_path = root / entry["path"]
+            if item_id is None or not file_path.exists():
+                stats["items_missing"] += 1
+            elif item_id in embedded:
+                stats["items_local"] += 1
+            elif os.path.getsize(file_path) != entry["size"] or _file_sha1(file_path) != entry["sha1"]:
+                stats["items_changed"] += 1
+            else:
+                matched[idx] = item_id
+                stats["items_matched"] += 1
+
+        rows = np.zeros((len(chunks), 3), dtype=np.int64)
+        alive = np.zeros(len(chunks), dtype=bool)
+        for r, (item_idx, chunk_idx, chunk_start, chunk_end, chunk_size) in enumerate(chunks.tolist()):
+            item_id = matched.get(item_idx)
+            if item_id is None:
+                continue
+            c.execute("""
+                INSERT INTO documentEmbeddings
+                  (itemID, chunkIndex, chunkStart, chunkEnd, embeddingModel, chunkSize)
+                VALUES (?,?,?,?,?,?)
+            """, (item_id, chunk_idx, chunk_start, chunk_end, model_name, chunk_size))
+            rows[r] = (c.lastrowid, item_id, chunk_idx)
+            alive[r] = True
+        stats["rows"] = int(alive.sum())
+
+        store = VectorStore(staging_dir, model_name, M=header["M"])
+        store.snapshot_path = snapshot_path
+        store.rows = rows
+        store.alive = alive
+        store.index = HNSWIndex.from_arrays(arrays["vectors"], arrays["graph"], norms=arrays["norms"])
+        store.save()
+
+        bump_library_generation(conn)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        shutil.rmtree(staging_dir, ignore_errors=True)
+        raise
+    finally:
+        conn.close()
+
+    shutil.rmtree(store_dir, ignore_errors=True)
+    os.replace(staging_dir, store_dir)
+    store.store_dir = store_dir
+    _open_stores[store_dir] = store
+
+    print(f"Imported snapshot {snapshot_path}: {stats}")
+    return stats
@@ -0,0 +1,308 @@
+from concurrent.futures import Future, ThreadPoolExecutor
+import hmac
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import os
+import queue
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+
+import numpy as np
+
+###############################################################################
+# Client
+###############################################################################
+
+# Every R session that loads the model modules through reticulate holds its
+# own copy of each model. Start one worker for the machine
+#
+#   LOGENY_INFERENCE_TOKEN=<secret> python Logeny/inference_worker.py [port] [library.sqlite ...]
+#
+# and set LOGENY_INFERENCE_URL=http://127.0.0.1:8765 and the same
+# LOGENY_INFERENCE_TOKEN before starting the app: get_embedder,
+# classify_text_with_map_reduce / classify_text_scores and the
+# huggingface_model_runner generation functions then call the worker instead
+# of loading models, and concurrent requests from all sessions are batched
+# together there. Every request must carry the token, and classification
+# only reads and writes the library databases named on the command line.
+INFERENCE_URL_ENV = "LOGENY_INFERENCE_URL"
+INFERENCE_TOKEN_ENV = "LOGENY_INFERENCE_TOKEN"
+INFERENCE_TOKEN_HEADER = "X-Logeny-Token"
+INFERENCE_TIMEOUT_S = float(os.environ.get("LOGENY_INFERENCE_TIMEOUT", "600"))
+DEFAULT_INFERENCE_PORT = 8765
+
+
+def inference_worker_url():
+    """The worker's base URL, or None when models are loaded in-process."""
+    url = os.environ.get(INFERENCE_URL_ENV, "").strip()
+    return url.rstrip("/") or None
+
+
+def _to_json(value):
+    return value.tolist() if hasattr(value, "tolist") else str(value)
+
+
+def call_inference_worker(op, **payload):
+    """
+    POSTs payload to the worker's /<op> endpoint and returns its result.
+    Errors raised in the worker come back as RuntimeError.
+    """
+    url = inference_worker_url()
+    if url is None:
+        raise RuntimeError(f"{INFERENCE_URL_ENV} is not set.")
+    body = json.dumps(payload, default=_to_json).encode("utf-8")
+    headers = {"Content-Type": "application/json", INFERENCE_TOKEN_HEADER: os.environ.get(INFERENCE_TOKEN_ENV, "")}
+    request = urllib.request.Request(f"{url}/{op}", data=body, headers=headers)
+    try:
+        with urllib.request.urlopen(request, timeout=INFERENCE_TIMEOUT_S) as response:
+            reply = json.loads(response.read().decode("utf-8"))
+    except urllib.error.HTTPError as e:
+        try:
+            reply = json.loads(e.read().decode("utf-8"))
+        except ValueError:
+            reply = {"error": f"HTTP {e.code}"}
+    except urllib.error.URLError as e:
+        raise RuntimeError(f"Inference worker at {url} is unreachable: {e.reason}")
+    if "error" in reply:
+        raise RuntimeError(f"Inference worker: {reply['error']}")
+    return reply["result"]
+
+
+class RemoteEmbedder:
+    """Stands in for a SentenceTransformer whose encode() runs in the worker."""
+
+    def __init__(self, model_name):
+        self.model_name = model_name
+
+    def encode(self, sentences, convert_to_numpy=True, convert_to_tensor=False, **kwargs):
+        single = isinstance(sentences, str)
+        texts = [sentences] if single else list(sentences)
+        vectors = np.asarray(call_inference_worker("embed", model=self.model_name, texts=texts),
+                             dtype=np.float32).reshape(len(texts), -1)
+        return vectors[0] if single else vectors
+
+###############################################################################
+# Dynamic batching
+###############################################################################
+
+# A request waits up to BATCH_WAIT_MS for others with the same batch key
+# (model, labels, ...) so requests from different sessions share one forward
+# pass; a batch is closed early once it holds BATCH_MAX_ITEMS inputs.
+BATCH_WAIT_MS = int(os.environ.get("LOGENY_BATCH_WAIT_MS", "20"))
+BATCH_MAX_ITEMS = 64
+# Batches of different keys run on this many threads per op, so a long
+# generation for one model doesn't hold up the others.
+BATCH_WORKERS = int(os.environ.get("LOGENY_BATCH_WORKERS", "4"))
+
+
+class _Batcher:
+    """
+    Queue of (key, items) requests. Requests with equal keys that arrive
+    within the wait window are concatenated into a single run_batch(key,
+    items) call, whose outputs are split back per request. Batches run on up
+    to `workers` threads; while all are busy, new requests keep queueing and
+    join larger batches.
+    """
+
+    def __init__(self, name, run_batch, max_items=BATCH_MAX_ITEMS, wait_ms=BATCH_WAIT_MS, workers=BATCH_WORKERS):
+        self.name = name
+        self.run_batch = run_batch
+        self.max_items = max_items
+        self.wait_s = wait_ms / 1000.0
+        self.queue = queue.Queue()
+        self.stats = {"requests": 0, "batches": 0, "items": 0, "largest_batch": 0}
+        self.stats_lock = threading.Lock()
+        self.slots = threading.Semaphore(max(1, workers))
+        self.pool = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix=f"batch-{name}")
+        threading.Thread(target=self._loop, daemon=True).start()
+
+    def submit(self, key, items):
+        future = Future()
+        self.queue.put((key, list(items), future))
+        return future.result()
+
+    def _collect(self):
+        pending = [self.queue.get()]
+        size = len(pending[0][1])
+        deadline = time.monotonic() + self.wait_s
+        while size < self.max_items:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                request = self.queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            pending.append(request)
+            size += len(request[1])
+        return pending
+
+    def _loop(self):
+        while True:
+            groups = {}
+            for request in self._collect():
+                groups.setdefault(request[0], []).append(request)
+            for key, requests in groups.items():
+                self.slots.acquire()
+                self.pool.submit(self._run, key, requests)
+
+    def _run(self, key, requests):
+        try:
+            items = [item for _, request_items, _ in requests for item in request_items]
+            try:
+                outputs = self.run_batch(key, items)
+            except Exception as e:
+                for _, _, future in requests:
+                    future.set_exception(e)
+                return
+            start = 0
+            for _, request_items, future in requests:
+                future.set_result(outputs[start:start + len(request_items)])
+                start += len(request_items)
+            with self.stats_lock:
+                self.stats["requests"] += len(requests)
+                self.stats["batches"] += 1
+                self.stats["items"] += len(items)
+                self.stats["largest_batch"] = max(self.stats["largest_batch"], len(items))
+        finally:
+            self.slots.release()
+
+###############################################################################
+# Worker
+###############################################################################
+
+# The model modules are imported only here, so the client side above stays
+# free of torch and friends.
+
+def _embed_batch(key, texts):
+    from vector_db_search import get_embedder
+    return np.asarray(get_embedder(key).encode(texts), dtype=np.float32).tolist()
+
+
+def _classify_batch(key, texts):
+    import classify_text
+    op, model, quantize, terms, db_path, template, multi_label = key
+    if op == "classify_scores":
+        return classify_text.classify_text_scores(texts, list(terms), db_path, template, multi_label,
+                                                  model_name=model, quantize=quantize)
+    return classify_text.classify_text_with_map_reduce(texts, "", list(terms), db_path=db_path,
+                                                       hypothesis_template=template, model_name=model,
+                                                       quantize=quantize)
+
+
+def _generate_batch(key, prompts):
+    from huggingface_model_runner import generate_responses
+    model, context_window, max_new_tokens, dtype = key
+    return generate_responses(prompts, model, context_window, max_new_tokens, dtype=dtype)
+
+
+_batchers = {}
+_batchers_lock = threading.Lock()
+
+# Set by serve_inference_worker().
+_token = None
+_db_paths = set()
+
+
+def _batcher(name):
+    with _batchers_lock:
+        if name not in _batchers:
+            run_batch = {"embed": _embed_batch, "classify": _classify_batch, "generate": _generate_batch}[name]
+            _batchers[name] = _Batcher(name, run_batch)
+        return _batchers[name]
+
+
+def _handle(op, p):
+    if op == "embed":
+        return _batcher("embed").submit(p["model"], p["texts"])
+
+    if op in ("classify", "classify_scores"):
+        db_path = p.get("db_path")
+        if db_path is not None:
+            db_path = os.path.realpath(db_path)
+            if db_path not in _db_paths:
+                raise ValueError(f"Library {p['db_path']} is not served by this worker.")
+        key = (op, p["model"], bool(p["quantize"]), tuple(p["terms"]), db_path,
+               p["hypothesis_template"], bool(p.get("multi_label", False)))
+        return _batcher("classify").submit(key, p["texts"])
+
+    import huggingface_model_runner as hf
+    if op == "generate":
+        if p.get("thread_id") is not None or p.get("draft_model"):
+            # Per-thread KV caches and assisted decoding are single-sequence.
+            return hf.generate_map_reduce_response(
+                p["prompt"], p["model"], p["context_window"], max_new_tokens=p["max_new_tokens"],
+                dtype=p.get("dtype"), thread_id=p.get("thread_id"), draft_model=p.get("draft_model"))
+        key = (p["model"], int(p["context_window"]), int(p["max_new_tokens"]), p.get("dtype"))
+        return _batcher("generate").submit(key, [p["prompt"]])[0]
+    if op == "tokens":
+        return hf.prompt_token_count(p["prompt"], p["model"])
+    if op == "stream_start":
+        return hf.start_stream(p["prompt"], p["model"], p["max_new_tokens"], p["do_sample"], p.get("dtype"),
+                               p.get("thread_id"), p.get("draft_model"))
+    if op == "stream_poll":
+        return hf.poll_stream(p["stream_id"], p["wait_s"])
+    if op == "stream_cancel":
+        return hf.cancel_stream(p["stream_id"])
+    if op == "stats":
+        return {
+            "batchers": {name: dict(b.stats) for name, b in _batchers.items()},
+            "models": hf.get_model_registry_stats(),
+        }
+    raise ValueError(f"Unknown inference operation: {op}")
+
+
+class _InferenceHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        op = self.path.strip("/")
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            payload = json.loads(self.rfile.read(length).decode("utf-8")) if length else {}
+            if not hmac.compare_digest(self.headers.get(INFERENCE_TOKEN_HEADER, "").encode("utf-8"),
+                                       _token.encode("utf-8")):
+                status, reply = 403, {"error": f"Missing or wrong {INFERENCE_TOKEN_ENV}."}
+            else:
+                status, reply = 200, {"result": _handle(op, payload)}
+        except Exception as e:
+            status, reply = 500, {"error": f"{type(e).__name__}: {e}"}
+        body = json.dumps(reply, default=_to_json).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve_inference_worker(port=DEFAULT_INFERENCE_PORT, host="127.0.0.1", db_paths=()):
+    """
+    Serves embedding, classification and generation to every Logeny session
+    on this machine until interrupted. Binds to localhost only, answers only
+    requests carrying LOGENY_INFERENCE_TOKEN, and classifies against only the
+    library databases in db_paths.
+    """
+    global _token, _db_paths
+    _token = os.environ.get(INFERENCE_TOKEN_ENV, "")
+    if not _token:
+        raise RuntimeError(f"Set {INFERENCE_TOKEN_ENV} to a shared secret before starting the inference worker.")
+    _db_paths = {os.path.realpath(path) for path in db_paths}
+    # The worker runs the models itself; it must not forward to another worker.
+    os.environ.pop(INFERENCE_URL_ENV, None)
+    server = ThreadingHTTPServer((host, int(port)), _InferenceHandler)
+    server.daemon_threads = True
+    print(f"[INFO] Inference worker listening on http://{host}:{port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    serve_inference_worker(int(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_INFERENCE_PORT, db_paths=sys.argv[2:])
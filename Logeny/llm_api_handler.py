@@ -2,28 +2,103 @@
 
 import requests
 import json
-from typing import Dict, Any, Optional
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from typing import Dict, Any, Optional, Tuple
+from urllib.parse import urlsplit
+
+from requests.adapters import HTTPAdapter
 
 class LLMAPIError(Exception):
     """Custom exception for LLM API errors."""
     pass
 
+# Connect/read timeouts in seconds; a provider that stops answering fails the
+# call instead of freezing the Shiny worker.
+CONNECT_TIMEOUT_S = 10
+READ_TIMEOUT_S = 120
+
+# Rate limits and transient server errors are retried with jittered
+# exponential backoff, or after the delay the provider asks for in
+# Retry-After.
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+MAX_RETRIES = 4
+BACKOFF_BASE_S = 1.0
+BACKOFF_MAX_S = 30.0
+RETRY_AFTER_MAX_S = 120.0
+
+# One keep-alive session per provider host, so repeated calls reuse the
+# TCP/TLS connection.
+_sessions: Dict[Tuple[str, str], requests.Session] = {}
+_sessions_lock = threading.Lock()
+
+def get_api_session(api_url: str) -> requests.Session:
+    """Returns the pooled session for the scheme and host of api_url."""
+    parts = urlsplit(api_url)
+    key = (parts.scheme, parts.netloc)
+    with _sessions_lock:
+        session = _sessions.get(key)
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=8)
+            session.mount(f"{parts.scheme}://", adapter)
+            _sessions[key] = session
+        return session
+
+def close_api_sessions() -> None:
+    """Closes every pooled session (their connections are reopened on demand)."""
+    with _sessions_lock:
+        for session in _sessions.values():
+            session.close()
+        _sessions.clear()
+
+def _retry_after_s(response: requests.Response) -> Optional[float]:
+    # Retry-After is either a number of seconds or an HTTP date.
+    value = response.headers.get("Retry-After")
+    if not value:
+        return None
+    try:
+        seconds = float(value)
+    except ValueError:
+        try:
+            seconds = parsedate_to_datetime(value).timestamp() - time.time()
+        except (TypeError, ValueError):
+            return None
+    return min(max(seconds, 0.0), RETRY_AFTER_MAX_S)
+
+def _backoff_s(attempt: int, retry_after: Optional[float] = None) -> float:
+    if retry_after is not None:
+        return retry_after
+    # "Full jitter": a random delay up to the exponential cap.
+    return random.uniform(0, min(BACKOFF_MAX_S, BACKOFF_BASE_S * 2 ** attempt))
+
 def make_api_call(
     api_url: str,
     method: str,
     headers: Dict[str, str],
     payload: Optional[Dict[str, Any]] = None,
-    api_key: str = None
+    api_key: str = None,
+    timeout: Optional[Tuple[float, float]] = None,
+    max_retries: int = MAX_RETRIES
 ) -> str:
     """
     Handles the core logic of making an API request.
 
+    The request goes through the pooled session for the API host. Responses
+    with a status in RETRY_STATUSES and connection failures are retried up
+    to max_retries times with backoff; read timeouts are not, since the
+    provider may still be working on the request.
+
     Args:
         api_url: The URL of the API endpoint.
         method: The HTTP method (e.g., "GET", "POST").
-        headers: HTTP headers to include in the request.
+        headers: HTTP headers to include in the request (not modified).
         payload: The request payload (for POST, PUT, etc.).
         api_key: (Optional) API key to include in headers.
+        timeout: (Optional) (connect, read) timeouts in seconds.
+        max_retries: Retries after the first attempt.
 
     Returns:
         The API response as a string.
@@ -32,16 +107,35 @@ def make_api_call(
         LLMAPIError: If the API request fails.
     """
 
+    headers = dict(headers or {})
     if api_key:
         headers["Authorization"] = f"Bearer {api_key}"  # Or however the API expects the key
-
-    try:
-        response = requests.request(method, api_url, headers=headers, json=payload)
-        response.raise_for_status()  # Raise HTTPError for bad responses (4xx or 5xx)
-        return response.text  # Or response.json() if you expect JSON
-
-    except requests.exceptions.RequestException as e:
-        raise LLMAPIError(f"API request failed: {e}")
+    timeout = timeout or (CONNECT_TIMEOUT_S, READ_TIMEOUT_S)
+    session = get_api_session(api_url)
+
+    attempt = 0
+    while True:
+        try:
+            response = session.request(method, api_url, headers=headers, json=payload, timeout=timeout)
+        except requests.exceptions.ConnectionError as e:
+            # Includes ConnectTimeout; ReadTimeout falls through to the clause below.
+            if attempt >= max_retries:
+                raise LLMAPIError(f"API request failed: {e}")
+            delay = _backoff_s(attempt)
+        except requests.exceptions.RequestException as e:
+            raise LLMAPIError(f"API request failed: {e}")
+        else:
+            if response.status_code not in RETRY_STATUSES or attempt >= max_retries:
+                try:
+                    response.raise_for_status()  # Raise HTTPError for bad responses (4xx or 5xx)
+                except requests.exceptions.RequestException as e:
+                    raise LLMAPIError(f"API request failed: {e}")
+                return response.text  # Or response.json() if you expect JSON
+            delay = _backoff_s(attempt, _retry_after_s(response))
+            response.close()
+        attempt += 1
+        print(f"[INFO] Retrying {method} {api_url} in {delay:.1f}s (attempt {attempt + 1} of {max_retries + 1})")
+        time.sleep(delay)
 
 def call_gemini_api(
     prompt: str,
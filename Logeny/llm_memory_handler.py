@@ -4,10 +4,15 @@ from sentence_transformers import SentenceTransformer, util
 from sklearn.metrics.pairwise import cosine_similarity
 import torch
 
+from db_schema import connect_db
+from inference_worker import RemoteEmbedder, inference_worker_url
+
 # Caching loaded models to avoid redundant downloads
 model_cache = {}
 
 def get_embedding_model(model_name):
+    if inference_worker_url():
+        return RemoteEmbedder(model_name)
     if model_name not in model_cache:
         model_cache[model_name] = SentenceTransformer(model_name)
     return model_cache[model_name]
@@ -18,7 +23,7 @@ def embed_text(texts, model_name):
 
 def save_message_embedding(db_path, item_id, message, model_name, chunk_size=100):
     embedding = embed_text([message], model_name)[0]
-    conn = sqlite3.connect(db_path)
+    conn = connect_db(db_path)
     cur = conn.cursor()
     cur.execute("""
         INSERT INTO documentEmbeddings (snippetID, itemID, chunkIndex, chunkStart, chunkEnd, embeddingModel, chunkSize, embedding)
@@ -37,10 +42,12 @@ def save_message_embedding(db_path, item_id, message, model_name, chunk_size=100
     conn.close()
     return embedding
 
+NOTE_CONTENT_SQL = "SELECT tagResponse FROM itemTags WHERE itemID = ? AND tagCategory = 'note_content'"
+
 def retrieve_nearest_context(db_path, user_message, model_name, chat_thread_id, k=3):
     message_vec = embed_text([user_message], model_name)[0]
 
-    conn = sqlite3.connect(db_path)
+    conn = connect_db(db_path)
     cur = conn.cursor()
 
     cur.execute("""
@@ -54,10 +61,7 @@ def retrieve_nearest_context(db_path, user_message, model_name, chat_thread_id,
     embeddings = []
     item_ids = []
     for item_id, chunk_idx, embedding_blob, _ in rows:
-        cur.execute("""
-            SELECT tagResponse FROM itemTags
-            WHERE itemID = ? AND tagCategory = 'note_content'
-        """, (item_id,))
+        cur.execute(NOTE_CONTENT_SQL, (item_id,))
         note = cur.fetchone()
         if not note:
             continue
@@ -90,7 +94,7 @@ def assemble_memory_context(db_path,
                              use_summary=True,
                              n_snippet_neighbors=3,
                              snippet_embedding_model="sentence-transformers/all-MiniLM-L6-v2"):
-    conn = sqlite3.connect(db_path)
+    conn = connect_db(db_path)
     cur = conn.cursor()
 
     # (1) Get last K messages from the thread
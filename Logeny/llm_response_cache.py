@@ -0,0 +1,188 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import unicodedata
+
+###############################################################################
+# Persistent LLM response cache
+###############################################################################
+
+# Responses of the API providers, keyed by (provider, model, normalized
+# prompt, temperature, max_tokens, system prompt). The runners don't know
+# which library they serve, so the cache is one SQLite file per user rather
+# than a table in the library database.
+LLM_CACHE_PATH = os.environ.get(
+    "LOGENY_LLM_CACHE_PATH", os.path.join(os.path.expanduser("~"), ".cache", "logeny", "llm_responses.sqlite"))
+LLM_CACHE_TTL_S = float(os.environ.get("LOGENY_LLM_CACHE_TTL_S", str(7 * 24 * 3600)))
+LLM_CACHE_MAX_MB = float(os.environ.get("LOGENY_LLM_CACHE_MAX_MB", "64"))
+
+# Only deterministic calls (temperature 0) are answered from the cache by
+# default; a sampled answer is a draw, and asking again should give another.
+# Set LOGENY_LLM_CACHE_SAMPLED=1 to reuse sampled answers too.
+LLM_CACHE_SAMPLED = os.environ.get("LOGENY_LLM_CACHE_SAMPLED", "0") == "1"
+
+_llm_cache_stats = {"hits": 0, "misses": 0, "bypassed": 0, "expired": 0, "stores": 0, "evictions": 0}
+_llm_cache_lock = threading.Lock()
+
+
+def _cache_conn():
+    os.makedirs(os.path.dirname(LLM_CACHE_PATH) or ".", exist_ok=True)
+    conn = sqlite3.connect(LLM_CACHE_PATH, timeout=30)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS llmResponses (
+            cacheKey TEXT PRIMARY KEY,
+            provider TEXT NOT NULL,
+            model TEXT NOT NULL,
+            response TEXT NOT NULL,
+            bytes INT NOT NULL,
+            created REAL NOT NULL,
+            lastUsed REAL NOT NULL,
+            hits INT NOT NULL DEFAULT 0
+        )
+    """)
+    # Size eviction drops the least recently used rows first.
+    conn.execute("CREATE INDEX IF NOT EXISTS llmResponses_lastUsed ON llmResponses(lastUsed)")
+    return conn
+
+
+def normalize_prompt(prompt):
+    """
+    Unicode NFC, Unix newlines, no trailing whitespace on any line and none
+    around the whole prompt, so prompts that differ only in those still
+    share a cache entry.
+    """
+    text = unicodedata.normalize("NFC", prompt or "").replace("\r\n", "\n").replace("\r", "\n")
+    return "\n".join(line.rstrip() for line in text.split("\n")).strip()
+
+
+def llm_cache_key(provider, model, prompt, temperature=None, max_tokens=None, system_prompt=None, extra=None):
+    params = [provider, model, normalize_prompt(prompt),
+              None if temperature is None else float(temperature),
+              None if max_tokens is None else int(max_tokens),
+              normalize_prompt(system_prompt) if system_prompt else None,
+              extra]
+    return hashlib.sha256(json.dumps(params, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+
+def _count(name):
+    with _llm_cache_lock:
+        _llm_cache_stats[name] += 1
+
+
+def _evict_to_size(conn):
+    budget = int(LLM_CACHE_MAX_MB * 1024 * 1024)
+    total = conn.execute("SELECT COALESCE(SUM(bytes), 0) FROM llmResponses").fetchone()[0]
+    if total <= budget:
+        return
+    doomed = []
+    for key, size in conn.execute("SELECT cacheKey, bytes FROM llmResponses ORDER BY lastUsed"):
+        if total <= budget:
+            break
+        doomed.append((key,))
+        total -= size
+    conn.executemany("DELETE FROM llmResponses WHERE cacheKey = ?", doomed)
+    with _llm_cache_lock:
+        _llm_cache_stats["evictions"] += len(doomed)
+
+
+def cached_llm_call(provider, model, prompt, call, temperature=None, max_tokens=None, system_prompt=None,
+                    extra=None, ttl_s=None):
+    """
+    Returns call()'s response for these settings, from the cache when an
+    entry younger than ttl_s exists and the settings are deterministic
+    (temperature 0, or any temperature with LOGENY_LLM_CACHE_SAMPLED=1).
+    Otherwise calls the provider, and stores the answer if it could be
+    served later. `extra` is any further JSON-able input the response
+    depends on.
+    """
+    ttl_s = LLM_CACHE_TTL_S if ttl_s is None else ttl_s
+    key = llm_cache_key(provider, model, prompt, temperature, max_tokens, system_prompt, extra)
+    servable = LLM_CACHE_SAMPLED or (temperature is not None and float(temperature) == 0)
+
+    if servable:
+        try:
+            conn = _cache_conn()
+            try:
+                row = conn.execute("SELECT response, created FROM llmResponses WHERE cacheKey = ?",
+                                   (key,)).fetchone()
+                now = time.time()
+                if row and now - row[1] <= ttl_s:
+                    conn.execute("UPDATE llmResponses SET lastUsed = ?, hits = hits + 1 WHERE cacheKey = ?",
+                                 (now, key))
+                    conn.commit()
+                    _count("hits")
+                    return row[0]
+                if row:
+                    conn.execute("DELETE FROM llmResponses WHERE cacheKey = ?", (key,))
+                    conn.commit()
+                    _count("expired")
+            finally:
+                conn.close()
+        except sqlite3.Error as e:
+            print(f"[INFO] LLM response cache unavailable: {e}")
+        _count("misses")
+    else:
+        _count("bypassed")
+
+    response = call()
+    if servable and isinstance(response, str):
+        try:
+            conn = _cache_conn()
+            try:
+                now = time.time()
+                conn.execute("""
+                    INSERT OR REPLACE INTO llmResponses
+                      (cacheKey, provider, model, response, bytes, created, lastUsed)
+                    VALUES (?, ?, ?, ?, ?, ?, ?)
+                """, (key, provider, model, response, len(response.encode("utf-8")), now, now))
+                conn.execute("DELETE FROM llmResponses WHERE created < ?", (now - LLM_CACHE_TTL_S,))
+                _evict_to_size(conn)
+                conn.commit()
+                _count("stores")
+            finally:
+                conn.close()
+        except sqlite3.Error as e:
+            print(f"[INFO] LLM response cache unavailable: {e}")
+    return response
+
+
+def get_llm_cache_stats():
+    """Counters since start plus the cache file's entry count and size."""
+    with _llm_cache_lock:
+        stats = dict(_llm_cache_stats)
+    lookups = stats["hits"] + stats["misses"]
+    stats["hit_rate"] = stats["hits"] / lookups if lookups else 0.0
+    try:
+        conn = _cache_conn()
+        try:
+            entries, size = conn.execute("SELECT COUNT(*), COALESCE(SUM(bytes), 0) FROM llmResponses").fetchone()
+        finally:
+            conn.close()
+        stats["entries"] = entries
+        stats["mb"] = size / 2**20
+    except sqlite3.Error:
+        pass
+    return stats
+
+
+def clear_llm_cache(provider=None, model=None):
+    """Deletes cached responses, all of them or one provider's / model's."""
+    conn = _cache_conn()
+    try:
+        clauses, params = [], []
+        if provider is not None:
+            clauses.append("provider = ?")
+            params.append(provider)
+        if model is not None:
+            clauses.append("model = ?")
+            params.append(model)
+        where = " WHERE " + " AND ".join(clauses) if clauses else ""
+        deleted = conn.execute("DELETE FROM llmResponses" + where, params).rowcount
+        conn.commit()
+    finally:
+        conn.close()
+    return deleted
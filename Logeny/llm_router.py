@@ -1,21 +1,309 @@
 from huggingface_model_runner import generate_map_reduce_response as hf_response
+from huggingface_model_runner import REDUCE_PROMPT, REDUCE_SEPARATOR
 from gemini_model_runner import configure_gemini, run_gemini_chat
-# from openai_model_runner import run_openai_chat  # future
+from openai_model_runner import openai_model_runner
 # from claude_model_runner import run_claude_chat  # future
 
+import asyncio
+from collections import deque
 import os
+import threading
+import time
 
-def route_model_response(provider, model_name, prompt, context_window=2048, api_key=None):
-    if provider.lower() == "huggingface":
+def route_model_response(provider, model_name, prompt, context_window=2048, api_key=None,
+                         system_prompt=None, temperature=0.7, max_output_tokens=1024):
+    """
+    Answers prompt with the provider's model. For remote providers, a prompt
+    longer than context_window (estimated) goes through
+    remote_map_reduce_response; context_window=None never splits.
+    """
+    provider = provider.lower()
+    if provider == "huggingface":
         return hf_response(prompt, model_name, context_window)
 
-    elif provider.lower() == "gemini":
+    if provider in ("gemini", "google"):
         if not api_key:
             raise ValueError("Gemini API key is required")
         configure_gemini(api_key)
-        return run_gemini_chat(model_name, prompt)
+    elif provider == "openai":
+        if not api_key:
+            api_key = os.getenv("OPENAI_API_KEY")
+    else:
+        raise ValueError(f"Unsupported provider: {provider}")
+
+    call = _remote_caller(provider, model_name, api_key, system_prompt, temperature, max_output_tokens)
+    if context_window is None or \
+            estimate_tokens(prompt, provider, model_name) <= _chunk_budget(context_window, max_output_tokens):
+        return call(prompt)
+    return remote_map_reduce_response(provider, model_name, prompt, context_window, api_key,
+                                      system_prompt, temperature, max_output_tokens)
+
+###############################################################################
+# Remote map-reduce
+###############################################################################
+
+# OpenAI prompts are counted with tiktoken when it is installed. Otherwise
+# (and for Gemini, whose count_tokens is a network round trip) tokens are
+# estimated at four characters each plus TOKEN_ESTIMATE_MARGIN: that ratio
+# holds for English prose, but code, tables and non-Latin text run denser.
+CHARS_PER_TOKEN = 4
+TOKEN_ESTIMATE_MARGIN = 1.25
+# Room left in each request for the map/reduce instructions.
+PROMPT_OVERHEAD_TOKENS = 64
+
+REMOTE_MAP_PROMPT = "This is part {part} of {parts} of a longer request. Respond to what this part contains:\n\n"
+
+# Requests of a map or reduce level that fail are sent again this many
+# times (after the others finished) before the run gives up.
+REMOTE_RETRIES = 2
+REMOTE_RETRY_WAIT_S = 2.0
+
+# Requests in flight and tokens per minute (prompt + max output, estimated)
+# allowed per provider, across every call and map-reduce run in this
+# process. Adjust with set_provider_limits() to match the account's rate
+# limits.
+PROVIDER_LIMITS = {
+    "google": {"concurrency": 4, "tpm": 1000000},
+    "openai": {"concurrency": 4, "tpm": 200000},
+}
+
+_token_budgets = {}
+_provider_slots = {}
+_token_budgets_lock = threading.Lock()
+
+
+_tiktoken_encodings = {}
+
+
+def _tiktoken_encoding(model_name):
+    if model_name not in _tiktoken_encodings:
+        try:
+            import tiktoken
+            try:
+                encoding = tiktoken.encoding_for_model(model_name)
+            except KeyError:
+                encoding = tiktoken.get_encoding("o200k_base")
+        except ImportError:
+            encoding = None
+        _tiktoken_encodings[model_name] = encoding
+    return _tiktoken_encodings[model_name]
+
+
+def estimate_tokens(text, provider=None, model_name=None):
+    if provider == "openai":
+        encoding = _tiktoken_encoding(model_name or "")
+        if encoding is not None:
+            return len(encoding.encode(text, disallowed_special=()))
+    return int(len(text) * TOKEN_ESTIMATE_MARGIN / CHARS_PER_TOKEN) + 1
+
+
+def _chunk_budget(context_window, max_output_tokens):
+    return int(context_window) - int(max_output_tokens) - PROMPT_OVERHEAD_TOKENS
+
+
+def _provider_key(provider):
+    return "google" if provider == "gemini" else provider
+
+
+def set_provider_limits(provider, concurrency=None, tpm=None):
+    limits = PROVIDER_LIMITS.setdefault(_provider_key(provider), {"concurrency": 4, "tpm": 100000})
+    if concurrency is not None:
+        limits["concurrency"] = int(concurrency)
+        with _token_budgets_lock:
+            _provider_slots.pop(_provider_key(provider), None)
+    if tpm is not None:
+        limits["tpm"] = int(tpm)
+        with _token_budgets_lock:
+            _token_budgets.pop(_provider_key(provider), None)
+    return dict(limits)
+
+
+class _TokenBudget:
+    """
+    Sliding one-minute window of tokens sent to one provider, shared by every
+    remote call in this process. A request that would exceed the limit
+    waits until enough of the window has expired; a single request larger
+    than the limit is let through alone.
+    """
+
+    def __init__(self, tpm):
+        self.tpm = tpm
+        self.sent = deque()
+        self.lock = threading.Lock()
 
-    # elif provider.lower() == "openai":
-    #     return run_openai_chat(model_name, prompt, api_key)
+    def _reserve(self, tokens):
+        # Records the request and returns 0, or returns how long to wait.
+        now = time.monotonic()
+        with self.lock:
+            while self.sent and now - self.sent[0][0] >= 60:
+                self.sent.popleft()
+            if not self.sent or sum(t for _, t in self.sent) + tokens <= self.tpm:
+                self.sent.append((now, tokens))
+                return 0.0
+            return 60 - (now - self.sent[0][0])
+
+    def acquire(self, tokens):
+        while True:
+            wait = self._reserve(tokens)
+            if wait <= 0:
+                return
+            time.sleep(wait)
+
+
+def _token_budget(provider):
+    key = _provider_key(provider)
+    with _token_budgets_lock:
+        if key not in _token_budgets:
+            _token_budgets[key] = _TokenBudget(PROVIDER_LIMITS.get(key, {}).get("tpm", 100000))
+        return _token_budgets[key]
+
+
+def _provider_slot(provider):
+    # Held for the duration of each blocking request to the provider.
+    key = _provider_key(provider)
+    with _token_budgets_lock:
+        if key not in _provider_slots:
+            _provider_slots[key] = threading.BoundedSemaphore(PROVIDER_LIMITS.get(key, {}).get("concurrency", 4))
+        return _provider_slots[key]
+
+
+def _unfence(text):
+    # openai_model_runner wraps answers in a ```markdown fence; partial
+    # answers are re-sent as input, so drop it there.
+    text = text.strip()
+    if text.startswith("```markdown\n") and text.endswith("```"):
+        return text[len("```markdown\n"):-3].strip()
+    return text
+
+
+def _remote_caller(provider, model_name, api_key, system_prompt, temperature, max_output_tokens):
+    # A blocking prompt -> text call for the provider's SDK, within the
+    # provider's tokens-per-minute and concurrency limits.
+    if provider == "openai":
+        run = lambda text: openai_model_runner(text, model=model_name, api_key=api_key, system_prompt=system_prompt,
+                                               temperature=temperature, max_tokens=max_output_tokens)
+    else:
+        run = lambda text: run_gemini_chat(model_name, text, temperature=temperature,
+                                           max_output_tokens=max_output_tokens, system_prompt=system_prompt)
+
+    def call(text):
+        _token_budget(provider).acquire(estimate_tokens(text, provider, model_name) + max_output_tokens)
+        with _provider_slot(provider):
+            return run(text)
+    return call
+
+
+def _split_for_remote(prompt, budget_tokens, count=estimate_tokens):
+    # Chunks of at most budget_tokens (as count() measures them), cut at
+    # whitespace. Sized from characters first; a chunk that counts over
+    # budget is halved until it fits.
+    max_chars = max(int(max(budget_tokens, 1) * CHARS_PER_TOKEN / TOKEN_ESTIMATE_MARGIN), 1)
+    pending = []
+    start = 0
+    while start < len(prompt):
+        end = min(start + max_chars, len(prompt))
+        if end < len(prompt):
+            cut = prompt.rfind(" ", start, end)
+            if cut > start:
+                end = cut
+        pending.append(prompt[start:end].strip())
+        start = end
+    chunks = []
+    pending.reverse()
+    while pending:
+        chunk = pending.pop()
+        if len(chunk) > 1 and count(chunk) > budget_tokens:
+            middle = chunk.rfind(" ", 0, len(chunk) // 2)
+            middle = middle if middle > 0 else len(chunk) // 2
+            pending += [chunk[middle:].strip(), chunk[:middle].strip()]
+        elif chunk:
+            chunks.append(chunk)
+    return chunks
+
+
+def _pack_parts(parts, budget_tokens, count=estimate_tokens):
+    # Consecutive parts joined into prompts that fit the budget. A part too
+    # large to share a prompt goes into one of its own; nothing is cut off.
+    groups = []
+    current, used = [], count(REDUCE_PROMPT)
+    for part in parts:
+        cost = count(part + REDUCE_SEPARATOR)
+        if current and used + cost > budget_tokens:
+            groups.append(current)
+            current, used = [], count(REDUCE_PROMPT)
+        current.append(part)
+        used += cost
+    if current:
+        groups.append(current)
+    if len(groups) == len(parts) > 1:
+        # No two parts fit one prompt; pair them anyway so the level shrinks.
+        groups = [parts[i:i + 2] for i in range(0, len(parts), 2)]
+    prompts = [REDUCE_PROMPT + REDUCE_SEPARATOR.join(group) for group in groups]
+    for text in prompts:
+        if count(text) > budget_tokens:
+            print(f"[INFO] Reduce prompt of ~{count(text)} tokens exceeds the "
+                  f"{budget_tokens}-token chunk budget; sending it whole.")
+    return prompts
+
+
+async def _remote_map_reduce(call, prompt, budget_tokens, count=estimate_tokens):
+    stats = {"requests": 0, "levels": 0, "retries": 0}
+
+    async def send(text):
+        # call() waits for token budget and one of the provider's slots in
+        # its worker thread.
+        stats["requests"] += 1
+        return _unfence(await asyncio.to_thread(call, text))
+
+    async def send_all(texts):
+        # One failed request is retried on its own instead of failing the level.
+        results = await asyncio.gather(*[send(text) for text in texts], return_exceptions=True)
+        for attempt in range(REMOTE_RETRIES + 1):
+            failed = [i for i, result in enumerate(results) if isinstance(result, Exception)]
+            if not failed:
+                return results
+            if attempt == REMOTE_RETRIES:
+                raise RuntimeError(f"{len(failed)} of {len(texts)} remote requests failed: "
+                                   f"{results[failed[0]]}") from results[failed[0]]
+            print(f"[INFO] Retrying {len(failed)} of {len(texts)} remote requests ({results[failed[0]]})")
+            stats["retries"] += len(failed)
+            await asyncio.sleep(REMOTE_RETRY_WAIT_S * (attempt + 1))
+            retried = await asyncio.gather(*[send(texts[i]) for i in failed], return_exceptions=True)
+            for i, result in zip(failed, retried):
+                results[i] = result
+
+    chunks = _split_for_remote(prompt, budget_tokens, count)
+    parts = await send_all([REMOTE_MAP_PROMPT.format(part=n + 1, parts=len(chunks)) + chunk
+                            for n, chunk in enumerate(chunks)])
+    while len(parts) > 1:
+        stats["levels"] += 1
+        parts = await send_all(_pack_parts(parts, budget_tokens, count))
+    return (parts[0] if parts else ""), len(chunks), stats
+
+
+def remote_map_reduce_response(provider, model_name, prompt, context_window, api_key=None, system_prompt=None,
+                               temperature=0.7, max_output_tokens=1024):
+    """
+    Map-reduce for API providers: the prompt is cut into chunks that fit
+    context_window, all chunks are sent concurrently (within the provider's
+    concurrency and tokens-per-minute limits), and the partial answers are
+    reduced the same way until one answer is left.
+    """
+    provider = provider.lower()
+    budget_tokens = _chunk_budget(context_window, max_output_tokens)
+    if budget_tokens < 2 * max_output_tokens:
+        raise ValueError(f"context_window {context_window} is too small to reduce outputs of "
+                         f"{max_output_tokens} tokens.")
+    if provider in ("gemini", "google") and api_key:
+        configure_gemini(api_key)
+    call = _remote_caller(provider, model_name, api_key, system_prompt, temperature, max_output_tokens)
 
-    raise ValueError(f"Unsupported provider: {provider}")
+    started = time.perf_counter()
+    count = lambda text: estimate_tokens(text, provider, model_name)
+    answer, n_chunks, stats = asyncio.run(_remote_map_reduce(call, prompt, budget_tokens, count))
+    print(f"[INFO] Remote map-reduce: {n_chunks} chunks, {stats['levels']} reduce levels, "
+          f"{stats['requests']} requests ({stats['retries']} retried) in {time.perf_counter() - started:.1f}s")
+    if provider == "openai":
+        # Same shape as a single openai_model_runner answer.
+        return f"```markdown\n{answer}\n```"
+    return answer
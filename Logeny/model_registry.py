@@ -0,0 +1,286 @@
+from collections import OrderedDict
+from contextlib import contextmanager
+import gc
+import json
+import math
+import os
+import struct
+import threading
+
+import torch
+from transformers import AutoTokenizer, AutoModelForCausalLM, AutoModelForSequenceClassification
+
+###############################################################################
+# Loading
+###############################################################################
+
+# RAM the registry may hold in loaded models before evicting the least
+# recently used idle one. LOGENY_MODEL_RAM_MB overrides it.
+MODEL_RAM_BUDGET_MB = int(os.environ.get("LOGENY_MODEL_RAM_MB", "8192"))
+
+# float32 loads as published; bfloat16 halves the weights; int8 applies
+# dynamic quantization to Linear layers after loading (CPU only).
+MODEL_DTYPES = ("float32", "bfloat16", "int8")
+DEFAULT_MODEL_DTYPE = os.environ.get("LOGENY_MODEL_DTYPE", "float32")
+
+MODEL_CLASSES = {
+    "causal-lm": AutoModelForCausalLM,
+    "sequence-classification": AutoModelForSequenceClassification,
+}
+
+
+def default_device():
+    return "cuda" if torch.cuda.is_available() else "cpu"
+
+
+def model_cache_dir(model_name):
+    base_dir = os.path.join(os.path.dirname(__file__), "models")
+    cache_dir = os.path.join(base_dir, model_name.replace("/", "_"))
+    os.makedirs(cache_dir, exist_ok=True)
+    return cache_dir
+
+
+def load_pretrained(model_name, model_type="causal-lm", dtype=DEFAULT_MODEL_DTYPE, device=None):
+    """
+    Loads (tokenizer, model) in eval mode on `device` with the given dtype.
+    """
+    if model_type not in MODEL_CLASSES:
+        raise ValueError(f"Unsupported model type: {model_type}")
+    if dtype not in MODEL_DTYPES:
+        raise ValueError(f"Unsupported model dtype: {dtype}")
+    device = device or default_device()
+    if dtype == "int8" and device != "cpu":
+        raise ValueError("int8 dynamic quantization is only available on CPU.")
+
+    cache_dir = model_cache_dir(model_name)
+    print(f"[INFO] Loading {model_type} {model_name} ({dtype}, {device}) into {cache_dir}")
+    tokenizer = AutoTokenizer.from_pretrained(model_name, cache_dir=cache_dir)
+    kwargs = {"torch_dtype": torch.bfloat16} if dtype == "bfloat16" else {}
+    model = MODEL_CLASSES[model_type].from_pretrained(model_name, cache_dir=cache_dir, **kwargs)
+    model.eval()
+    if dtype == "int8":
+        model = torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    elif device != "cpu":
+        model = model.to(device)
+    return tokenizer, model
+
+###############################################################################
+# Registry
+###############################################################################
+
+# Bytes per weight once loaded, for estimating a model's size before loading.
+BYTES_PER_PARAM = {"float32": 4, "bfloat16": 2, "int8": 1}
+
+
+def _model_bytes(value):
+    # Approximate resident size: parameter and buffer storage of every model
+    # reachable from the cached value (a (tokenizer, model) pair or a
+    # pipeline). Dynamically quantized Linear layers keep their int8 weights
+    # in _packed_params rather than as parameters, so those are added too.
+    total = 0
+    for v in value if isinstance(value, tuple) else (value,):
+        m = v if hasattr(v, "parameters") else getattr(v, "model", None)
+        if m is None:
+            continue
+        for t in list(m.parameters()) + list(m.buffers()):
+            total += t.numel() * t.element_size()
+        for module in m.modules():
+            packed = getattr(module, "_packed_params", None)
+            if isinstance(packed, torch.nn.Module) and hasattr(packed, "_weight_bias"):
+                for t in packed._weight_bias():
+                    if t is not None:
+                        total += t.numel() * t.element_size()
+    return total
+
+
+def _safetensors_params(path):
+    # Weight count from the file's JSON header, without reading the tensors.
+    try:
+        with open(path, "rb") as f:
+            header = json.loads(f.read(struct.unpack("<Q", f.read(8))[0]))
+    except (OSError, ValueError, struct.error):
+        return 0
+    return sum(math.prod(t["shape"]) for name, t in header.items() if name != "__metadata__")
+
+
+def _config_params(path):
+    # Rough transformer weight count from config.json: embeddings plus
+    # attention (4 h^2) and MLP (2 h * intermediate) per layer.
+    try:
+        with open(path, "r") as f:
+            config = json.load(f)
+    except (OSError, ValueError):
+        return 0
+    hidden = config.get("hidden_size") or config.get("n_embd") or config.get("d_model")
+    layers = config.get("num_hidden_layers") or config.get("n_layer") or config.get("num_layers")
+    if not hidden or not layers:
+        return 0
+    intermediate = config.get("intermediate_size") or config.get("n_inner") or 4 * hidden
+    return config.get("vocab_size", 0) * hidden + layers * (4 * hidden * hidden + 2 * hidden * intermediate)
+
+
+def estimate_model_bytes(model_name, dtype=DEFAULT_MODEL_DTYPE):
+    """
+    The model's size once loaded at dtype, estimated from the tensor shapes in
+    its cached safetensors headers, else from its cached config.json. 0 when
+    nothing is cached yet (the first load downloads it).
+    """
+    safetensors, config = {}, None
+    for root, _, files in os.walk(model_cache_dir(model_name)):
+        for name in files:
+            if name.endswith(".safetensors"):
+                safetensors[root] = safetensors.get(root, 0) + _safetensors_params(os.path.join(root, name))
+            elif name == "config.json" and config is None:
+                config = os.path.join(root, name)
+    # One snapshot directory per cached revision; count the largest once.
+    params = max(safetensors.values(), default=0) or (_config_params(config) if config else 0)
+    return params * BYTES_PER_PARAM.get(dtype, 4)
+
+
+class ModelRegistry:
+    """
+    Loaded models keyed by (name, type, dtype, device), least recently used
+    first. When the estimated total exceeds the budget, idle entries are
+    evicted oldest first; entries acquired by an in-flight generation are
+    never evicted. Every module loading models goes through the one registry
+    instance below, so the budget covers them all.
+
+    A miss makes room for the model's estimated size before loading it, and
+    loads outside the lock: other keys stay available meanwhile, and callers
+    wanting the same key wait for that one load.
+    """
+
+    def __init__(self, budget_mb=MODEL_RAM_BUDGET_MB):
+        self.budget_bytes = int(budget_mb) * 1024 * 1024
+        self._entries = OrderedDict()
+        self._loading = {}  # key -> (Event set when the load ends, estimated bytes)
+        self._external = {}  # name -> bytes held outside the registry (e.g. KV caches)
+        self._lock = threading.RLock()
+        self.loads = 0
+        self.evictions = 0
+
+    def get(self, key, loader):
+        """
+        The cached value for key, loading it with loader() on a miss.
+        """
+        return self._get(key, loader, pin=False)
+
+    def acquire(self, key, loader):
+        """get() and pin the entry until release(key)."""
+        return self._get(key, loader, pin=True)
+
+    def _get(self, key, loader, pin):
+        while True:
+            with self._lock:
+                entry = self._entries.get(key)
+                if entry is not None:
+                    self._entries.move_to_end(key)
+                    entry["refs"] += int(pin)
+                    return entry["value"]
+                loading = self._loading.get(key)
+                if loading is None:
+                    done = threading.Event()
+                    self._loading[key] = (done, 0)
+                    break
+            # Another thread is loading key; use its result, or retry if it failed.
+            loading[0].wait()
+
+        try:
+            estimate = estimate_model_bytes(key[0], key[2])
+            with self._lock:
+                self._loading[key] = (done, estimate)
+                self._evict()
+            value = loader()
+            with self._lock:
+                self._entries[key] = {"value": value, "bytes": _model_bytes(value), "refs": int(pin)}
+                self.loads += 1
+                del self._loading[key]
+                self._evict(keep=key)
+            return value
+        finally:
+            with self._lock:
+                self._loading.pop(key, None)
+            done.set()
+
+    def release(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry["refs"] > 0:
+                entry["refs"] -= 1
+            self._evict()
+
+    @contextmanager
+    def using(self, key, loader):
+        value = self.acquire(key, loader)
+        try:
+            yield value
+        finally:
+            self.release(key)
+
+    def _evict(self, keep=None):
+        # Models being loaded count at their estimated size.
+        total = (sum(e["bytes"] for e in self._entries.values()) + sum(b for _, b in self._loading.values())
+                 + sum(self._external.values()))
+        if total <= self.budget_bytes:
+            return
+        for key in list(self._entries):
+            if total <= self.budget_bytes:
+                break
+            entry = self._entries[key]
+            if key == keep or entry["refs"] > 0:
+                continue
+            del self._entries[key]
+            total -= entry["bytes"]
+            self.evictions += 1
+            print(f"[INFO] Evicted model {key} ({entry['bytes'] / 2**20:.0f} MB) to stay within the RAM budget")
+        if total > self.budget_bytes:
+            print(f"[INFO] Models in use need {total / 2**20:.0f} MB, over the {self.budget_bytes / 2**20:.0f} MB budget")
+        gc.collect()
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+    def evict(self, key):
+        """Drops key unless it is in use. Returns True if it was dropped."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry["refs"] > 0:
+                return False
+            del self._entries[key]
+            self.evictions += 1
+        gc.collect()
+        return True
+
+    def set_external_bytes(self, name, nbytes):
+        """
+        Charges memory held outside the registry (e.g. cached KV tensors)
+        to the budget under `name`, evicting idle models if it no longer fits.
+        """
+        with self._lock:
+            if nbytes:
+                self._external[name] = int(nbytes)
+            else:
+                self._external.pop(name, None)
+            self._evict()
+
+    def set_budget(self, budget_mb):
+        with self._lock:
+            self.budget_bytes = int(budget_mb) * 1024 * 1024
+            self._evict()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "budget_mb": self.budget_bytes / 2**20,
+                "loaded_mb": sum(e["bytes"] for e in self._entries.values()) / 2**20,
+                "loading": [list(key) for key in self._loading],
+                "external_mb": sum(self._external.values()) / 2**20,
+                "loads": self.loads,
+                "evictions": self.evictions,
+                "models": [
+                    {"key": list(key), "mb": e["bytes"] / 2**20, "refs": e["refs"]}
+                    for key, e in self._entries.items()
+                ],
+            }
+
+
+registry = ModelRegistry()
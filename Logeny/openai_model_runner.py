@@ -1,6 +1,8 @@
 import openai
 import os
 
+from llm_response_cache import cached_llm_call
+
 def openai_model_runner(prompt, model="gpt-3.5-turbo", api_key=None, system_prompt=None, temperature=0.7, max_tokens=1024):
     if not api_key:
         api_key = os.getenv("OPENAI_API_KEY")
@@ -14,14 +16,18 @@ def openai_model_runner(prompt, model="gpt-3.5-turbo", api_key=None, system_prom
         messages.append({"role": "system", "content": system_prompt})
     messages.append({"role": "user", "content": "Please format your response in Markdown. " + prompt})
 
-    try:
+    def call():
         response = client.chat.completions.create(
             model=model,
             messages=messages,
             temperature=temperature,
             max_tokens=max_tokens
         )
-        output = response.choices[0].message.content.strip()
+        return response.choices[0].message.content.strip()
+
+    try:
+        output = cached_llm_call("openai", model, prompt, call, temperature=temperature,
+                                 max_tokens=max_tokens, system_prompt=system_prompt)
         return f"```markdown\n{output}\n```"
     except Exception as e:
         raise RuntimeError(f"OpenAI API call failed: {e}")
@@ -1,81 +1,62 @@
+import hashlib
+import json
 import os
 import re
-import sqlite3
+import time
 import numpy as np
-from sentence_transformers import SentenceTransformer
+from sentence_transformers import CrossEncoder, SentenceTransformer
 
 from extract_text import read_text_file
+from cache_utils import LRUCache
+from db_schema import connect_db, get_library_generation
+from inference_worker import RemoteEmbedder, inference_worker_url
+from vector_store import search_vector_stores
+from zotero_integration import collection_items_query
 
-###############################################################################
-# HNSWIndex with Cosine Distance
-###############################################################################
+# model_name -> loaded SentenceTransformer
+_embedders = {}
 
-class HNSWIndex:
-    def __init__(self, dim, M=16, ef=50):
-        self.dim = dim
-        self.M = M
-        self.ef = ef
-        self.vectors = []
-        self.ids = []
-        self.graph = []
-
-    def add_items(self, vectors, ids):
-        def cosine_distance(v1, v2):
-            return 1.0 - np.dot(v1, v2) / (np.linalg.norm(v1) * np.linalg.norm(v2))
-
-        for i in range(len(vectors)):
-            v = vectors[i]
-            the_id = ids[i]
-            idx = len(self.vectors)
-            self.vectors.append(v)
-            self.ids.append(the_id)
-            self.graph.append([])
-            if idx == 0:
-                continue
-            dists = []
-            for j in range(idx):
-                dist = cosine_distance(v, self.vectors[j])
-                dists.append((dist, j))
-            dists.sort(key=lambda x: x[0])
-            neighbors = [p[1] for p in dists[:self.M]]
-            self.graph[idx] = neighbors
-            for nbr in neighbors:
-                if len(self.graph[nbr]) < self.M:
-                    self.graph[nbr].append(idx)
-
-    def search(self, qvec, top_k=5):
-        def cosine_distance(v1, v2):
-            return 1.0 - np.dot(v1, v2) / (np.linalg.norm(v1) * np.linalg.norm(v2))
-
-        import random, heapq
-        if len(self.vectors) == 0:
-            return []
+# (model_name, query_str) -> query vector
+_query_embeddings = LRUCache(maxsize=256)
+
+# cacheKey -> (library generation, ranked hits), in front of the searchCache table
+_search_cache = LRUCache(maxsize=256)
+
+DEFAULT_RERANK_MODEL = "cross-encoder/ms-marco-MiniLM-L-6-v2"
+RERANK_BATCH_SIZE = 16
 
-        start = random.randint(0, len(self.vectors)-1)
-        visited = set([start])
-        candidates = [(cosine_distance(qvec, self.vectors[start]), start)]
-        heapq.heapify(candidates)
+# model_name -> loaded CrossEncoder
+_cross_encoders = {}
 
-        while len(candidates) < self.ef and len(candidates) < len(self.vectors):
-            dist, node = heapq.heappop(candidates)
-            for nbr in self.graph[node]:
-                if nbr not in visited:
-                    visited.add(nbr)
-                    dist_nbr = cosine_distance(qvec, self.vectors[nbr])
-                    heapq.heappush(candidates, (dist_nbr, nbr))
+# sha1(model, query, chunk text) -> cross-encoder score
+_pair_scores = LRUCache(maxsize=4096)
 
-        candidates.sort(key=lambda x: x[0])
-        return [self.ids[x[1]] for x in candidates[:top_k]]
+# (file path, mtime) -> list of words, so re-chunking many hits from one
+# file reads it once
+_file_words = LRUCache(maxsize=16)
 
 ###############################################################################
 # Reconstruct Snippet
 ###############################################################################
 
+def _read_file_words(file_path):
+    try:
+        key = (file_path, os.path.getmtime(file_path))
+    except OSError:
+        return None
+    words = _file_words.get(key)
+    if words is None:
+        text = read_text_file(file_path)
+        if not text:
+            return None
+        words = re.split(r"\s+", text.strip())
+        _file_words.put(key, words)
+    return words
+
 def re_chunk_file(file_path, chunk_size, snippet_index):
-    text = read_text_file(file_path)
-    if not text:
+    words = _read_file_words(file_path)
+    if not words:
         return None
-    words = re.split(r"\s+", text.strip())
     start_i = snippet_index * chunk_size
     end_i = min(len(words), start_i + chunk_size)
     if start_i >= len(words):
@@ -83,101 +64,429 @@ def re_chunk_file(file_path, chunk_size, snippet_index):
     return " ".join(words[start_i:end_i])
 
 ###############################################################################
-# Vector Search Logic
+# Search Scope
 ###############################################################################
-def vector_db_search(db_path, collection_name, query_str, top_k=5, chunk_size=50, model_name="sentence-transformers/all-MiniLM-L6-v2"):
 
-    os.environ["TRANSFORMERS_OFFLINE"] = "1"
+SCOPE_TAG_SQL = "SELECT itemID FROM itemTags WHERE tagCategory = ? AND tagResponse = ?"
 
-    conn = sqlite3.connect(db_path)
-    c = conn.cursor()
+def get_scope_item_ids(c, collection_name, recursive=False, filters=None):
+    """
+    Resolves a search scope to itemIDs in a single query. Returns None for
+    "All Documents" with no filters, meaning every live row is in scope.
 
-    # 1. Get relevant itemIDs
-    if collection_name == "All Documents":
-        c.execute("SELECT itemID FROM items WHERE itemTypeID != 14")
-        item_ids = [r[0] for r in c.fetchall()]
-    else:
-        c.execute("SELECT collectionID FROM collections WHERE collectionName=?", (collection_name,))
-        row = c.fetchone()
-        if not row:
-            conn.close()
+    `filters` is an optional dict of metadata constraints:
+      - "year_from" / "year_to": inclusive bounds on the item's year,
+      - any other key: an itemTags category whose tagResponse must equal the
+        value (e.g. {"project": "Global"}).
+    """
+    filters = dict(filters or {})
+    clauses = []
+    params = []
+
+    if collection_name != "All Documents":
+        query = collection_items_query(c, collection_name, recursive)
+        if query is None:
             return []
-        coll_id = row[0]
-        c.execute("SELECT itemID FROM collectionItems WHERE collectionID=?", (coll_id,))
-        item_ids = [r[0] for r in c.fetchall()]
-        if not item_ids:
+        clauses.append(query[0])
+        params.extend(query[1])
+
+    year_from = filters.pop("year_from", None)
+    year_to = filters.pop("year_to", None)
+    if year_from is not None or year_to is not None:
+        # fieldID=115 => date/year, stored as text starting with the year
+        clauses.append("""
+            SELECT itemData.itemID
+            FROM itemData
+            JOIN itemDataValues ON itemData.valueID = itemDataValues.valueID
+            WHERE itemData.fieldID = 115
+              AND CAST(substr(itemDataValues.value, 1, 4) AS INTEGER) BETWEEN ? AND ?
+        """)
+        params.extend([int(year_from) if year_from is not None else 0,
+                       int(year_to) if year_to is not None else 9999])
+
+    for tag_category, tag_response in filters.items():
+        clauses.append(SCOPE_TAG_SQL)
+        params.extend([tag_category, str(tag_response)])
+
+    if not clauses:
+        return None
+    c.execute(" INTERSECT ".join(clauses), params)
+    return [r[0] for r in c.fetchall()]
+
+###############################################################################
+# Query embedding + result caches
+###############################################################################
+
+def get_embedder(model_name):
+    embedder = _embedders.get(model_name)
+    if embedder is None and inference_worker_url():
+        return RemoteEmbedder(model_name)
+    if embedder is None:
+        embedder = SentenceTransformer(model_name, cache_folder=os.path.expanduser("~/.cache/huggingface/"))
+        _embedders[model_name] = embedder
+    return embedder
+
+
+def embed_query(query_str, model_name):
+    """
+    Query vector for `query_str`, reusing recent ones so a repeated query
+    never touches the model.
+    """
+    key = (model_name, query_str)
+    q_vec = _query_embeddings.get(key)
+    if q_vec is None:
+        q_vec = get_embedder(model_name).encode([query_str])[0].astype("float32")
+        _query_embeddings.put(key, q_vec)
+    return q_vec
+
+
+def _search_cache_key(q_vec, model_name, collection_name, top_k, recursive, filters, quantization):
+    params = json.dumps([model_name, collection_name, int(top_k), bool(recursive),
+                         sorted((filters or {}).items()), quantization], default=str)
+    digest = hashlib.sha1(np.ascontiguousarray(q_vec, dtype=np.float32).tobytes())
+    digest.update(params.encode("utf-8"))
+    return digest.hexdigest()
+
+
+SEARCH_CACHE_SQL = "SELECT generation, hits FROM searchCache WHERE cacheKey=?"
+
+
+def _get_cached_hits(c, cache_key, generation):
+    cached = _search_cache.get(cache_key)
+    if cached is not None and cached[0] == generation:
+        return cached[1]
+    c.execute(SEARCH_CACHE_SQL, (cache_key,))
+    row = c.fetchone()
+    if row and row[0] == generation:
+        hits = [tuple(h) for h in json.loads(row[1])]
+        if all(len(h) == 4 for h in hits):  # (snippetID, itemID, chunkIndex, score)
+            _search_cache.put(cache_key, (generation, hits))
+            return hits
+    return None
+
+
+def _put_cached_hits(c, cache_key, generation, hits):
+    _search_cache.put(cache_key, (generation, hits))
+    c.execute("DELETE FROM searchCache WHERE generation < ?", (generation,))
+    c.execute("""
+        INSERT OR REPLACE INTO searchCache (cacheKey, generation, hits)
+        VALUES (?, ?, ?)
+    """, (cache_key, generation, json.dumps(hits)))
+
+
+def clear_search_cache(db_path=None):
+    """
+    Empties the in-process caches, and the searchCache table as well when
+    db_path is given.
+    """
+    _search_cache.clear()
+    _query_embeddings.clear()
+    if db_path:
+        conn = connect_db(db_path)
+        try:
+            conn.execute("DELETE FROM searchCache")
+            conn.commit()
+        finally:
             conn.close()
-            return []
 
-    # 2. Load embeddings
-    placeholders = ",".join(["?"] * len(item_ids))
-    c.execute(f"""
-        SELECT snippetID, itemID, chunkIndex
-        FROM documentEmbeddings
-        WHERE itemID IN ({placeholders})
-        ORDER BY snippetID
-    """, item_ids)
-    snippet_rows = c.fetchall()
-
-    db_folder = os.path.dirname(db_path)
-    emb_folder = os.path.join(db_folder, "embedding_data")
-    vectors = []
-    snippet_ids = []
-
-    for s_id, i_id, chunk_idx in snippet_rows:
-        emb_path = os.path.join(emb_folder, f"snippet_{s_id}.npy")
-        if os.path.exists(emb_path):
-            vectors.append(np.load(emb_path))
-            snippet_ids.append((s_id, i_id, chunk_idx))
-
-    if not vectors:
-        conn.close()
-        return []
+###############################################################################
+# Cross-encoder re-ranking
+###############################################################################
 
-    # 3. Build HNSW index and embed query
-    dim = vectors[0].shape[0]
-    hnsw = HNSWIndex(dim)
-    hnsw.add_items(np.array(vectors, dtype=np.float32), list(range(len(vectors))))
+def get_cross_encoder(model_name=DEFAULT_RERANK_MODEL):
+    model = _cross_encoders.get(model_name)
+    if model is None:
+        try:
+            model = CrossEncoder(model_name)
+        except Exception as e:
+            raise RuntimeError(f"Failed to load cross-encoder '{model_name}': {e}")
+        _cross_encoders[model_name] = model
+    return model
 
-    embedder = SentenceTransformer(model_name, cache_folder=os.path.expanduser("~/.cache/huggingface/"))
-    q_vec = embedder.encode([query_str])[0].astype("float32")
 
-    # 4. Search
-    local_indices = hnsw.search(q_vec, top_k=top_k)
+def _pair_key(model_name, query_str, text):
+    return hashlib.sha1("\0".join([model_name, query_str, text]).encode("utf-8")).hexdigest()
 
-    # 5. Insert results + return
-    results = []
-    for L in local_indices:
-        snippet_id, item_id, chunk_idx = snippet_ids[L]
 
-        # Fetch file path for chunk reconstruction
+def cross_encoder_rerank(query_str, texts, model_name=DEFAULT_RERANK_MODEL,
+                      budget_s=1.0, batch_size=RERANK_BATCH_SIZE):
+    """
+    Scores (query, text) pairs with a cross-encoder and returns candidate
+    indices, best first. `texts` must be in bi-encoder order.
+
+    Pairs are scored in batches in that order. Once the next batch would run
+    past budget_s, scoring stops; the unscored tail keeps its bi-encoder order
+    after everything that was scored. Scores are cached by content hash, so
+    cached pairs cost nothing against the budget.
+    """
+    started = time.perf_counter()
+    scores = {}
+    pending = []
+    for i, text in enumerate(texts):
+        if text is None:
+            continue
+        cached = _pair_scores.get(_pair_key(model_name, query_str, text))
+        if cached is None:
+            pending.append(i)
+        else:
+            scores[i] = cached
+
+    per_pair = None
+    for b_start in range(0, len(pending), batch_size):
+        batch = pending[b_start:b_start + batch_size]
+        elapsed = time.perf_counter() - started
+        if per_pair is not None and elapsed + per_pair * len(batch) > budget_s:
+            print(f"Re-rank budget reached after {b_start}/{len(pending)} uncached pairs.")
+            break
+        batch_started = time.perf_counter()
+        model = get_cross_encoder(model_name)
+        batch_scores = model.predict([(query_str, texts[i]) for i in batch], batch_size=batch_size)
+        per_pair = (time.perf_counter() - batch_started) / len(batch)
+        for i, score in zip(batch, batch_scores):
+            scores[i] = float(score)
+            _pair_scores.put(_pair_key(model_name, query_str, texts[i]), float(score))
+
+    scored = sorted(scores, key=lambda i: -scores[i])
+    return scored + [i for i in range(len(texts)) if i not in scores]
+
+###############################################################################
+# Vector Search Logic
+###############################################################################
+def vector_db_search(db_path, collection_name, query_str, top_k=5, chunk_size=50, model_name="sentence-transformers/all-MiniLM-L6-v2", recursive=False, filters=None, quantization=False,
+                     rerank=False, rerank_candidates=50, rerank_budget_s=1.0, rerank_model=DEFAULT_RERANK_MODEL,
+                     workers=1):
+    """
+    Semantic search over the named collection ("All Documents" for the whole
+    library). recursive=True also searches every subcollection; `filters`
+    narrows the scope further (see get_scope_item_ids). Scope is applied as a
+    row mask inside the vector store, not as an IN (...) list.
+    quantization (None or "int8") switches the store's search mode; see
+    load_vector_store.
+
+    Ranked hits are cached in memory and in the searchCache table, keyed by
+    the query embedding and the search parameters, until the next sync,
+    embedding run or garbage collection bumps the library generation.
+
+    rerank=True retrieves max(top_k, rerank_candidates) candidates and
+    re-orders them with a cross-encoder within rerank_budget_s seconds (see
+    cross_encoder_rerank()) before keeping the top_k.
+
+    workers > 1 searches large scopes (e.g. "All Documents") exactly, shard
+    by shard, in that many threads.
+
+    For results that show up before their context is parsed, see
+    search_hits_page() / iter_vector_db_search().
+    """
+
+    os.environ["TRANSFORMERS_OFFLINE"] = "1"
+
+    conn = connect_db(db_path)
+    c = conn.cursor()
+
+    n_candidates = max(top_k, rerank_candidates) if rerank else top_k
+
+    # 1-2. Ranked hits, from the cache or the vector store
+    hits = _ranked_hits(conn, db_path, query_str, collection_name, n_candidates, model_name,
+                        recursive, filters, quantization, workers)
+
+    # 3. Reconstruct snippet text for each candidate
+    file_keys = []
+    texts = []
+    for snippet_id, item_id, chunk_idx, _ in hits:
         c.execute("SELECT key FROM items WHERE itemID=?", (item_id,))
         row_k = c.fetchone()
-        if not row_k:
-            continue
-        file_key = row_k[0]
-
-        snippet_text = re_chunk_file(file_key, chunk_size, chunk_idx)
-        snippet_text = snippet_text if snippet_text else "(No snippet text found)"
-
-        # Check if result already exists
-        c.execute("""
-            SELECT 1 FROM search_results
-            WHERE snippetID = ? AND query = ? AND collection_name = ?
-        """, (snippet_id, query_str, collection_name))
-        if not c.fetchone():
-            c.execute("""
-                INSERT INTO search_results (queryID, snippetID, query, matched_word, context, collection_name)
-                VALUES (?,?, ?, ?, ?, ?)
-            """, (0,snippet_id, query_str, query_str, snippet_text, collection_name))
+        file_keys.append(row_k[0] if row_k else None)
+        texts.append(re_chunk_file(row_k[0], chunk_size, chunk_idx) if row_k else None)
 
+    # 4. Optionally re-rank the candidates with a cross-encoder
+    order = list(range(len(hits)))
+    if rerank and hits:
+        order = cross_encoder_rerank(query_str, texts, rerank_model, rerank_budget_s)
+    order = order[:top_k]
+
+    # 5. Insert results (one batch, skipping ones already stored) + return
+    results = []
+    for i in order:
+        if file_keys[i] is None:
+            continue
+        snippet_text = texts[i] if texts[i] else "(No snippet text found)"
         results.append({
-            "snippetID": snippet_id,
+            "snippetID": hits[i][0],
             "matched_word": query_str,
-            "context": snippet_text
+            "context": snippet_text,
+            "score": hits[i][3],
         })
 
+    _store_search_results(c, query_str, collection_name, results)
     conn.commit()
     conn.close()
     return results
 
+
+def _ranked_hits(conn, db_path, query_str, collection_name, n, model_name, recursive, filters, quantization, workers=1):
+    """
+    Top-n (snippetID, itemID, chunkIndex, score) for a query, best first,
+    through the search cache.
+    """
+    c = conn.cursor()
+    q_vec = embed_query(query_str, model_name)
+    generation = get_library_generation(conn)
+    cache_key = _search_cache_key(q_vec, model_name, collection_name, n, recursive, filters, quantization)
+    hits = _get_cached_hits(c, cache_key, generation)
+    if hits is None:
+        hits = _search_hits(c, db_path, q_vec, collection_name, n, model_name, recursive, filters, quantization, workers)
+        _put_cached_hits(c, cache_key, generation, hits)
+        conn.commit()
+    return hits
+
+
+def _search_hits(c, db_path, q_vec, collection_name, top_k, model_name, recursive, filters, quantization, workers=1):
+    """
+    Ranked (snippetID, itemID, chunkIndex, score) hits for a query vector.
+    """
+    item_ids = get_scope_item_ids(c, collection_name, recursive, filters)
+    if item_ids is not None and not item_ids:
+        return []
+    scored = search_vector_stores(db_path, model_name, q_vec, top_k, item_ids, quantization, workers)
+    return [hit + (round(float(score), 6),) for score, hit in scored]
+
+
+STORE_SEARCH_RESULT_SQL = """
+    INSERT INTO search_results (queryID, snippetID, query, matched_word, context, collection_name)
+    SELECT ?, ?, ?, ?, ?, ?
+    WHERE NOT EXISTS (
+        SELECT 1 FROM search_results
+        WHERE snippetID = ? AND query = ? AND collection_name = ?
+    )
+"""
+
+
+def _store_search_results(c, query_str, collection_name, results):
+    c.executemany(STORE_SEARCH_RESULT_SQL, [
+        (0, r["snippetID"], query_str, query_str, r["context"], collection_name,
+         r["snippetID"], query_str, collection_name)
+        for r in results
+    ])
+
+###############################################################################
+# Paged search with lazy context
+###############################################################################
+
+# Deepest rank a cursor can page to. Every page slices one ranking of this
+# many hits, cached under one key: the approximate search's top n depends
+# on n, so ranking each page separately would repeat and skip hits.
+MAX_PAGED_RESULTS = 1000
+
+
+def search_hits_page(db_path, collection_name, query_str, cursor=None, page_size=20,
+                     model_name="sentence-transformers/all-MiniLM-L6-v2", recursive=False, filters=None,
+                     quantization=False, workers=1):
+    """
+    One page of ranked hits without their context. The first page ranks
+    MAX_PAGED_RESULTS hits and later pages slice the cached ranking, so
+    paging costs no further vector search and no document parsing. Returns
+        {"hits": [{rank, snippetID, itemID, chunkIndex, score, document}, ...],
+         "next_cursor": str or None}
+    Pass next_cursor back to get the following page. Fill in context for the
+    hits actually shown with fill_search_page().
+    """
+    os.environ["TRANSFORMERS_OFFLINE"] = "1"
+    offset = int(cursor) if cursor else 0
+    page_size = int(page_size)
+    if offset < 0 or page_size <= 0:
+        raise ValueError("cursor must be >= 0 and page_size > 0")
+    n = min(offset + page_size, MAX_PAGED_RESULTS)
+
+    conn = connect_db(db_path)
+    try:
+        c = conn.cursor()
+        hits = _ranked_hits(conn, db_path, query_str, collection_name, MAX_PAGED_RESULTS, model_name,
+                            recursive, filters, quantization, workers)
+        page = []
+        for rank, (snippet_id, item_id, chunk_idx, score) in enumerate(hits[offset:n], start=offset + 1):
+            c.execute("SELECT key FROM items WHERE itemID=?", (item_id,))
+            row_k = c.fetchone()
+            if not row_k:
+                continue
+            page.append({
+                "rank": rank,
+                "snippetID": snippet_id,
+                "itemID": item_id,
+                "chunkIndex": chunk_idx,
+                "score": score,
+                "document": os.path.basename(row_k[0]) if row_k[0] else "(No Name)",
+            })
+    finally:
+        conn.close()
+
+    more = len(hits) > n
+    return {"hits": page, "next_cursor": str(n) if more else None}
+
+
+def fill_search_page(db_path, collection_name, query_str, snippet_ids, chunk_size=50):
+    """
+    Reconstructs the context of the given snippets, records them in
+    search_results like vector_db_search does, and returns
+    [{snippetID, matched_word, context}, ...] in the order given.
+    """
+    if isinstance(snippet_ids, (int, np.integer)):
+        snippet_ids = [snippet_ids]
+    conn = connect_db(db_path)
+    try:
+        c = conn.cursor()
+        results = []
+        for snippet_id in snippet_ids:
+            context = _snippet_context(c, int(snippet_id), chunk_size)
+            if context is None:
+                continue
+            results.append({"snippetID": int(snippet_id), "matched_word": query_str, "context": context})
+        _store_search_results(c, query_str, collection_name, results)
+        conn.commit()
+    finally:
+        conn.close()
+    return results
+
+
+def _snippet_context(c, snippet_id, chunk_size):
+    c.execute("""
+        SELECT items.key, documentEmbeddings.chunkIndex
+        FROM documentEmbeddings
+        JOIN items ON items.itemID = documentEmbeddings.itemID
+        WHERE documentEmbeddings.snippetID = ?
+    """, (snippet_id,))
+    row = c.fetchone()
+    if not row:
+        return None
+    return re_chunk_file(row[0], chunk_size, row[1]) or "(No snippet text found)"
+
+
+def iter_vector_db_search(db_path, collection_name, query_str, page_size=20, cursor=None, chunk_size=50,
+                          with_context=True, model_name="sentence-transformers/all-MiniLM-L6-v2",
+                          recursive=False, filters=None, quantization=False, workers=1):
+    """
+    Generator over ranked hits, best first, fetching one page at a time from
+    `cursor`. Each hit is a search_hits_page() dict plus "next_cursor" (where
+    to resume after its page) and "context". With with_context=True the
+    context is parsed just before that hit is yielded, so the first hit does
+    not wait for the rest; with False it is left as None. Closing the
+    generator early (or an error) closes its database connection.
+    """
+    conn = None
+    try:
+        while True:
+            page = search_hits_page(db_path, collection_name, query_str, cursor, page_size,
+                                    model_name, recursive, filters, quantization, workers)
+            for hit in page["hits"]:
+                hit["next_cursor"] = page["next_cursor"]
+                hit["context"] = None
+                if with_context:
+                    if conn is None:
+                        conn = connect_db(db_path)
+                    hit["context"] = _snippet_context(conn.cursor(), hit["snippetID"], chunk_size)
+                yield hit
+            cursor = page["next_cursor"]
+            if cursor is None:
+                break
+    finally:
+        if conn is not None:
+            conn.close()
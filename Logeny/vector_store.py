@@ -0,0 +1,935 @@
+import heapq
+import io
+import json
+import os
+import re
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from db_schema import bump_library_generation, connect_db
+
+DEFAULT_EMBEDDING_MODEL = "sentence-transformers/all-MiniLM-L6-v2"
+
+STORE_FORMAT_VERSION = 1
+
+# Compact a store (and rebuild its graph) once this share of rows is dead.
+COMPACT_DEAD_FRACTION = 0.2
+
+# When a filter leaves at most this many candidate rows, a flat scan over
+# them is both exact and cheaper than walking the graph.
+EXACT_SEARCH_MAX_ROWS = 5000
+
+# Quantized stores shortlist max(top_k * RERANK_FACTOR, RERANK_MIN) rows on
+# the 8-bit codes, then re-rank them with the full float32 vectors.
+RERANK_FACTOR = 8
+RERANK_MIN = 64
+QUANT_BLOCK_ROWS = 65536
+
+# Full vectors are read from the memmapped vectors.npy this many rows at a
+# time (graph building, norms, quantizer fitting, compaction), so no step
+# holds a float32 copy of the whole store.
+SCAN_BLOCK_ROWS = 65536
+
+# Parallel search splits the vectors into shards of this many rows,
+# and only kicks in once at least PARALLEL_MIN_ROWS rows are in scope (below
+# that, thread overhead outweighs the scan).
+SHARD_ROWS = 50000
+PARALLEL_MIN_ROWS = 100000
+
+###############################################################################
+# HNSWIndex with Cosine Distance
+###############################################################################
+
+def _row_norms(vectors):
+    norms = np.empty(len(vectors), dtype=np.float32)
+    for b in range(0, len(vectors), SCAN_BLOCK_ROWS):
+        block = np.asarray(vectors[b:b + SCAN_BLOCK_ROWS], dtype=np.float32)
+        norms[b:b + len(block)] = np.linalg.norm(block, axis=1)
+    norms[norms == 0] = 1.0
+    return norms
+
+
+class HNSWIndex:
+    """
+    Neighbour graph over cosine distance. Node i links to its M nearest
+    earlier nodes, and each of those links back, replacing its farthest link
+    once it already has M.
+    The graph is a fixed-width int32 array padded with -1 so it can be saved
+    next to the vectors and reloaded without rebuilding.
+    """
+
+    SEED_COUNT = 256
+    SEED_ENTRIES = 16
+
+    def __init__(self, dim, M=16, ef=50):
+        self.dim = dim
+        self.M = M
+        self.ef = ef
+        self.vectors = np.zeros((0, dim), dtype=np.float32)
+        self.norms = np.zeros(0, dtype=np.float32)
+        self.ids = []
+        self.graph = np.full((0, M), -1, dtype=np.int32)
+
+    @classmethod
+    def from_arrays(cls, vectors, graph, ids=None, ef=50, norms=None):
+        index = cls(vectors.shape[1], M=graph.shape[1], ef=ef)
+        index.vectors = vectors
+        index.norms = _row_norms(vectors) if norms is None else np.asarray(norms, dtype=np.float32)
+        index.ids = list(range(len(vectors))) if ids is None else list(ids)
+        index.graph = np.array(graph, dtype=np.int32)
+        return index
+
+    def __len__(self):
+        return len(self.vectors)
+
+    def _distances(self, qvec, nodes):
+        qnorm = np.linalg.norm(qvec) or 1.0
+        sims = (self.vectors[nodes] @ qvec) / (self.norms[nodes] * qnorm)
+        return 1.0 - sims
+
+    def add_items(self, vectors, ids, block_size=64):
+        """Appends in-memory vectors and links them into the graph."""
+        vectors = np.asarray(vectors, dtype=np.float32).reshape(-1, self.dim)
+        if len(vectors) == 0:
+            return
+        self.link_items(np.vstack([self.vectors, vectors]) if len(self.vectors) else vectors, ids, block_size)
+
+    def link_items(self, all_vectors, ids, block_size=64):
+        """
+        Links rows len(self) onwards of all_vectors, which holds the current
+        vectors followed by the new ones (e.g. vectors.npy reopened after
+        appending to it), and makes all_vectors the index's vectors. Earlier
+        rows are read SCAN_BLOCK_ROWS at a time, so a memmap is never copied
+        into memory as a whole.
+        """
+        start, n = len(self.vectors), len(all_vectors)
+        if n <= start:
+            return
+        norms = np.concatenate([self.norms, _row_norms(all_vectors[start:n])])
+        graph = np.vstack([self.graph, np.full((n - start, self.M), -1, dtype=np.int32)])
+        degree = (graph >= 0).sum(axis=1)
+
+        for b_start in range(start, n, block_size):
+            b_end = min(b_start + block_size, n)
+            block = np.asarray(all_vectors[b_start:b_end], dtype=np.float32)
+            block_rows = np.arange(b_start, b_end)
+            # The M closest earlier rows of each block row, merged slab by slab.
+            best_d = np.full((len(block), self.M), np.inf, dtype=np.float32)
+            best_i = np.full((len(block), self.M), -1, dtype=np.int64)
+            for s_start in range(0, b_end, SCAN_BLOCK_ROWS):
+                s_end = min(s_start + SCAN_BLOCK_ROWS, b_end)
+                slab = np.asarray(all_vectors[s_start:s_end], dtype=np.float32)
+                dists = 1.0 - (block @ slab.T) / (norms[b_start:b_end, None] * norms[None, s_start:s_end])
+                cols = np.arange(s_start, s_end)
+                if s_end > b_start:
+                    dists[cols[None, :] >= block_rows[:, None]] = np.inf
+                merged_d = np.hstack([best_d, dists])
+                merged_i = np.hstack([best_i, np.broadcast_to(cols, dists.shape)])
+                top = np.argpartition(merged_d, self.M - 1, axis=1)[:, :self.M]
+                best_d = np.take_along_axis(merged_d, top, axis=1)
+                best_i = np.take_along_axis(merged_i, top, axis=1)
+
+            for r, idx in enumerate(block_rows):
+                if idx == 0:
+                    continue
+                k = min(self.M, idx)
+                order = np.argsort(best_d[r])[:k]
+                neighbors = best_i[r, order]
+                graph[idx, :k] = neighbors
+                degree[idx] = k
+                for nbr, dist in zip(neighbors, best_d[r, order]):
+                    if degree[nbr] < self.M:
+                        graph[nbr, degree[nbr]] = idx
+                        degree[nbr] += 1
+                        continue
+                    # Full: swap out nbr's farthest link if idx is closer.
+                    links = graph[nbr]
+                    link_vecs = np.asarray(all_vectors[links], dtype=np.float32)
+                    nbr_vec = np.asarray(all_vectors[nbr], dtype=np.float32)
+                    link_sims = (link_vecs @ nbr_vec) / (norms[links] * norms[nbr])
+                    worst = int(np.argmin(link_sims))
+                    if 1.0 - link_sims[worst] > dist:
+                        graph[nbr, worst] = idx
+
+        self.vectors = all_vectors
+        self.norms = norms
+        self.graph = graph
+        self.ids.extend(ids)
+
+    def search(self, qvec, top_k=5, allowed=None):
+        """
+        Returns the ids of the top_k nearest nodes. `allowed` is an optional
+        boolean mask over nodes; masked-out nodes are still walked through but
+        never returned.
+        """
+        n = len(self.vectors)
+        if n == 0:
+            return []
+        qvec = np.asarray(qvec, dtype=np.float32)
+
+        candidates = np.flatnonzero(allowed) if allowed is not None else None
+        n_candidates = n if candidates is None else len(candidates)
+        if n_candidates == 0:
+            return []
+        if n_candidates <= max(EXACT_SEARCH_MAX_ROWS, top_k):
+            return self._exact_search(qvec, top_k, candidates if candidates is not None else np.arange(n))
+
+        ef = max(self.ef, top_k)
+        visited = np.zeros(n, dtype=bool)
+
+        # Evenly spaced seed nodes act as a coarse top layer: start from the
+        # few closest so the walk isn't stuck in the cluster node 0 sits in.
+        seeds = np.arange(0, n, max(1, n // max(self.SEED_COUNT, n // 32)))
+        seed_dists = self._distances(qvec, seeds)
+        order = np.argsort(seed_dists)[:self.SEED_ENTRIES]
+        visited[seeds] = True
+        frontier = [(float(seed_dists[i]), int(seeds[i])) for i in order]
+        heapq.heapify(frontier)
+        results = []  # max-heap (negated distance) of the best ef allowed nodes
+        for i in range(len(seeds)):
+            if allowed is None or allowed[seeds[i]]:
+                heapq.heappush(results, (-float(seed_dists[i]), int(seeds[i])))
+                if len(results) > ef:
+                    heapq.heappop(results)
+
+        while frontier:
+            dist, node = heapq.heappop(frontier)
+            if len(results) >= ef and dist > -results[0][0]:
+                break
+            nbrs = self.graph[node]
+            nbrs = nbrs[nbrs >= 0]
+            nbrs = nbrs[~visited[nbrs]]
+            if len(nbrs) == 0:
+                continue
+            visited[nbrs] = True
+            for d_nbr, nbr in zip(self._distances(qvec, nbrs), nbrs):
+                d_nbr = float(d_nbr)
+                if len(results) < ef or d_nbr < -results[0][0]:
+                    heapq.heappush(frontier, (d_nbr, int(nbr)))
+                    if allowed is None or allowed[nbr]:
+                        heapq.heappush(results, (-d_nbr, int(nbr)))
+                        if len(results) > ef:
+                            heapq.heappop(results)
+
+        if len(results) < top_k:
+            # The walk ran out of reachable nodes; finish exactly.
+            return self._exact_search(qvec, top_k, candidates if candidates is not None else np.arange(n))
+
+        results.sort(key=lambda x: -x[0])
+        return [self.ids[node] for _, node in results[:top_k]]
+
+    def _exact_search(self, qvec, top_k, candidates):
+        dists = self._distances(qvec, candidates)
+        k = min(top_k, len(candidates))
+        best = np.argpartition(dists, k - 1)[:k]
+        best = best[np.argsort(dists[best])]
+        return [self.ids[int(candidates[i])] for i in best]
+
+###############################################################################
+# 8-bit scalar quantization
+###############################################################################
+
+def _fit_scalar_quantizer(vectors):
+    """
+    Per-dimension (scale, lo) mapping [min, max] onto the 256 code values.
+    """
+    lo = np.full(vectors.shape[1], np.inf, dtype=np.float32)
+    hi = np.full(vectors.shape[1], -np.inf, dtype=np.float32)
+    for b in range(0, len(vectors), SCAN_BLOCK_ROWS):
+        block = np.asarray(vectors[b:b + SCAN_BLOCK_ROWS], dtype=np.float32)
+        np.minimum(lo, block.min(axis=0), out=lo)
+        np.maximum(hi, block.max(axis=0), out=hi)
+    scale = (hi - lo) / 255.0
+    scale[scale == 0] = 1.0
+    return scale, lo
+
+
+def _encode_scalar(vectors, scale, lo):
+    codes = np.empty(vectors.shape, dtype=np.uint8)
+    for b in range(0, len(vectors), QUANT_BLOCK_ROWS):
+        block = np.asarray(vectors[b:b + QUANT_BLOCK_ROWS], dtype=np.float32)
+        # Vectors appended after fitting can fall outside [lo, hi]; clip them.
+        codes[b:b + len(block)] = np.clip(np.rint((block - lo) / scale), 0, 255)
+    return codes
+
+###############################################################################
+# Sharded parallel search
+###############################################################################
+
+_shard_pool = None
+_shard_pool_workers = 0
+
+
+def _search_shard(vectors, norms, start, end, qvec, top_k, allowed):
+    """
+    Exact cosine top_k over rows [start, end) of vectors; returns
+    [(similarity, row), ...].
+    """
+    rows = np.arange(start, end) if allowed is None else start + np.flatnonzero(allowed)
+    if len(rows) == 0:
+        return []
+    block = np.asarray(vectors[start:end] if allowed is None else vectors[rows], dtype=np.float32)
+    sims = (block @ qvec) / (norms[rows] * (np.linalg.norm(qvec) or 1.0))
+    k = min(top_k, len(rows))
+    best = np.argpartition(-sims, k - 1)[:k]
+    return [(float(sims[i]), int(rows[i])) for i in best]
+
+
+def _get_shard_pool(workers):
+    global _shard_pool, _shard_pool_workers
+    if _shard_pool is None or _shard_pool_workers != workers:
+        shutdown_shard_pool()
+        _shard_pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="shard-search")
+        _shard_pool_workers = workers
+    return _shard_pool
+
+
+def shutdown_shard_pool():
+    global _shard_pool, _shard_pool_workers
+    if _shard_pool is not None:
+        _shard_pool.shutdown(wait=False, cancel_futures=True)
+    _shard_pool = None
+    _shard_pool_workers = 0
+
+
+def parallel_shard_search(vectors, qvec, top_k=5, allowed=None, workers=None, norms=None):
+    """
+    Exact top_k over vectors (typically the store's memmapped vectors.npy),
+    split into SHARD_ROWS-row shards searched in a thread pool. numpy
+    releases the GIL in the matrix products, so shards run in parallel
+    without spawning processes, which hangs under reticulate on platforms
+    that start workers by re-running the interpreter. Returns row numbers
+    best first.
+    """
+    workers = workers or os.cpu_count() or 1
+    n = len(vectors) if allowed is None else min(len(vectors), len(allowed))
+    norms = _row_norms(vectors) if norms is None else norms
+    qvec = np.asarray(qvec, dtype=np.float32)
+
+    pool = _get_shard_pool(workers)
+    futures = []
+    for start in range(0, n, SHARD_ROWS):
+        end = min(start + SHARD_ROWS, n)
+        shard_allowed = None
+        if allowed is not None:
+            shard_allowed = allowed[start:end]
+            if not shard_allowed.any():
+                continue
+            if shard_allowed.all():
+                shard_allowed = None
+        futures.append(pool.submit(_search_shard, vectors, norms, start, end, qvec, top_k, shard_allowed))
+    hits = []
+    for future in futures:
+        hits.extend(future.result())
+    return [row for _, row in heapq.nlargest(top_k, hits)]
+
+###############################################################################
+# Consolidated vector store
+###############################################################################
+
+def get_vector_store_dir(db_path, model_name=DEFAULT_EMBEDDING_MODEL):
+    db_folder = os.path.dirname(os.path.abspath(db_path))
+    return os.path.join(db_folder, "embedding_data", "store", model_name.replace("/", "_"))
+
+
+def get_snapshot_store_dir(db_path, model_name=DEFAULT_EMBEDDING_MODEL):
+    db_folder = os.path.dirname(os.path.abspath(db_path))
+    return os.path.join(db_folder, "embedding_data", "snapshot", model_name.replace("/", "_"))
+
+
+def _append_vectors(path, vectors, keep_rows):
+    """
+    Writes vectors after the first keep_rows rows of the float32 matrix saved
+    at path, overwriting anything past them (rows of an append that save()
+    never recorded). Only the new rows and the .npy header are written; the
+    existing rows are not read.
+    """
+    vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+    if keep_rows == 0 or not os.path.exists(path):
+        np.save(path, vectors)
+        return
+    fmt = np.lib.format
+    shape = (keep_rows + len(vectors), vectors.shape[1])
+    with open(path, "r+b") as f:
+        version = fmt.read_magic(f)
+        read_header, write_header = ((fmt.read_array_header_1_0, fmt.write_array_header_1_0) if version == (1, 0)
+                                     else (fmt.read_array_header_2_0, fmt.write_array_header_2_0))
+        old_shape, fortran_order, dtype = read_header(f)
+        offset = f.tell()
+        if fortran_order or dtype != np.float32 or old_shape[1:] != shape[1:] or old_shape[0] < keep_rows:
+            raise ValueError(f"{path} does not hold the store's {keep_rows} x {shape[1]} float32 vectors.")
+        header = io.BytesIO()
+        write_header(header, {"descr": fmt.dtype_to_descr(dtype), "fortran_order": False, "shape": shape})
+        if len(header.getvalue()) == offset:
+            # Rows first, header last: a crash in between leaves the old shape.
+            f.seek(offset + keep_rows * vectors.shape[1] * vectors.itemsize)
+            f.write(vectors.tobytes())
+            if old_shape[0] > shape[0]:
+                f.truncate()
+            f.seek(0)
+            f.write(header.getvalue())
+            return
+
+    # The header has no room for the new row count; copy into a new file.
+    tmp_path = path[:-len(".npy")] + ".grow.npy"
+    old = np.load(path, mmap_mode="r")
+    out = np.lib.format.open_memmap(tmp_path, mode="w+", dtype=np.float32, shape=shape)
+    for b in range(0, keep_rows, SCAN_BLOCK_ROWS):
+        out[b:min(b + SCAN_BLOCK_ROWS, keep_rows)] = old[b:min(b + SCAN_BLOCK_ROWS, keep_rows)]
+    out[keep_rows:] = vectors
+    out.flush()
+    del out, old
+    os.replace(tmp_path, path)
+
+
+class VectorStore:
+    """
+    Every snippet vector for one embedding model in a single matrix, with the
+    row -> (snippetID, itemID, chunkIndex) map, a live-row mask and the HNSW
+    graph. The per-snippet .npy files written by generate_document_embeddings
+    stay the source of truth; a store can always be rebuilt from them.
+
+    With quantization="int8" the store also keeps one uint8 code per vector
+    dimension in memory (4x smaller than float32) and searches on those,
+    reading only the shortlisted rows from the memmapped full vectors.
+
+    A store whose meta.json names a snapshot_path is a read-only segment over
+    an imported index snapshot (see index_snapshot.py): vectors and graph are
+    memory-mapped from the snapshot file, only rows and alive are local.
+    """
+
+    QUANTIZATIONS = (None, "int8")
+
+    def __init__(self, store_dir, model_name, M=16):
+        self.store_dir = store_dir
+        self.model_name = model_name
+        self.M = M
+        self.rows = np.zeros((0, 3), dtype=np.int64)
+        self.alive = np.zeros(0, dtype=bool)
+        self.index = None
+        self.high_water = 0
+        # Vectors are written to disk as they are appended; after compact()
+        # they go to vectors.compact.npy until save() swaps it in.
+        self._vectors_name = "vectors"
+        self._codes_dirty = False
+        self._item_order = None
+        self._sorted_items = None
+        self.quantization = None
+        self.codes = None
+        self.quant_scale = None
+        self.quant_lo = None
+        self.snapshot_path = None
+
+    def _vectors_path(self):
+        return os.path.join(self.store_dir, self._vectors_name + ".npy")
+
+    @property
+    def read_only(self):
+        return self.snapshot_path is not None
+
+    @property
+    def size(self):
+        return len(self.rows)
+
+    @property
+    def snippet_ids(self):
+        return self.rows[:, 0]
+
+    @property
+    def item_ids(self):
+        return self.rows[:, 1]
+
+    @property
+    def chunk_indices(self):
+        return self.rows[:, 2]
+
+    @property
+    def dead_fraction(self):
+        if self.size == 0:
+            return 0.0
+        return float((~self.alive).sum()) / self.size
+
+    def item_mask(self, item_ids):
+        """
+        Boolean row mask for the given itemIDs. Uses a sorted itemID -> row
+        index, so the cost grows with the number of matching rows rather than
+        needing one SQL placeholder per item.
+        """
+        if self._item_order is None:
+            self._item_order = np.argsort(self.item_ids, kind="stable")
+            self._sorted_items = self.item_ids[self._item_order]
+        ids = np.unique(np.asarray(list(item_ids), dtype=np.int64))
+        lo = np.searchsorted(self._sorted_items, ids, side="left")
+        hi = np.searchsorted(self._sorted_items, ids, side="right")
+        lengths = hi - lo
+        starts = np.repeat(lo, lengths)
+        offsets = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+        mask = np.zeros(self.size, dtype=bool)
+        mask[self._item_order[starts + offsets]] = True
+        return mask
+
+    @classmethod
+    def load(cls, store_dir, model_name):
+        store = cls(store_dir, model_name)
+        meta_path = os.path.join(store_dir, "meta.json")
+        if not os.path.exists(meta_path):
+            return store
+        with open(meta_path, "r") as f:
+            meta = json.load(f)
+        if meta.get("format_version") != STORE_FORMAT_VERSION:
+            print(f"Ignoring vector store in {store_dir}: unsupported format {meta.get('format_version')}")
+            return store
+
+        store.M = meta["M"]
+        store.high_water = meta.get("high_water", 0)
+        store.rows = np.load(os.path.join(store_dir, "rows.npy"))
+        store.alive = np.load(os.path.join(store_dir, "alive.npy"))
+        if meta.get("snapshot_path"):
+            from index_snapshot import open_snapshot_arrays
+            store.snapshot_path = meta["snapshot_path"]
+            try:
+                _, arrays = open_snapshot_arrays(store.snapshot_path)
+            except (OSError, ValueError) as e:
+                print(f"Snapshot {store.snapshot_path} unavailable ({e}); skipping it.")
+                store.rows = np.zeros((0, 3), dtype=np.int64)
+                store.alive = np.zeros(0, dtype=bool)
+                return store
+            store.index = HNSWIndex.from_arrays(arrays["vectors"], arrays["graph"], norms=arrays["norms"])
+            return store
+        # Rows past len(rows) are from an append that was never saved.
+        vectors = np.load(os.path.join(store_dir, "vectors.npy"), mmap_mode="r")[:len(store.rows)]
+        graph = np.load(os.path.join(store_dir, "graph.npy"))
+        store.index = HNSWIndex.from_arrays(vectors, graph)
+        store.quantization = meta.get("quantization")
+        if store.quantization and os.path.exists(os.path.join(store_dir, "codes.npy")):
+            store.codes = np.load(os.path.join(store_dir, "codes.npy"))
+            store.quant_scale, store.quant_lo = np.load(os.path.join(store_dir, "quant.npy"))
+        return store
+
+    def _save_array(self, name, arr):
+        tmp_path = os.path.join(self.store_dir, name + ".tmp.npy")
+        np.save(tmp_path, arr)
+        os.replace(tmp_path, os.path.join(self.store_dir, name + ".npy"))
+
+    def save(self):
+        os.makedirs(self.store_dir, exist_ok=True)
+        if self.index is None:
+            return
+        if self.read_only:
+            # Vectors and graph live in the snapshot file.
+            self._codes_dirty = False
+        if self._vectors_name != "vectors":
+            os.replace(self._vectors_path(), os.path.join(self.store_dir, "vectors.npy"))
+            self._vectors_name = "vectors"
+        if self._codes_dirty:
+            for name in ("codes", "quant"):
+                path = os.path.join(self.store_dir, name + ".npy")
+                if os.path.exists(path):
+                    os.remove(path)
+            if self.quantization and self.codes is not None:
+                self._save_array("codes", self.codes)
+                self._save_array("quant", np.stack([self.quant_scale, self.quant_lo]))
+            self._codes_dirty = False
+        if not self.read_only:
+            self._save_array("graph", self.index.graph)
+        self._save_array("rows", self.rows)
+        self._save_array("alive", self.alive)
+        meta = {
+            "format_version": STORE_FORMAT_VERSION,
+            "model_name": self.model_name,
+            "dim": self.index.dim,
+            "M": self.M,
+            "size": self.size,
+            "high_water": int(self.high_water),
+            "quantization": self.quantization,
+            "snapshot_path": self.snapshot_path,
+        }
+        with open(os.path.join(self.store_dir, "meta.json"), "w") as f:
+            json.dump(meta, f)
+
+    def append(self, vectors, rows):
+        """
+        Adds vectors with their (snippetID, itemID, chunkIndex) rows and links
+        them into the graph. The vectors are appended to the file on disk and
+        the memmap reopened; only codes, norms and graph grow in memory.
+        """
+        vectors = np.asarray(vectors, dtype=np.float32)
+        rows = np.asarray(rows, dtype=np.int64).reshape(-1, 3)
+        if len(rows) == 0:
+            return
+        if self.read_only:
+            raise RuntimeError(f"Vector store {self.store_dir} is a read-only snapshot segment.")
+        if self.index is None:
+            self.index = HNSWIndex(vectors.shape[1], M=self.M)
+        start = self.size
+        os.makedirs(self.store_dir, exist_ok=True)
+        _append_vectors(self._vectors_path(), vectors, start)
+        self.index.link_items(np.load(self._vectors_path(), mmap_mode="r"), list(range(start, start + len(rows))))
+        self.rows = np.vstack([self.rows, rows])
+        self.alive = np.concatenate([self.alive, np.ones(len(rows), dtype=bool)])
+        self.high_water = max(self.high_water, int(rows[:, 0].max()))
+        if self.quantization:
+            if self.quant_scale is None:
+                self.quant_scale, self.quant_lo = _fit_scalar_quantizer(vectors)
+            new_codes = _encode_scalar(vectors, self.quant_scale, self.quant_lo)
+            self.codes = new_codes if self.codes is None else np.vstack([self.codes, new_codes])
+        self._codes_dirty = True
+        self._item_order = None
+
+    def mark_dead(self, snippet_ids):
+        """
+        Marks rows for the given snippetIDs as deleted. Returns how many live
+        rows were affected.
+        """
+        dead = self.alive & np.isin(self.snippet_ids, np.asarray(list(snippet_ids), dtype=np.int64))
+        self.alive[dead] = False
+        return int(dead.sum())
+
+    def compact(self):
+        """
+        Drops dead rows and rebuilds the graph over what is left. Live vectors
+        are copied block by block into vectors.compact.npy, which save()
+        moves over vectors.npy.
+        """
+        if self.index is None or self.read_only:
+            return
+        keep = np.flatnonzero(self.alive)
+        old = self.index.vectors
+        os.makedirs(self.store_dir, exist_ok=True)
+        self._vectors_name = "vectors.compact"
+        out = np.lib.format.open_memmap(self._vectors_path(), mode="w+", dtype=np.float32,
+                                        shape=(len(keep), self.index.dim))
+        for b in range(0, len(keep), SCAN_BLOCK_ROWS):
+            out[b:b + SCAN_BLOCK_ROWS] = old[keep[b:b + SCAN_BLOCK_ROWS]]
+        out.flush()
+        del out, old
+        vectors = np.load(self._vectors_path(), mmap_mode="r")
+
+        self.rows = self.rows[keep]
+        self.alive = np.ones(len(self.rows), dtype=bool)
+        self.index = HNSWIndex(self.index.dim, M=self.M, ef=self.index.ef)
+        self.index.link_items(vectors, list(range(len(vectors))))
+        if self.quantization and len(vectors):
+            self.quant_scale, self.quant_lo = _fit_scalar_quantizer(vectors)
+            self.codes = _encode_scalar(vectors, self.quant_scale, self.quant_lo)
+        elif self.quantization:
+            self.codes = self.quant_scale = self.quant_lo = None
+        self._codes_dirty = True
+        self._item_order = None
+
+    def set_quantization(self, quantization):
+        """
+        Switches the store between full-precision search (None) and 8-bit
+        scalar-quantized search ("int8"), re-encoding every vector.
+        """
+        if quantization not in self.QUANTIZATIONS:
+            raise ValueError(f"Unsupported quantization {quantization!r}; expected one of {self.QUANTIZATIONS}")
+        if quantization == self.quantization:
+            return
+        if self.read_only:
+            raise RuntimeError(f"Vector store {self.store_dir} is a read-only snapshot segment.")
+        self.quantization = quantization
+        self.codes = self.quant_scale = self.quant_lo = None
+        if quantization and self.index is not None and self.size:
+            self.quant_scale, self.quant_lo = _fit_scalar_quantizer(self.index.vectors)
+            self.codes = _encode_scalar(self.index.vectors, self.quant_scale, self.quant_lo)
+        self._codes_dirty = True
+
+    def search(self, qvec, top_k=5, allowed=None, workers=1):
+        """
+        Returns the top_k nearest row numbers, restricted to `allowed` if
+        given. Quantized stores score every candidate on the codes, then
+        re-rank a shortlist exactly; others use the HNSW index.
+
+        workers > 1 scans large scopes exactly, shard by shard, in a thread
+        pool instead (see parallel_shard_search).
+        """
+        if self.index is None or self.size == 0:
+            return []
+        n_candidates = self.size if allowed is None else int(np.count_nonzero(allowed))
+        if workers > 1 and n_candidates >= PARALLEL_MIN_ROWS:
+            return parallel_shard_search(self.index.vectors, qvec, top_k, allowed, workers, self.index.norms)
+        if not self.quantization:
+            return self.index.search(qvec, top_k, allowed)
+
+        candidates = np.flatnonzero(allowed) if allowed is not None else np.arange(self.size)
+        if len(candidates) == 0:
+            return []
+        qvec = np.asarray(qvec, dtype=np.float32)
+
+        # q . x  ~=  q . lo + (q * scale) . code, scored block by block.
+        q_scaled = qvec * self.quant_scale
+        scores = np.empty(len(candidates), dtype=np.float32)
+        for b in range(0, len(candidates), QUANT_BLOCK_ROWS):
+            block = candidates[b:b + QUANT_BLOCK_ROWS]
+            scores[b:b + len(block)] = self.codes[block].astype(np.float32) @ q_scaled
+        scores += float(qvec @ self.quant_lo)
+        scores /= self.index.norms[candidates]
+
+        k = min(len(candidates), max(top_k * RERANK_FACTOR, RERANK_MIN))
+        shortlist = np.sort(candidates[np.argpartition(-scores, k - 1)[:k]])
+        return self.index._exact_search(qvec, top_k, shortlist)
+
+
+# One store object per directory, shared by search and garbage collection.
+_open_stores = {}
+
+
+def _open_store(store_dir, model_name):
+    store = _open_stores.get(store_dir)
+    if store is None:
+        store = VectorStore.load(store_dir, model_name)
+        _open_stores[store_dir] = store
+    return store
+
+
+def load_vector_store(db_path, model_name=DEFAULT_EMBEDDING_MODEL, quantization=False):
+    """
+    Opens the VectorStore for `model_name` and appends any snippets embedded
+    since it was last saved (snippetIDs only ever grow, so this is one indexed
+    range query plus the new .npy files).
+
+    quantization=None or "int8" switches the store's search mode (persisted);
+    the default False leaves it as it is.
+    """
+    store_dir = get_vector_store_dir(db_path, model_name)
+    store = _open_store(store_dir, model_name)
+    emb_folder = os.path.join(os.path.dirname(os.path.abspath(db_path)), "embedding_data")
+
+    conn = connect_db(db_path)
+    try:
+        c = conn.cursor()
+        c.execute("SELECT MAX(snippetID) FROM documentEmbeddings")
+        max_id = c.fetchone()[0] or 0
+        if store.high_water > max_id:
+            # The database was recreated underneath the store; start over.
+            print(f"Vector store in {store_dir} is ahead of the database; rebuilding it.")
+            shutil.rmtree(store_dir, ignore_errors=True)
+            store = VectorStore(store_dir, model_name)
+            _open_stores[store_dir] = store
+
+        c.execute("""
+            SELECT snippetID, itemID, chunkIndex
+            FROM documentEmbeddings
+            WHERE embeddingModel = ? AND snippetID > ?
+            ORDER BY snippetID
+        """, (model_name, store.high_water))
+        new_rows = c.fetchall()
+    finally:
+        conn.close()
+
+    vectors = []
+    rows = []
+    for s_id, i_id, chunk_idx in new_rows:
+        emb_path = os.path.join(emb_folder, f"snippet_{s_id}.npy")
+        if os.path.exists(emb_path):
+            vectors.append(np.load(emb_path))
+            rows.append((s_id, i_id, chunk_idx))
+
+    changed = False
+    if quantization is not False and quantization != store.quantization:
+        store.set_quantization(quantization)
+        changed = True
+    if rows:
+        store.append(np.array(vectors, dtype=np.float32), rows)
+    if new_rows:
+        store.high_water = max(store.high_water, new_rows[-1][0])
+        changed = True
+    if changed:
+        store.save()
+    return store
+
+
+def load_snapshot_store(db_path, model_name=DEFAULT_EMBEDDING_MODEL):
+    """
+    The read-only segment imported from an index snapshot for `model_name`,
+    or None if no snapshot was imported.
+    """
+    store_dir = get_snapshot_store_dir(db_path, model_name)
+    if not os.path.exists(os.path.join(store_dir, "meta.json")):
+        return None
+    return _open_store(store_dir, model_name)
+
+
+def search_vector_stores(db_path, model_name, qvec, top_k=5, item_ids=None, quantization=False, workers=1):
+    """
+    Searches the model's local store and its imported snapshot segment (if
+    any), restricted to live rows of `item_ids` (None = everything), and
+    merges them. Returns [(similarity, (snippetID, itemID, chunkIndex)), ...]
+    best first.
+    """
+    qvec = np.asarray(qvec, dtype=np.float32)
+    stores = [load_vector_store(db_path, model_name, quantization), load_snapshot_store(db_path, model_name)]
+    scored = []
+    for store in stores:
+        if store is None or store.size == 0 or store.index is None:
+            continue
+        allowed = store.alive.copy()
+        if item_ids is not None:
+            allowed &= store.item_mask(item_ids)
+        if not allowed.any():
+            continue
+        rows = store.search(qvec, top_k=top_k, allowed=allowed, workers=workers)
+        if not rows:
+            continue
+        sims = 1.0 - store.index._distances(qvec, np.asarray(rows))
+        scored.extend((float(sim), tuple(int(x) for x in store.rows[r])) for sim, r in zip(sims, rows))
+    scored.sort(key=lambda x: -x[0])
+    return scored[:top_k]
+
+
+def get_snippet_vectors(db_path, snippet_ids, model_name=DEFAULT_EMBEDDING_MODEL):
+    """
+    Stored vectors for the given snippetIDs from the model's store and
+    snapshot segment. Returns (vectors (n, dim) float32, found bool (n,));
+    rows of snippets without a live vector are zero.
+    """
+    ids = np.asarray(list(snippet_ids), dtype=np.int64)
+    stores = [load_vector_store(db_path, model_name), load_snapshot_store(db_path, model_name)]
+    stores = [s for s in stores if s is not None and s.size and s.index is not None]
+    if not stores:
+        return np.zeros((len(ids), 0), dtype=np.float32), np.zeros(len(ids), dtype=bool)
+
+    vectors = np.zeros((len(ids), stores[0].index.vectors.shape[1]), dtype=np.float32)
+    found = np.zeros(len(ids), dtype=bool)
+    for store in stores:
+        live = np.flatnonzero(store.alive)
+        if not len(live):
+            continue
+        order = np.argsort(store.snippet_ids[live], kind="stable")
+        sorted_ids = store.snippet_ids[live][order]
+        pos = np.minimum(np.searchsorted(sorted_ids, ids), len(sorted_ids) - 1)
+        hit = (sorted_ids[pos] == ids) & ~found
+        if hit.any():
+            vectors[hit] = store.index.vectors[live[order[pos[hit]]]]
+            found |= hit
+    return vectors, found
+
+
+def measure_search_recall(db_path, model_name=DEFAULT_EMBEDDING_MODEL, top_k=10, n_queries=100, seed=0):
+    """
+    Recall@top_k of the store's search (graph or quantized) against an exact
+    full-precision scan, using a random sample of stored vectors as queries.
+    Also reports the in-memory footprint of the search data.
+    """
+    store = load_vector_store(db_path, model_name)
+    live = np.flatnonzero(store.alive)
+    if len(live) == 0:
+        return {"recall": None, "queries": 0, "quantization": store.quantization}
+
+    rng = np.random.default_rng(seed)
+    queries = rng.choice(live, size=min(n_queries, len(live)), replace=False)
+    hits = 0
+    for row in queries:
+        qvec = np.asarray(store.index.vectors[row], dtype=np.float32)
+        expected = set(store.index._exact_search(qvec, top_k, live))
+        hits += len(expected & set(store.search(qvec, top_k, store.alive)))
+
+    dim = store.index.dim
+    return {
+        "recall": hits / float(len(queries) * min(top_k, len(live))),
+        "queries": len(queries),
+        "quantization": store.quantization,
+        "float32_bytes": store.size * dim * 4,
+        "code_bytes": 0 if store.codes is None else int(store.codes.nbytes),
+    }
+
+###############################################################################
+# Garbage collection
+###############################################################################
+
+def delete_snippet_files(db_path, snippet_ids):
+    """
+    Removes embedding_data/snippet_{id}.npy for each snippetID.
+    """
+    emb_folder = os.path.join(os.path.dirname(os.path.abspath(db_path)), "embedding_data")
+    removed = 0
+    for s_id in snippet_ids:
+        emb_path = os.path.join(emb_folder, f"snippet_{s_id}.npy")
+        if os.path.exists(emb_path):
+            os.remove(emb_path)
+            removed += 1
+    return removed
+
+
+def collect_garbage(db_path, compact_threshold=COMPACT_DEAD_FRACTION):
+    """
+    Cleans up after deleted items:
+      1) documentEmbeddings rows whose item no longer exists,
+      2) search_results rows whose snippet no longer exists,
+      3) snippet_*.npy files with no documentEmbeddings row,
+      4) vector store rows for deleted snippets, compacting a store and
+         rebuilding its graph once its dead fraction passes compact_threshold.
+
+    sync_folder_with_db runs this whenever files were removed; it is also safe
+    to call on demand. Returns a dict of what was removed.
+    """
+    stats = {"embeddings": 0, "search_results": 0, "files": 0, "store_rows": 0, "compacted": []}
+
+    conn = connect_db(db_path)
+    try:
+        c = conn.cursor()
+        c.execute("DELETE FROM documentEmbeddings WHERE itemID NOT IN (SELECT itemID FROM items)")
+        stats["embeddings"] = c.rowcount
+        c.execute("DELETE FROM search_results WHERE snippetID NOT IN (SELECT snippetID FROM documentEmbeddings)")
+        stats["search_results"] = c.rowcount
+        conn.commit()
+
+        c.execute("SELECT snippetID, embeddingModel FROM documentEmbeddings")
+        live_by_model = {}
+        for s_id, model in c.fetchall():
+            live_by_model.setdefault(model, []).append(s_id)
+    finally:
+        conn.close()
+
+    live_ids = set()
+    for ids in live_by_model.values():
+        live_ids.update(ids)
+
+    emb_folder = os.path.join(os.path.dirname(os.path.abspath(db_path)), "embedding_data")
+    if os.path.isdir(emb_folder):
+        for fname in os.listdir(emb_folder):
+            m = re.match(r"snippet_(\d+)\.npy$", fname)
+            if m and int(m.group(1)) not in live_ids:
+                os.remove(os.path.join(emb_folder, fname))
+                stats["files"] += 1
+
+    store_dirs = []
+    for root_name in ("store", "snapshot"):
+        store_root = os.path.join(emb_folder, root_name)
+        if os.path.isdir(store_root):
+            store_dirs.extend(os.path.join(store_root, name) for name in sorted(os.listdir(store_root)))
+    for store_dir in store_dirs:
+        name = os.path.basename(store_dir)
+        meta_path = os.path.join(store_dir, "meta.json")
+        if not os.path.exists(meta_path):
+            continue
+        with open(meta_path, "r") as f:
+            model_name = json.load(f).get("model_name", name)
+        store = _open_store(store_dir, model_name)
+        if store.size == 0:
+            continue
+
+        live = np.asarray(live_by_model.get(model_name, []), dtype=np.int64)
+        dead = store.alive & ~np.isin(store.snippet_ids, live)
+        if dead.any():
+            store.alive[dead] = False
+            stats["store_rows"] += int(dead.sum())
+        if store.dead_fraction > compact_threshold and not store.read_only:
+            store.compact()
+            stats["compacted"].append(model_name)
+        if dead.any() or model_name in stats["compacted"]:
+            store.save()
+
+    if stats["embeddings"] or stats["search_results"] or stats["store_rows"]:
+        conn = connect_db(db_path)
+        try:
+            bump_library_generation(conn)
+            conn.commit()
+        finally:
+            conn.close()
+
+    print(f"Garbage collection: {stats}")
+    return stats
@@ -1,3 +1,4 @@
+import hashlib
 import os
 import re
 import shutil
@@ -12,6 +13,10 @@ import pandas as pd
 from sentence_transformers import SentenceTransformer
 
 from extract_text import read_text_file  # We'll use your existing read_text_file() here.
+from inference_worker import RemoteEmbedder, inference_worker_url
+from db_schema import (connect_db, apply_schema_migrations, bump_library_generation,
+                       get_logeny_setting, set_logeny_setting)
+from vector_store import collect_garbage, delete_snippet_files, load_snapshot_store, load_vector_store
 
 ###############################################################################
 # 1) ZOTERO CORE DB LOGIC
@@ -24,7 +29,7 @@ def get_all_collections(db_path):
     if not os.path.exists(db_path):
         raise FileNotFoundError(f"Zotero database not found: {db_path}")
 
-    conn = sqlite3.connect(db_path)
+    conn = connect_db(db_path)
     c = conn.cursor()
     c.execute("SELECT collectionName FROM collections")
     rows = c.fetchall()
@@ -33,28 +38,59 @@ def get_all_collections(db_path):
     collection_names = [r[0] for r in rows if r[0] is not None]
     return sorted(set(collection_names))
 
-def get_collection_items_metadata(db_path, collection_name, require_attachment=False):
+COLLECTION_BY_NAME_SQL = "SELECT collectionID FROM collections WHERE collectionName=?"
+
+def collection_items_sql(recursive=False):
+    """
+    SQL selecting the itemIDs filed in the collection given as its one
+    parameter, and with recursive=True in every subcollection too, resolved
+    through the collectionClosure table in a single indexed query.
+    """
+    if recursive:
+        return """
+            SELECT DISTINCT collectionItems.itemID
+            FROM collectionClosure
+            JOIN collectionItems ON collectionItems.collectionID = collectionClosure.descendantID
+            WHERE collectionClosure.ancestorID = ?
+        """
+    return "SELECT itemID FROM collectionItems WHERE collectionID = ?"
+
+def collection_items_query(c, collection_name, recursive=False):
+    """
+    (sql, params) selecting the itemIDs of the named collection (see
+    collection_items_sql). None when there is no such collection.
+    """
+    c.execute(COLLECTION_BY_NAME_SQL, (collection_name,))
+    row = c.fetchone()
+    if not row:
+        return None
+    return collection_items_sql(recursive), [row[0]]
+
+def get_collection_item_ids(c, collection_name, recursive=False):
+    """
+    Returns the itemIDs filed in the named collection, including those of
+    every subcollection when recursive=True.
+    """
+    query = collection_items_query(c, collection_name, recursive)
+    if query is None:
+        return []
+    c.execute(*query)
+    return [r[0] for r in c.fetchall()]
+
+def get_collection_items_metadata(db_path, collection_name, require_attachment=False, recursive=False):
     """
     Retrieves metadata (title, authors, year, key) for items in the given collection.
     If require_attachment=True, skip items that have no 'key' (file path).
+    If recursive=True, include items from all subcollections.
     """
     if not os.path.exists(db_path):
         raise FileNotFoundError(f"Zotero database not found: {db_path}")
 
-    conn = sqlite3.connect(db_path)
+    conn = connect_db(db_path)
     c = conn.cursor()
 
-    # 1) Find the collectionID
-    c.execute("SELECT collectionID FROM collections WHERE collectionName=?", (collection_name,))
-    row = c.fetchone()
-    if not row:
-        conn.close()
-        return []
-    collection_id = row[0]
-
-    # 2) itemIDs in that collection
-    c.execute("SELECT itemID FROM collectionItems WHERE collectionID=?", (collection_id,))
-    item_ids = [r[0] for r in c.fetchall()]
+    # 1) itemIDs in that collection (and its subcollections if recursive)
+    item_ids = get_collection_item_ids(c, collection_name, recursive)
     if not item_ids:
         conn.close()
         return []
@@ -68,12 +104,12 @@ def get_collection_items_metadata(db_path, collection_name, require_attachment=F
                 # skip if no file
                 continue
 
-        # 3) key -> file path or folder
+        # 2) key -> file path or folder
         c.execute("SELECT key FROM items WHERE itemID=?", (item_id,))
         row_key = c.fetchone()
         doc_key = row_key[0] if row_key else ""
 
-        # 4) Title (fieldID=110)
+        # 3) Title (fieldID=110)
         c.execute("""
             SELECT itemDataValues.value
             FROM itemData
@@ -83,7 +119,7 @@ def get_collection_items_metadata(db_path, collection_name, require_attachment=F
         row_t = c.fetchone()
         title = row_t[0] if row_t else ""
 
-        # 5) Authors
+        # 4) Authors
         c.execute("""
             SELECT group_concat(
                 CASE WHEN creatorData.lastName IS NOT NULL AND creatorData.lastName!=''
@@ -98,7 +134,7 @@ def get_collection_items_metadata(db_path, collection_name, require_attachment=F
         row_a = c.fetchone()
         authors = row_a[0] if row_a else ""
 
-        # 6) Year (fieldID=115)
+        # 5) Year (fieldID=115)
         c.execute("""
             SELECT itemDataValues.value
             FROM itemData
@@ -139,23 +175,24 @@ def sync_folder_with_db(folder_path, db_path):
     if not folder_path.is_dir():
         raise NotADirectoryError(f"{folder_path} is not a valid directory.")
 
-    conn = sqlite3.connect(str(db_path))
+    conn = connect_db(db_path)
     c = conn.cursor()
 
     # -------------------------------------------------------
     # 0) Load existing collections/items
     # -------------------------------------------------------
-    folder_to_coll = _load_existing_collections(c)
-    file_to_item   = _load_existing_items(c)
+    folder_to_coll = _load_existing_collections(c, folder_path)
+    file_to_item   = _load_existing_items(c, folder_path)
 
     disk_folders   = set()
     disk_files     = set()
 
     for dirpath, dirnames, filenames in os.walk(folder_path):
+      dirnames[:] = [d for d in dirnames if d != "embedding_data"]  # our own vector files
       disk_folders.add(Path(dirpath).resolve())
       for f in filenames:
-        if f.endswith(".npy"):
-            continue  # skip .npy files
+        if f.endswith(".npy") or f.endswith(".lgsnap"):
+            continue  # skip .npy files and index snapshots
         if f.startswith(".") or f.startswith("~$"):
             continue  # skip hidden and Word temp lock files
         disk_files.add(Path(dirpath, f).resolve())
@@ -208,7 +245,7 @@ def sync_folder_with_db(folder_path, db_path):
     removed_files = set(file_to_item.keys()) - disk_files
     for old_file in removed_files:
         item_id = file_to_item[old_file]
-        _remove_item(conn, c, item_id)
+        _remove_item(conn, c, item_id, db_path)
         del file_to_item[old_file]
 
     # -------------------------------------------------------
@@ -223,8 +260,32 @@ def sync_folder_with_db(folder_path, db_path):
         item_id = _create_item(conn, c, new_file, parent_coll_id)
         file_to_item[new_file] = item_id
 
+    # -------------------------------------------------------
+    # 5) Detect edited files; their embeddings are stale
+    # -------------------------------------------------------
+    on_disk = {item_id: str(path) for path, item_id in file_to_item.items() if path in disk_files}
+    changed_items = _check_item_files(c, on_disk)
+    stale_snippets = _drop_item_embeddings(c, changed_items)
+
+    if removed_folders or new_folders or removed_files or new_files or changed_items:
+        bump_library_generation(conn)  # invalidates cached search results
     conn.commit()
     conn.close()
+    delete_snippet_files(db_path, stale_snippets)
+    if changed_items:
+        print(f"{len(changed_items)} edited files will be re-embedded.")
+
+    # -------------------------------------------------------
+    # 6) Drop vectors of removed and edited files from the vector stores
+    # -------------------------------------------------------
+    if removed_files or changed_items:
+        collect_garbage(db_path)
+
+    # -------------------------------------------------------
+    # 7) Apply the search history retention policy
+    # -------------------------------------------------------
+    prune_search_results(db_path)
+
     print("Sync complete (root folder also stored as a top-level collection).")
 
 def get_all_items(db_path):
@@ -235,7 +296,7 @@ def get_all_items(db_path):
     if not os.path.exists(db_path):
         raise FileNotFoundError(f"Zotero database not found: {db_path}")
 
-    conn = sqlite3.connect(db_path)
+    conn = connect_db(db_path)
     c = conn.cursor()
     c.execute("SELECT itemID FROM items WHERE itemTypeID!=14")
     rows = c.fetchall()
@@ -312,7 +373,8 @@ def _initialize_default_library(conn):
 def initialize_zotero_db_from_skeleton(skeleton_db, target_db):
     """
     If target_db does not exist, copy skeleton_db to create it.
-    Then ensure libraryID=1 exists in libraries table.
+    Then ensure libraryID=1 exists in libraries table and the schema
+    migrations in db_schema.py are applied.
     Also ensure a default Global project exists as an entity.
     """
     from pathlib import Path
@@ -327,6 +389,7 @@ def initialize_zotero_db_from_skeleton(skeleton_db, target_db):
     conn = sqlite3.connect(str(target_db))
     try:
         _initialize_default_library(conn)
+        apply_schema_migrations(conn)
 
         # Ensure Global project exists as an entity
         c = conn.cursor()
@@ -367,7 +430,7 @@ def insert_project_note(db_path, project_name, note_text, created_by="system"):
     Insert a note into the items table, tagged as a project note.
     If the project doesn't exist as an entity, create it.
     """
-    conn = sqlite3.connect(db_path)
+    conn = connect_db(db_path)
     c = conn.cursor()
 
     try:
@@ -413,6 +476,7 @@ def insert_project_note(db_path, project_name, note_text, created_by="system"):
             (item_id, 'created_by', created_by, created_by)
         ])
 
+        bump_library_generation(conn)  # tag filters now match another item
         conn.commit()
         print(f"Inserted note into project '{project_name}' as item {item_id}.")
 
@@ -421,35 +485,104 @@ def insert_project_note(db_path, project_name, note_text, created_by="system"):
 
 
 
-def _load_existing_collections(c):
+def _under_root(path_str, root):
+    # Only paths inside the folder being synced are ours to remove; other
+    # keys (skeleton sample items, chat items, other synced roots) are left alone.
+    if not path_str or not os.path.isabs(path_str):
+        return False
+    path = Path(path_str).resolve()
+    return path == root or root in path.parents
+
+def _load_existing_collections(c, root):
     folder_map = {}
     c.execute("SELECT collectionID, collectionName, key FROM collections")
     for row in c.fetchall():
         coll_id, coll_name, folder_path_str = row
-        if folder_path_str and os.path.exists(folder_path_str):
+        # Missing folders are kept so sync can detect and remove them.
+        if _under_root(folder_path_str, root):
             folder_map[Path(folder_path_str).resolve()] = coll_id
     return folder_map
 
-def _load_existing_items(c):
+def _load_existing_items(c, root):
     file_map = {}
     c.execute("SELECT itemID, key FROM items WHERE itemTypeID!=14")
     for row in c.fetchall():
         item_id, file_path_str = row
-        if file_path_str and os.path.exists(file_path_str):
+        # Missing files are kept so sync can detect and remove them.
+        if _under_root(file_path_str, root):
             file_map[Path(file_path_str).resolve()] = item_id
     return file_map
 
 def _remove_collection(conn, c, coll_id):
+    c.execute("DELETE FROM collectionClosure WHERE descendantID=? OR ancestorID=?", (coll_id, coll_id))
     c.execute("DELETE FROM collectionItems WHERE collectionID=?", (coll_id,))
     c.execute("DELETE FROM collections WHERE collectionID=?", (coll_id,))
     conn.commit()
 
-def _remove_item(conn, c, item_id):
+ITEM_SNIPPETS_SQL = "SELECT snippetID FROM documentEmbeddings WHERE itemID=?"
+
+def _drop_item_embeddings(c, item_ids):
+    # Deletes the items' snippets (embedding rows and cached search results)
+    # and returns their snippetIDs, whose .npy files the caller removes after
+    # committing. Vector store rows are dropped by collect_garbage().
+    snippet_ids = []
+    for item_id in item_ids:
+        c.execute(ITEM_SNIPPETS_SQL, (item_id,))
+        snippet_ids.extend(r[0] for r in c.fetchall())
+        c.execute("""
+            DELETE FROM search_results
+            WHERE snippetID IN (SELECT snippetID FROM documentEmbeddings WHERE itemID=?)
+        """, (item_id,))
+        c.execute("DELETE FROM documentEmbeddings WHERE itemID=?", (item_id,))
+    return snippet_ids
+
+def _check_item_files(c, item_paths):
+    """
+    Compares each item's file ({itemID: path}) with its recorded mtime, size
+    and SHA-1 in itemFiles and records the current ones. Returns the itemIDs
+    whose content changed; a file seen for the first time is only recorded.
+    The file is only hashed when its mtime or size moved.
+    """
+    c.execute("SELECT itemID, mtime, size, sha1 FROM itemFiles")
+    known = {r[0]: r[1:] for r in c.fetchall()}
+    changed = []
+    for item_id, path in item_paths.items():
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue
+        record = known.get(item_id)
+        if record and record[0] == st.st_mtime and record[1] == st.st_size:
+            continue
+        sha1 = _file_sha1(path)
+        if record and record[2] != sha1:
+            changed.append(item_id)
+        c.execute("INSERT OR REPLACE INTO itemFiles (itemID, mtime, size, sha1) VALUES (?,?,?,?)",
+                  (item_id, st.st_mtime, st.st_size, sha1))
+    return changed
+
+def _file_sha1(path, block_size=1 << 20):
+    digest = hashlib.sha1()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def _remove_item(conn, c, item_id, db_path):
+    # Cascade to the item's snippets: cached search results, embedding rows
+    # and their .npy files. Vector store rows are dropped by collect_garbage().
+    snippet_ids = _drop_item_embeddings(c, [item_id])
+    c.execute("DELETE FROM itemFiles WHERE itemID=?", (item_id,))
     c.execute("DELETE FROM itemData WHERE itemID=?", (item_id,))
     c.execute("DELETE FROM itemCreators WHERE itemID=?", (item_id,))
+    c.execute("DELETE FROM itemTags WHERE itemID=?", (item_id,))
+    tags_removed = c.rowcount > 0
     c.execute("DELETE FROM collectionItems WHERE itemID=?", (item_id,))
     c.execute("DELETE FROM items WHERE itemID=?", (item_id,))
+    if snippet_ids or tags_removed:
+        bump_library_generation(conn)  # invalidates cached search results
     conn.commit()
+    delete_snippet_files(db_path, snippet_ids)
 
 def _create_collection(conn, c, collection_name, parent_coll_id, full_path):
     library_id = 1
@@ -457,8 +590,17 @@ def _create_collection(conn, c, collection_name, parent_coll_id, full_path):
         INSERT INTO collections (libraryID, collectionName, parentCollectionID, key)
         VALUES (?,?,?,?)
     """, (library_id, collection_name, parent_coll_id, full_path))
+    coll_id = c.lastrowid
+
+    # Closure rows: itself at depth 0, plus each of the parent's ancestors one level deeper.
+    c.execute("""
+        INSERT INTO collectionClosure (ancestorID, descendantID, depth)
+        SELECT ancestorID, ?, depth + 1 FROM collectionClosure WHERE descendantID = ?
+        UNION ALL
+        SELECT ?, ?, 0
+    """, (coll_id, parent_coll_id, coll_id, coll_id))
     conn.commit()
-    return c.lastrowid
+    return coll_id
 
 def _create_item(conn, c, file_path, coll_id):
     random_key = _generate_random_key()
@@ -516,62 +658,130 @@ def insert_search_results(db_path, results, queryID, query_text, collection_name
     
     Each `res` dict must contain: snippetID, matched_word, context
     """
-    conn = sqlite3.connect(db_path)
+    conn = connect_db(db_path)
     c = conn.cursor()
-    for res in results:
-        c.execute("""
-            INSERT INTO search_results (queryID, snippetID, query, matched_word, context, collection_name)
-            VALUES (?, ?, ?, ?, ?, ?)
-        """, (queryID, res["snippetID"], query_text, res["matched_word"], res["context"], collection_name))
+    c.executemany("""
+        INSERT INTO search_results (queryID, snippetID, query, matched_word, context, collection_name)
+        VALUES (?, ?, ?, ?, ?, ?)
+    """, [(queryID, res["snippetID"], query_text, res["matched_word"], res["context"], collection_name)
+          for res in results])
     conn.commit()
     conn.close()
 
-def get_search_results(db_path, collection_name=None):
+def search_results_query(collection_name=None, limit=None, before_timestamp=None, before_id=None):
+    """
+    (sql, params) for one page of get_search_results, newest first.
+    """
+    where = []
+    params = []
+    if collection_name:
+        where.append("sr.collection_name = ?")
+        params.append(collection_name)
+    if before_timestamp is not None and before_id is not None:
+        where.append("(sr.timestamp, sr.resultID) < (?, ?)")
+        params.extend([str(before_timestamp), int(before_id)])
+    query = """
+        SELECT sr.snippetID, sr.query, sr.matched_word, sr.context, sr.collection_name, sr.timestamp,
+               i.key AS document, sr.resultID
+        FROM search_results sr
+        JOIN documentEmbeddings de ON sr.snippetID = de.snippetID
+        JOIN items i ON de.itemID = i.itemID
+    """
+    if where:
+        query += " WHERE " + " AND ".join(where)
+    query += " ORDER BY sr.timestamp DESC, sr.resultID DESC"
+    if limit is not None:
+        query += " LIMIT ?"
+        params.append(int(limit))
+    return query, params
+
+def get_search_results(db_path, collection_name=None, limit=None, before_timestamp=None, before_id=None):
     """
     Retrieve search results with document name, based on snippetID → itemID → items.key.
+
+    Newest first. With `limit`, returns one page; pass the last row's
+    timestamp and resultID as before_timestamp/before_id to get the next
+    (keyset pagination, so later pages cost the same as the first).
     """
-    conn = sqlite3.connect(db_path)
+    conn = connect_db(db_path)
     c = conn.cursor()
-
-    if collection_name:
-        c.execute("""
-            SELECT sr.snippetID, sr.query, sr.matched_word, sr.context, sr.collection_name, sr.timestamp,
-                   i.key AS document
-            FROM search_results sr
-            JOIN documentEmbeddings de ON sr.snippetID = de.snippetID
-            JOIN items i ON de.itemID = i.itemID
-            WHERE sr.collection_name = ?
-            ORDER BY sr.timestamp DESC
-        """, (collection_name,))
-    else:
-        c.execute("""
-            SELECT sr.snippetID, sr.query, sr.matched_word, sr.context, sr.collection_name, sr.timestamp,
-                   i.key AS document
-            FROM search_results sr
-            JOIN documentEmbeddings de ON sr.snippetID = de.snippetID
-            JOIN items i ON de.itemID = i.itemID
-            ORDER BY sr.timestamp DESC
-        """)
+    c.execute(*search_results_query(collection_name, limit, before_timestamp, before_id))
 
     rows = c.fetchall()
     conn.close()
 
     df = pd.DataFrame(rows, columns=[
-        "snippetID", "query", "matched_word", "context", "collection_name", "timestamp", "document"
+        "snippetID", "query", "matched_word", "context", "collection_name", "timestamp", "document", "resultID"
     ])
     df["document"] = df["document"].apply(lambda x: os.path.basename(x) if x else "(No Name)")
     return df
 
 
+# Defaults when no retention is configured; 0 disables a limit.
+SEARCH_RESULTS_MAX_AGE_DAYS = 365
+SEARCH_RESULTS_MAX_ROWS = 100000
+
+def set_search_results_retention(db_path, max_age_days=None, max_rows=None):
+    """
+    Stores how long search history is kept (0 = no limit). Applied by
+    prune_search_results, which every folder sync runs.
+    """
+    conn = connect_db(db_path)
+    try:
+        if max_age_days is not None:
+            set_logeny_setting(conn, "search_results_max_age_days", int(max_age_days))
+        if max_rows is not None:
+            set_logeny_setting(conn, "search_results_max_rows", int(max_rows))
+        conn.commit()
+    finally:
+        conn.close()
+
+PRUNE_SEARCH_RESULTS_SQL = "DELETE FROM search_results WHERE timestamp < datetime('now', ?)"
+
+def prune_search_results(db_path, max_age_days=None, max_rows=None):
+    """
+    Deletes search_results older than max_age_days and beyond the newest
+    max_rows. Unset limits come from set_search_results_retention, else the
+    module defaults. Returns the number of rows deleted.
+    """
+    conn = connect_db(db_path)
+    try:
+        c = conn.cursor()
+        if max_age_days is None:
+            max_age_days = int(get_logeny_setting(conn, "search_results_max_age_days", SEARCH_RESULTS_MAX_AGE_DAYS))
+        if max_rows is None:
+            max_rows = int(get_logeny_setting(conn, "search_results_max_rows", SEARCH_RESULTS_MAX_ROWS))
+
+        deleted = 0
+        if max_age_days > 0:
+            c.execute(PRUNE_SEARCH_RESULTS_SQL, (f"-{int(max_age_days)} days",))
+            deleted += c.rowcount
+        if max_rows > 0:
+            c.execute("""
+                DELETE FROM search_results WHERE resultID IN (
+                    SELECT resultID FROM search_results
+                    ORDER BY timestamp DESC, resultID DESC
+                    LIMIT -1 OFFSET ?
+                )
+            """, (int(max_rows),))
+            deleted += c.rowcount
+        conn.commit()
+    finally:
+        conn.close()
+    if deleted:
+        print(f"Pruned {deleted} old search results.")
+    return deleted
+
+
 def get_entity_id(db_path, name, entity_type):
-    with sqlite3.connect(db_path) as con:
+    with connect_db(db_path) as con:
         cur = con.cursor()
         cur.execute("SELECT entity_id FROM entities WHERE entity_name = ? AND entity_type = ?", (name, entity_type))
         result = cur.fetchone()
         return result[0] if result else None
 
 def get_entity_tags(db_path, name, entity_type):
-    with sqlite3.connect(db_path) as con:
+    with connect_db(db_path) as con:
         cur = con.cursor()
         cur.execute("""
             SELECT tagCategory, tagValue 
@@ -583,7 +793,7 @@ def get_entity_tags(db_path, name, entity_type):
 def add_entity_tag(db_path, name, entity_type, tagCategory, tagValue):
     entity_id = get_entity_id(db_path, name, entity_type)
     if entity_id is not None:
-        with sqlite3.connect(db_path) as con:
+        with connect_db(db_path) as con:
             cur = con.cursor()
             cur.execute("""
                 INSERT INTO entity_tags (entity_id, tagCategory, tagValue)
@@ -624,6 +834,12 @@ def generate_document_embeddings(db_path, chunk_size=25, model_name="sentence-tr
     2) For each item in 'items', read text, chunk by chunk_size words
     3) For each chunk, store snippetID row with (chunkStart, chunkEnd, embeddingModel, chunkSize)
     4) Also save a .npy file with the embedding in e.g. [db_folder]/embedding_data/snippet_{snippetID}.npy
+
+    Items that already have embeddings for this model and chunk size from an
+    earlier run are skipped, and so are items covered by an imported index
+    snapshot, whatever its chunk size. Items embedded at another chunk size,
+    or whose file changed since it was last seen (see _check_item_files),
+    lose their old embeddings first and are embedded again.
     """
     import os
     from pathlib import Path
@@ -635,7 +851,10 @@ def generate_document_embeddings(db_path, chunk_size=25, model_name="sentence-tr
     CACHE_DIR = str(Path.home() / ".cache" / "sentence_transformers")
 
     try:
-        embedder = SentenceTransformer(model_name, cache_folder=CACHE_DIR)
+        if inference_worker_url():
+            embedder = RemoteEmbedder(model_name)
+        else:
+            embedder = SentenceTransformer(model_name, cache_folder=CACHE_DIR)
     except Exception as e:
         raise RuntimeError(f"Failed to load embedding model '{model_name}': {e}")
 
@@ -647,7 +866,7 @@ def generate_document_embeddings(db_path, chunk_size=25, model_name="sentence-tr
     emb_folder = os.path.join(db_folder, "embedding_data")
     os.makedirs(emb_folder, exist_ok=True)
 
-    conn = sqlite3.connect(db_path)
+    conn = connect_db(db_path)
     c = conn.cursor()
 
     # -------------------------------------------------------
@@ -656,7 +875,42 @@ def generate_document_embeddings(db_path, chunk_size=25, model_name="sentence-tr
     c.execute("SELECT itemID, key FROM items WHERE itemTypeID!=14")
     rows = c.fetchall()
 
+    changed_items = _check_item_files(c, {i: k for i, k in rows if k and os.path.exists(k)})
+    stale_snippets = _drop_item_embeddings(c, changed_items)
+    conn.commit()
+    if changed_items:
+        delete_snippet_files(db_path, stale_snippets)
+        collect_garbage(db_path)
+        print(f"Re-embedding {len(changed_items)} edited files.")
+
+    c.execute("""
+        SELECT DISTINCT itemID FROM documentEmbeddings
+        WHERE embeddingModel = ? AND chunkSize = ?
+    """, (model_name, chunk_size))
+    already_embedded = {r[0] for r in c.fetchall()}
+    # Snapshot rows keep the snapshot's chunk size; embedding those items
+    # again at this one would only duplicate their hits.
+    snapshot = load_snapshot_store(db_path, model_name)
+    if snapshot is not None and snapshot.size:
+        already_embedded.update(int(i) for i in snapshot.item_ids[snapshot.alive])
+
+    # Local rows at another chunk size are replaced, not added to.
+    c.execute("""
+        SELECT snippetID, itemID FROM documentEmbeddings
+        WHERE embeddingModel = ? AND chunkSize != ?
+    """, (model_name, chunk_size))
+    outdated = [(s_id,) for s_id, item_id in c.fetchall() if item_id not in already_embedded]
+    c.executemany("DELETE FROM search_results WHERE snippetID = ?", outdated)
+    c.executemany("DELETE FROM documentEmbeddings WHERE snippetID = ?", outdated)
+    conn.commit()
+    if outdated:
+        delete_snippet_files(db_path, [s_id for (s_id,) in outdated])
+        collect_garbage(db_path)
+    inserted = 0
+
     for (item_id, file_key) in rows:
+        if item_id in already_embedded:
+            continue
         if file_key and os.path.exists(file_key):
             text = read_text_file(file_key)
             if not text or not text.strip():
@@ -679,9 +933,16 @@ def generate_document_embeddings(db_path, chunk_size=25, model_name="sentence-tr
 
                 emb_path = os.path.join(emb_folder, f"snippet_{snippet_id}.npy")
                 np.save(emb_path, embeddings[idx])
+                inserted += 1
 
+    if inserted or changed_items or outdated:
+        bump_library_generation(conn)  # invalidates cached search results
     conn.commit()
     conn.close()
+
+    # Fold the new vectors into the model's vector store now rather than on
+    # the first search.
+    load_vector_store(db_path, model_name)
     print("Done generating document embeddings in table + .npy files.")
 
 
@@ -0,0 +1,28 @@
+import shutil
+import sys
+from pathlib import Path
+
+import pytest
+
+REPO_DIR = Path(__file__).resolve().parents[1]
+
+# The app loads the modules in Logeny/ as top-level modules (source_python),
+# and they import each other that way.
+sys.path.insert(0, str(REPO_DIR / "Logeny"))
+
+
+@pytest.fixture
+def library_db(tmp_path):
+    """Path to a fresh copy of skeleton.sqlite, migrated on first connect."""
+    path = tmp_path / "zotero.sqlite"
+    shutil.copy(REPO_DIR / "skeleton.sqlite", path)
+    return str(path)
+
+
+@pytest.fixture
+def zotero_db(tmp_path):
+    """A library database set up the way the app does it, from skeleton.sqlite."""
+    from zotero_integration import initialize_zotero_db_from_skeleton
+    path = tmp_path / "zotero.sqlite"
+    initialize_zotero_db_from_skeleton(str(REPO_DIR / "skeleton.sqlite"), str(path))
+    return str(path)
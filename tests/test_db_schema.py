@@ -0,0 +1,100 @@
+import sqlite3
+
+import pytest
+
+import db_schema
+from db_schema import (LATEST_SCHEMA_VERSION, apply_schema_migrations, bump_library_generation, connect_db,
+                       explain_hot_queries, get_library_generation, get_schema_version)
+
+
+def _names(conn, kind):
+    return {r[0] for r in conn.execute("SELECT name FROM sqlite_master WHERE type = ?", (kind,))}
+
+
+def test_migrations_bring_skeleton_to_latest(library_db):
+    conn = sqlite3.connect(library_db)
+    try:
+        assert get_schema_version(conn) == 0
+        assert apply_schema_migrations(conn) == LATEST_SCHEMA_VERSION
+        assert get_schema_version(conn) == LATEST_SCHEMA_VERSION
+        assert {"collectionClosure", "searchCache", "classificationScores", "itemFiles"} <= _names(conn, "table")
+        assert {"documentEmbeddings_itemID", "itemTags_category_response", "collections_collectionName",
+                "search_results_collection_time"} <= _names(conn, "index")
+
+        # Applying again is a no-op.
+        assert apply_schema_migrations(conn) == LATEST_SCHEMA_VERSION
+    finally:
+        conn.close()
+
+
+def test_failed_migration_rolls_back(library_db, monkeypatch):
+    monkeypatch.setattr(db_schema, "SCHEMA_MIGRATIONS", db_schema.SCHEMA_MIGRATIONS + [
+        (LATEST_SCHEMA_VERSION + 1, [
+            "CREATE TABLE halfMigrated (x INT)",
+            "CREATE TABLE broken (",
+        ]),
+    ])
+    conn = sqlite3.connect(library_db)
+    try:
+        with pytest.raises(RuntimeError):
+            apply_schema_migrations(conn)
+        assert get_schema_version(conn) == LATEST_SCHEMA_VERSION
+        assert "halfMigrated" not in _names(conn, "table")
+    finally:
+        conn.close()
+
+
+def test_closure_backfill_covers_existing_collections(library_db):
+    conn = sqlite3.connect(library_db)
+    try:
+        c = conn.cursor()
+        c.execute("INSERT INTO libraries (libraryID, libraryType) SELECT 1, 1 "
+                  "WHERE NOT EXISTS (SELECT 1 FROM libraries WHERE libraryID = 1)")
+        c.execute("INSERT INTO collections (libraryID, collectionName, key) VALUES (1, 'root', 'k1')")
+        root = c.lastrowid
+        c.execute("INSERT INTO collections (libraryID, collectionName, parentCollectionID, key) "
+                  "VALUES (1, 'child', ?, 'k2')", (root,))
+        child = c.lastrowid
+        c.execute("INSERT INTO collections (libraryID, collectionName, parentCollectionID, key) "
+                  "VALUES (1, 'grandchild', ?, 'k3')", (child,))
+        grandchild = c.lastrowid
+        conn.commit()
+
+        apply_schema_migrations(conn)
+
+        rows = set(c.execute("SELECT ancestorID, descendantID, depth FROM collectionClosure "
+                             "WHERE descendantID IN (?, ?, ?)", (root, child, grandchild)))
+        assert rows == {
+            (root, root, 0), (child, child, 0), (grandchild, grandchild, 0),
+            (root, child, 1), (child, grandchild, 1), (root, grandchild, 2),
+        }
+    finally:
+        conn.close()
+
+
+def test_library_generation_counts_bumps(library_db):
+    conn = connect_db(library_db)
+    try:
+        assert get_library_generation(conn) == 0
+        assert bump_library_generation(conn) == 1
+        assert bump_library_generation(conn) == 2
+        conn.commit()
+    finally:
+        conn.close()
+    conn = connect_db(library_db)
+    try:
+        assert get_library_generation(conn) == 2
+    finally:
+        conn.close()
+
+
+def test_hot_queries_use_their_indexes(library_db):
+    # hot_queries() imports the modules that run the queries.
+    for module in ("openai", "google.generativeai", "torch", "transformers", "sentence_transformers",
+                   "sklearn", "pandas"):
+        pytest.importorskip(module)
+
+    report = explain_hot_queries(library_db)
+
+    failing = {name: r["plan"] for name, r in report.items() if not r["uses_index"]}
+    assert not failing
@@ -0,0 +1,106 @@
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+pytest.importorskip("requests")
+
+import llm_api_handler
+from llm_api_handler import LLMAPIError, close_api_sessions, make_api_call
+
+
+class _StubHandler(BaseHTTPRequestHandler):
+    # Keep-alive, so connection reuse shows up as one client port.
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        server = self.server
+        with server.lock:
+            server.requests.append((self.path, self.client_address[1]))
+            script = server.scripts.get(self.path, [])
+            status, headers, delay = script.pop(0) if len(script) > 1 else script[0]
+        if delay:
+            time.sleep(delay)
+        body = b'{"ok": true}'
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def stub_server():
+    """
+    Local HTTP server answering each path from a script of (status,
+    headers, delay) responses; the last one repeats.
+    """
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _StubHandler)
+    server.daemon_threads = True
+    server.lock = threading.Lock()
+    server.requests = []
+    server.scripts = {}
+    server.url = f"http://127.0.0.1:{server.server_address[1]}"
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    close_api_sessions()
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    """Backoff delays make_api_call asked for, without waiting them out."""
+    delays = []
+    monkeypatch.setattr(llm_api_handler.time, "sleep", delays.append)
+    return delays
+
+
+def test_calls_reuse_one_connection(stub_server):
+    stub_server.scripts["/ok"] = [(200, {}, 0)]
+
+    for _ in range(3):
+        assert make_api_call(stub_server.url + "/ok", "POST", {}, {"q": 1}) == '{"ok": true}'
+
+    ports = {port for _, port in stub_server.requests}
+    assert len(stub_server.requests) == 3
+    assert len(ports) == 1
+
+
+def test_429_waits_for_retry_after(stub_server, sleeps):
+    stub_server.scripts["/limited"] = [
+        (429, {"Retry-After": "3"}, 0),
+        (429, {"Retry-After": "3"}, 0),
+        (200, {}, 0),
+    ]
+
+    assert make_api_call(stub_server.url + "/limited", "POST", {}, {}) == '{"ok": true}'
+
+    assert len(stub_server.requests) == 3
+    assert sleeps == [3.0, 3.0]
+
+
+def test_503_raises_after_the_retries(stub_server, sleeps):
+    stub_server.scripts["/down"] = [(503, {}, 0)]
+
+    with pytest.raises(LLMAPIError):
+        make_api_call(stub_server.url + "/down", "POST", {}, {}, max_retries=2)
+
+    assert len(stub_server.requests) == 3
+    assert len(sleeps) == 2
+    assert all(0 <= delay <= llm_api_handler.BACKOFF_MAX_S for delay in sleeps)
+
+
+def test_read_timeout_is_not_retried(stub_server):
+    stub_server.scripts["/slow"] = [(200, {}, 1.0)]
+
+    with pytest.raises(LLMAPIError):
+        make_api_call(stub_server.url + "/slow", "POST", {}, {}, timeout=(1, 0.2))
+
+    assert len(stub_server.requests) == 1
@@ -0,0 +1,152 @@
+import os
+
+import numpy as np
+import pytest
+
+pytest.importorskip("pandas")
+pytest.importorskip("sentence_transformers")
+
+import vector_db_search
+import vector_store
+from db_schema import connect_db
+from vector_db_search import MAX_PAGED_RESULTS, _ranked_hits, get_scope_item_ids, search_hits_page
+from zotero_integration import sync_folder_with_db
+
+MODEL = "test-model"
+DIM = 8
+CHUNKS_PER_ITEM = 30
+
+
+@pytest.fixture
+def library(tmp_path, zotero_db):
+    """
+    zotero_db synced with
+        docs/2019 survey.txt, docs/sub/2021 method.txt, docs/sub/deep/2023 result.txt
+    Returns (db_path, {file name: itemID}).
+    """
+    docs = tmp_path / "docs"
+    (docs / "sub" / "deep").mkdir(parents=True)
+    for path in ("2019 survey.txt", "sub/2021 method.txt", "sub/deep/2023 result.txt"):
+        (docs / path).write_text(f"text of {path}")
+    sync_folder_with_db(str(docs), zotero_db)
+
+    conn = connect_db(zotero_db)
+    try:
+        rows = conn.execute("SELECT itemID, key FROM items WHERE itemTypeID != 14").fetchall()
+    finally:
+        conn.close()
+    root = str(docs.resolve())
+    return zotero_db, {os.path.basename(key): item_id for item_id, key in rows if key and key.startswith(root)}
+
+
+def _scope(db_path, collection_name, recursive=False, filters=None):
+    conn = connect_db(db_path)
+    try:
+        ids = get_scope_item_ids(conn.cursor(), collection_name, recursive, filters)
+    finally:
+        conn.close()
+    return ids if ids is None else set(ids)
+
+
+def test_scope_resolves_collections_and_filters(library):
+    db_path, items = library
+    survey, method, result = items["2019 survey.txt"], items["2021 method.txt"], items["2023 result.txt"]
+    conn = connect_db(db_path)
+    try:
+        conn.execute("INSERT INTO itemTags (itemID, tagCategory, tagResponse) VALUES (?, 'project', 'Global')",
+                     (method,))
+        conn.commit()
+    finally:
+        conn.close()
+
+    assert _scope(db_path, "All Documents") is None
+    assert _scope(db_path, "missing") == set()
+    assert _scope(db_path, "sub") == {method}
+    assert _scope(db_path, "sub", recursive=True) == {method, result}
+    assert _scope(db_path, "docs", recursive=True, filters={"year_from": 2020}) == {method, result}
+    assert _scope(db_path, "All Documents", filters={"year_to": 2021}) >= {survey, method}
+    assert result not in _scope(db_path, "All Documents", filters={"year_to": 2021})
+    assert _scope(db_path, "All Documents", filters={"project": "Global"}) == {method}
+    assert _scope(db_path, "sub", recursive=True, filters={"project": "Global", "year_from": 2022}) == set()
+
+
+@pytest.fixture
+def embedded_library(library, monkeypatch):
+    """
+    library with CHUNKS_PER_ITEM random snippet embeddings per item and a
+    fixed query vector. Returns (db_path, calls), where calls counts vector
+    searches.
+    """
+    db_path, items = library
+    emb_folder = os.path.join(os.path.dirname(db_path), "embedding_data")
+    os.makedirs(emb_folder, exist_ok=True)
+    rng = np.random.default_rng(0)
+    conn = connect_db(db_path)
+    try:
+        c = conn.cursor()
+        for item_id in items.values():
+            for idx in range(CHUNKS_PER_ITEM):
+                c.execute("""
+                    INSERT INTO documentEmbeddings
+                      (itemID, chunkIndex, chunkStart, chunkEnd, embeddingModel, chunkSize)
+                    VALUES (?,?,?,?,?,?)
+                """, (item_id, idx, idx * 50, idx * 50 + 50, MODEL, 50))
+                np.save(os.path.join(emb_folder, f"snippet_{c.lastrowid}.npy"),
+                        rng.standard_normal(DIM).astype(np.float32))
+        conn.commit()
+    finally:
+        conn.close()
+
+    query = rng.standard_normal(DIM).astype(np.float32)
+    monkeypatch.setattr(vector_db_search, "embed_query", lambda query_str, model_name: query)
+    monkeypatch.setattr(vector_store, "EXACT_SEARCH_MAX_ROWS", 0)
+    calls = []
+    search = vector_db_search.search_vector_stores
+
+    def counting_search(*args, **kwargs):
+        calls.append(args[3])
+        return search(*args, **kwargs)
+
+    monkeypatch.setattr(vector_db_search, "search_vector_stores", counting_search)
+    return db_path, calls
+
+
+def test_pages_slice_one_ranking(embedded_library):
+    db_path, calls = embedded_library
+
+    pages = []
+    cursor = None
+    while True:
+        page = search_hits_page(db_path, "docs", "query", cursor=cursor, page_size=7, model_name=MODEL,
+                                recursive=True)
+        pages.append(page["hits"])
+        cursor = page["next_cursor"]
+        if cursor is None:
+            break
+
+    hits = [h for page in pages for h in page]
+    assert all(len(page) == 7 for page in pages[:-1])
+    assert [h["rank"] for h in hits] == list(range(1, len(hits) + 1))
+    assert len({h["snippetID"] for h in hits}) == len(hits) == 3 * CHUNKS_PER_ITEM
+    scores = [h["score"] for h in hits]
+    assert scores == sorted(scores, reverse=True)
+    assert calls == [MAX_PAGED_RESULTS]
+
+    conn = connect_db(db_path)
+    try:
+        ranked = _ranked_hits(conn, db_path, "query", "docs", MAX_PAGED_RESULTS, MODEL, True, None, False)
+    finally:
+        conn.close()
+    assert [(h["snippetID"], h["itemID"], h["chunkIndex"], h["score"]) for h in hits] == \
+        [tuple(r) for r in ranked]
+    assert calls == [MAX_PAGED_RESULTS]
+
+
+def test_page_scope_follows_the_collection(embedded_library):
+    db_path, _ = embedded_library
+
+    page = search_hits_page(db_path, "sub", "query", page_size=100, model_name=MODEL)
+
+    assert {h["document"] for h in page["hits"]} == {"2021 method.txt"}
+    assert len(page["hits"]) == CHUNKS_PER_ITEM
+    assert page["next_cursor"] is None
@@ -0,0 +1,140 @@
+import numpy as np
+import pytest
+
+import vector_store
+from vector_store import VectorStore
+
+DIM = 16
+
+
+def _vectors(n, seed):
+    return np.random.default_rng(seed).standard_normal((n, DIM)).astype(np.float32)
+
+
+def _rows(start, n):
+    # (snippetID, itemID, chunkIndex), four chunks per item; snippetIDs from 1.
+    ids = np.arange(start + 1, start + n + 1)
+    return np.stack([ids, (ids - 1) // 4 + 1, (ids - 1) % 4], axis=1)
+
+
+@pytest.fixture(autouse=True)
+def small_store_limits(monkeypatch):
+    # Walk the graph and scan in blocks even on stores this small.
+    monkeypatch.setattr(vector_store, "EXACT_SEARCH_MAX_ROWS", 0)
+    monkeypatch.setattr(vector_store, "SCAN_BLOCK_ROWS", 37)
+    monkeypatch.setattr(vector_store, "QUANT_BLOCK_ROWS", 37)
+
+
+@pytest.fixture
+def store_dir(tmp_path):
+    return str(tmp_path / "store")
+
+
+def _build(store_dir, n, seed=0, quantization=None):
+    store = VectorStore(store_dir, "test-model")
+    store.set_quantization(quantization)
+    vectors = _vectors(n, seed)
+    store.append(vectors, _rows(0, n))
+    return store, vectors
+
+
+def _finds_itself(store, vectors, rows):
+    return all(store.search(vectors[r], top_k=1) == [r] for r in rows)
+
+
+def test_appends_persist_across_save_and_load(store_dir):
+    store, first = _build(store_dir, 100)
+    second = _vectors(50, seed=1)
+    store.append(second, _rows(100, 50))
+    store.save()
+
+    loaded = VectorStore.load(store_dir, "test-model")
+
+    assert loaded.size == 150
+    assert loaded.high_water == 150
+    np.testing.assert_array_equal(loaded.rows, _rows(0, 150))
+    np.testing.assert_array_equal(np.asarray(loaded.index.vectors), np.vstack([first, second]))
+    np.testing.assert_array_equal(loaded.index.graph, store.index.graph)
+    assert _finds_itself(loaded, np.vstack([first, second]), range(0, 150, 7))
+
+
+def test_unsaved_append_is_dropped_on_load(store_dir):
+    store, first = _build(store_dir, 100)
+    store.save()
+    store.append(_vectors(50, seed=1), _rows(100, 50))  # never saved
+
+    loaded = VectorStore.load(store_dir, "test-model")
+    assert loaded.size == 100
+    np.testing.assert_array_equal(np.asarray(loaded.index.vectors), first)
+
+    third = _vectors(30, seed=2)
+    loaded.append(third, _rows(100, 30))
+    loaded.save()
+    reloaded = VectorStore.load(store_dir, "test-model")
+    assert reloaded.size == 130
+    np.testing.assert_array_equal(np.asarray(reloaded.index.vectors), np.vstack([first, third]))
+
+
+def test_compact_drops_dead_rows(store_dir):
+    store, vectors = _build(store_dir, 200)
+    dead = store.snippet_ids[::2]
+    assert store.mark_dead(dead) == 100
+    assert store.dead_fraction == 0.5
+    live_rows = np.flatnonzero(store.alive)
+    for r in range(0, 200, 9):
+        assert set(store.search(vectors[r], top_k=5, allowed=store.alive)) <= set(live_rows)
+
+    store.compact()
+    store.save()
+    loaded = VectorStore.load(store_dir, "test-model")
+
+    assert loaded.size == 100
+    assert loaded.dead_fraction == 0.0
+    np.testing.assert_array_equal(loaded.rows, _rows(0, 200)[live_rows])
+    np.testing.assert_array_equal(np.asarray(loaded.index.vectors), vectors[live_rows])
+    assert _finds_itself(loaded, vectors[live_rows], range(0, 100, 7))
+
+
+def test_int8_quantized_search_and_persistence(store_dir):
+    store, vectors = _build(store_dir, 300, quantization="int8")
+    assert store.codes.shape == (300, DIM)
+    assert store.codes.dtype == np.uint8
+    assert _finds_itself(store, vectors, range(0, 300, 11))
+
+    more = _vectors(40, seed=3)
+    store.append(more, _rows(300, 40))
+    assert store.codes.shape == (340, DIM)
+    store.save()
+
+    loaded = VectorStore.load(store_dir, "test-model")
+    assert loaded.quantization == "int8"
+    np.testing.assert_array_equal(loaded.codes, store.codes)
+    assert _finds_itself(loaded, np.vstack([vectors, more]), range(0, 340, 13))
+
+    loaded.set_quantization(None)
+    loaded.save()
+    plain = VectorStore.load(store_dir, "test-model")
+    assert plain.quantization is None
+    assert plain.codes is None
+
+
+def test_quantized_compact_reencodes_live_rows(store_dir):
+    store, vectors = _build(store_dir, 120, quantization="int8")
+    store.mark_dead(store.snippet_ids[:40])
+    store.compact()
+    store.save()
+
+    loaded = VectorStore.load(store_dir, "test-model")
+    assert loaded.codes.shape == (80, DIM)
+    assert _finds_itself(loaded, vectors[40:], range(0, 80, 5))
+
+
+def test_compacting_every_row_leaves_a_loadable_store(store_dir):
+    store, _ = _build(store_dir, 30, quantization="int8")
+    store.mark_dead(store.snippet_ids)
+    store.compact()
+    store.save()
+
+    loaded = VectorStore.load(store_dir, "test-model")
+    assert loaded.size == 0
+    assert loaded.search(_vectors(1, seed=4)[0], top_k=3) == []
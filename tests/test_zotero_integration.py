@@ -0,0 +1,96 @@
+from pathlib import Path
+
+import pytest
+
+pytest.importorskip("pandas")
+pytest.importorskip("sentence_transformers")
+
+from db_schema import connect_db, get_library_generation
+from zotero_integration import get_collection_item_ids, sync_folder_with_db
+
+
+@pytest.fixture
+def library(tmp_path, zotero_db):
+    """
+    zotero_db synced with the folder tree
+        docs/a.txt, docs/sub/b.txt, docs/sub/deep/c.txt
+    Returns (db_path, docs folder, {file name: itemID}).
+    """
+    docs = tmp_path / "docs"
+    (docs / "sub" / "deep").mkdir(parents=True)
+    for path in ("a.txt", "sub/b.txt", "sub/deep/c.txt"):
+        (docs / path).write_text(f"text of {path}")
+    sync_folder_with_db(str(docs), zotero_db)
+    return zotero_db, docs, _item_ids(zotero_db, docs)
+
+
+def _item_ids(db_path, docs):
+    # {file name: itemID} for the files synced from docs.
+    conn = connect_db(db_path)
+    try:
+        rows = conn.execute("SELECT itemID, key FROM items WHERE itemTypeID != 14").fetchall()
+    finally:
+        conn.close()
+    root = docs.resolve()
+    return {Path(key).name: item_id for item_id, key in rows if key and root in Path(key).parents}
+
+
+def _collection_items(db_path, name, recursive):
+    conn = connect_db(db_path)
+    try:
+        return set(get_collection_item_ids(conn.cursor(), name, recursive))
+    finally:
+        conn.close()
+
+
+def test_recursive_collection_items_come_from_the_closure(library):
+    db_path, _, items = library
+
+    assert _collection_items(db_path, "sub", recursive=False) == {items["b.txt"]}
+    assert _collection_items(db_path, "sub", recursive=True) == {items["b.txt"], items["c.txt"]}
+    assert _collection_items(db_path, "docs", recursive=True) == set(items.values())
+    assert _collection_items(db_path, "missing", recursive=True) == set()
+
+
+def test_closure_rows_follow_the_folder_tree(library):
+    db_path, docs, _ = library
+    conn = connect_db(db_path)
+    try:
+        ids = dict(conn.execute("SELECT collectionName, collectionID FROM collections"))
+        ancestors = dict(conn.execute("SELECT ancestorID, depth FROM collectionClosure WHERE descendantID = ?",
+                                      (ids["deep"],)))
+    finally:
+        conn.close()
+    assert ancestors == {ids["deep"]: 0, ids["sub"]: 1, ids["docs"]: 2}
+
+    (docs / "sub" / "deep" / "c.txt").unlink()
+    (docs / "sub" / "deep").rmdir()
+    sync_folder_with_db(str(docs), db_path)
+
+    conn = connect_db(db_path)
+    try:
+        stale = conn.execute("SELECT COUNT(*) FROM collectionClosure WHERE ancestorID = ? OR descendantID = ?",
+                             (ids["deep"], ids["deep"])).fetchone()[0]
+    finally:
+        conn.close()
+    assert stale == 0
+    assert _collection_items(db_path, "sub", recursive=True) == {_item_ids(db_path, docs)["b.txt"]}
+
+
+def test_sync_bumps_the_library_generation_only_on_change(library):
+    db_path, docs, _ = library
+
+    def generation():
+        conn = connect_db(db_path)
+        try:
+            return get_library_generation(conn)
+        finally:
+            conn.close()
+
+    before = generation()
+    sync_folder_with_db(str(docs), db_path)
+    assert generation() == before
+
+    (docs / "d.txt").write_text("new file")
+    sync_folder_with_db(str(docs), db_path)
+    assert generation() == before + 1